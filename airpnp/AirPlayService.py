@@ -24,7 +24,6 @@ import platform
 import uuid
 
 from ZeroconfService import ZeroconfService
-from plist import read_binary_plist
 from airplayserver import *
 
 from twisted.python import log
@@ -40,8 +39,30 @@ __all__ = [
 ]
 
 
+def playback_info(duration, position, playing):
+    """Return the value of a playback-info response."""
+    # a position and duration of zero means that nothing has been loaded
+    loaded = duration + position != 0
+    time_range = {'duration': duration, 'start': 0.0}
+    return {
+        'duration': duration,
+        'position': position,
+        'rate': float(playing),
+        'playbackBufferEmpty': not loaded,
+        'playbackBufferFull': False,
+        'playbackLikelyToKeepUp': True,
+        'readyToPlay': loaded,
+        'loadedTimeRanges': [time_range],
+        'seekableTimeRanges': [time_range],
+    }
+
+
 class PlaybackInfoResource(BaseResource):
 
+    def __init__(self, apserver):
+        BaseResource.__init__(self, apserver)
+        self._cache = PListResponseCache(playback_info)
+
     def render_GET(self, request):
         d1 = self.apserver.get_scrub()
         d2 = self.apserver.is_playing()
@@ -52,56 +73,15 @@ class PlaybackInfoResource(BaseResource):
     def late_render_get(self, value, request):
         d, p = value[0][1]
         playing = value[1][1]
+        state = (float(d), float(p), bool(playing))
 
-        content = '<?xml version="1.0" encoding="UTF-8"?>\
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\
-<plist version="1.0">\
-<dict>\
-<key>duration</key>\
-<real>%f</real>\
-<key>position</key>\
-<real>%f</real>\
-<key>rate</key>\
-<real>%f</real>\
-<key>playbackBufferEmpty</key>\
-<%s/>\
-<key>playbackBufferFull</key>\
-<false/>\
-<key>playbackLikelyToKeepUp</key>\
-<true/>\
-<key>readyToPlay</key>\
-<%s/>\
-<key>loadedTimeRanges</key>\
-<array>\
-    <dict>\
-        <key>duration</key>\
-        <real>%f</real>\
-        <key>start</key>\
-        <real>0.000000</real>\
-    </dict>\
-</array>\
-<key>seekableTimeRanges</key>\
-<array>\
-    <dict>\
-        <key>duration</key>\
-        <real>%f</real>\
-        <key>start</key>\
-        <real>0.000000</real>\
-    </dict>\
-</array>\
-</dict>\
-</plist>'
-
-        if (d + p == 0):
-            playbackBufferEmpty = 'true'
-            readyToPlay = 'false'
+        if playing:
+            # the position changes between polls, so caching wouldn't help
+            response = PListResponse(playback_info(*state))
         else:
-            playbackBufferEmpty = 'false'
-            readyToPlay = 'true'
-
-        content = content % (float(d), float(p), int(playing), playbackBufferEmpty, readyToPlay, float(d), float(d))
-        request.setHeader("Content-Type", CT_TEXT_PLIST)
-        return content
+            # while paused or stopped, the client polls for the same state
+            response = self._cache.get(state)
+        return self.render_plist(request, response)
 
 
 class PlayResource(BaseResource):
@@ -113,13 +93,15 @@ class PlayResource(BaseResource):
         # position may not be given for streaming media
         position = parsedbody['Start-Position'] if \
                 'Start-Position' in parsedbody else 0.0
-        self.apserver.play(parsedbody['Content-Location'], float(position))
+        self.ignore_result(self.apserver.play(parsedbody['Content-Location'],
+                                              float(position)), "play")
         return ""
 
     def parse_body(self, headers, body):
         ctype = headers.get('content-type')
-        if ctype == CT_BINARY_PLIST:
-            parsedbody = read_binary_plist(StringIO(body))
+        opener = PLIST_OPENERS.get(ctype)
+        if opener is not None:
+            parsedbody = opener(body)
         else:
             parsedbody = HTTPMessage(StringIO(body))
         return parsedbody
@@ -128,7 +110,7 @@ class PlayResource(BaseResource):
 class StopResource(BaseResource):
 
     def render_POST(self, request):
-        self.apserver.stop()
+        self.ignore_result(self.apserver.stop(), "stop")
         return ""
 
 
@@ -147,7 +129,7 @@ class ScrubResource(BaseResource):
 
     def render_POST(self, request):
         position = request.args['position'][0]
-        self.apserver.set_scrub(float(position))
+        self.ignore_result(self.apserver.set_scrub(float(position)), "scrub")
         return ""
 
 
@@ -165,14 +147,45 @@ class RateResource(BaseResource):
 
     def render_POST(self, request):
         value = request.args['value'][0]
-        self.apserver.rate(float(value))
+        self.ignore_result(self.apserver.rate(float(value)), "rate")
         return ""
 
 
 class PhotoResource(BaseResource):
 
     def render_PUT(self, request):
-        self.apserver.photo(request.content.read(), request.getHeader('X-Apple-Transition'))
+        action = request.getHeader('X-Apple-AssetAction')
+        key = request.getHeader('X-Apple-AssetKey')
+        transition = request.getHeader('X-Apple-Transition')
+        if action == 'displayCached' and key:
+            if not self.apserver.show_cached_photo(key, transition):
+                # the client sends the photo again on this status
+                request.setResponseCode(412)
+        elif action == 'cacheOnly' and key:
+            return self.photo_read(
+                self.apserver.cache_photo(key, request.content), request)
+        else:
+            # the upload is passed on as a file, so that large photos don't
+            # have to be read into memory
+            return self.photo_read(
+                self.apserver.photo(request.content, transition), request)
+        return ""
+
+    def photo_read(self, result, request):
+        """Return the response to a photo upload, which waits until the
+        AirPlay server has read the photo, since the upload is closed when the
+        request is finished."""
+        if not isinstance(result, defer.Deferred):
+            return ""
+        result.addCallback(lambda _: "")
+        result.addErrback(self.photo_rejected, request)
+        return result
+
+    def photo_rejected(self, fail, request):
+        fail.trap(PhotoRejectedError)
+        log.msg("AirPlay photo rejected: %s" % (fail.getErrorMessage(), ),
+                ll=1)
+        request.setResponseCode(503)
         return ""
 
 
@@ -183,49 +196,28 @@ class ServerInfoResource(BaseResource):
         self.deviceid = deviceid
         self.features = features
         self.model = model
+        self._response = PListResponse({
+            'deviceid': deviceid,
+            'features': features,
+            'model': model,
+            'protovers': '1.0',
+            'srcvers': '101.10',
+        })
 
     def render_GET(self, request):
-        content = '<?xml version="1.0" encoding="UTF-8"?>\
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\
-<plist version="1.0">\
-<dict>\
-<key>deviceid</key>\
-<string>%s</string>\
-<key>features</key>\
-<integer>%d</integer>\
-<key>model</key>\
-<string>%s</string>\
-<key>protovers</key>\
-<string>1.0</string>\
-<key>srcvers</key>\
-<string>101.10</string>\
-</dict>\
-</plist>'
-        content = content % (self.deviceid, self.features, self.model)
-        request.setHeader("Content-Type", CT_TEXT_PLIST)
-        return content
+        return self.render_plist(request, self._response)
 
 
 class SlideshowFeaturesResource(BaseResource):
 
+    def __init__(self, ops):
+        BaseResource.__init__(self, ops)
+        self._response = PListResponse({
+            'themes': [{'key': 'UPnP', 'name': 'UPnP'}],
+        })
+
     def render_GET(self, request):
-        content = '<?xml version="1.0" encoding="UTF-8"?>\
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\
-<plist version="1.0">\
-<dict>\
-<key>themes</key>\
-<array>\
-<dict>\
-<key>key</key>\
-<string>UPnP</string>\
-<key>name</key>\
-<string>UPnP</string>\
-</dict>\
-</array>\
-</dict>\
-</plist>'
-        request.setHeader("Content-Type", CT_TEXT_PLIST)
-        return content
+        return self.render_plist(request, self._response)
 
 
 class AirPlayService(MultiService):
@@ -30,27 +30,115 @@ from twisted.web import resource, server
 from twisted.internet import defer
 from twisted.python import log
 from zope.interface import Interface
-from plist import read_binary_plist
+from plist import open_binary_plist, open_xml_plist, write_binary_plist, \
+        write_xml_plist
 from cStringIO import StringIO
 
 __all__ = [
     'BaseResource',
     'IAirPlayServer',
+    'PhotoRejectedError',
     'SessionRejectedError',
     'SetPropertyResource',
     'LogNoResource',
+    'PListResponse',
+    'PListResponseCache',
+    'negotiate_plist_type',
     'CT_BINARY_PLIST',
     'CT_TEXT_PLIST',
+    'PLIST_OPENERS',
 ]
 
 CT_BINARY_PLIST = 'application/x-apple-binary-plist'
 CT_TEXT_PLIST = 'text/x-apple-plist+xml'
 
+# functions that open a plist request body as a PListView, by content type
+PLIST_OPENERS = {
+    CT_BINARY_PLIST: open_binary_plist,
+    CT_TEXT_PLIST: open_xml_plist,
+}
+
 
 class SessionRejectedError(Exception):
     pass
 
 
+class PhotoRejectedError(Exception):
+    """Raised by an AirPlay server that has no room for a photo."""
+
+
+def negotiate_plist_type(accept):
+    """Return the plist content type to use for a response, given the value
+    of the Accept header of the request (or None).
+
+    An XML plist is used unless the client prefers a binary plist.
+
+    """
+    quality = {CT_TEXT_PLIST: 0.0, CT_BINARY_PLIST: 0.0}
+    for entry in (accept or '').split(','):
+        params = entry.split(';')
+        ctype = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if ctype in quality:
+            quality[ctype] = max(quality[ctype], q)
+    if quality[CT_BINARY_PLIST] > quality[CT_TEXT_PLIST]:
+        return CT_BINARY_PLIST
+    return CT_TEXT_PLIST
+
+
+class PListResponse(object):
+    """Plist response document that is encoded once per content type, the
+    first time it is requested in that type."""
+
+    __slots__ = ['value', '_encoded']
+
+    def __init__(self, value):
+        self.value = value
+        self._encoded = {}
+
+    def encode(self, content_type):
+        """Return the document encoded as the given plist content type."""
+        data = self._encoded.get(content_type)
+        if data is None:
+            if content_type == CT_BINARY_PLIST:
+                data = write_binary_plist(self.value)
+            else:
+                data = write_xml_plist(self.value)
+            self._encoded[content_type] = data
+        return data
+
+
+class PListResponseCache(object):
+    """Cache for a plist response that depends on some state, and that is
+    only rebuilt when the state changes."""
+
+    def __init__(self, build):
+        """Initialize the cache.
+
+        Arguments:
+        build -- callable that receives the items of a state tuple, and
+                 returns the value of the plist document
+
+        """
+        self._build = build
+        self._state = None
+        self._response = None
+
+    def get(self, state):
+        """Return a PListResponse for the given state tuple."""
+        if self._response is None or state != self._state:
+            self._response = PListResponse(self._build(*state))
+            self._state = state
+        return self._response
+
+
 class IAirPlayServer(Interface):
 
     def set_session_id(sid):
@@ -91,8 +179,29 @@ class IAirPlayServer(Interface):
     def photo(data, transition):
         """Show a photo.
 
-        Data is the actual photo data, and transition is a transition to use
-        when changing photo.
+        Data is a seekable file-like object that contains the photo data, and
+        transition is a transition to use when changing photo.
+
+        May return a Deferred that fires when the data has been read, which
+        must stay open until then. It fails with a PhotoRejectedError if there
+        is no room for the photo.
+
+        """
+
+    def cache_photo(key, data):
+        """Cache a photo that is to be shown later.
+
+        Key is the asset key that the client uses to refer to the photo, and
+        data is a seekable file-like object that contains the photo data. The
+        result is as for photo.
+
+        """
+
+    def show_cached_photo(key, transition):
+        """Show a previously cached photo.
+
+        Returns False if there is no photo cached with the given asset key, in
+        which case the client has to send the photo again.
 
         """
 
@@ -102,6 +211,10 @@ class IAirPlayServer(Interface):
     def set_property(name, value):
         """Set the value of a property."""
 
+    def close():
+        """Release everything that is held on to for the renderer, when it
+        has disappeared."""
+
 
 class BaseResource(resource.Resource):
 
@@ -109,6 +222,14 @@ class BaseResource(resource.Resource):
         resource.Resource.__init__(self)
         self.apserver = IAirPlayServer(apserver)
 
+    def ignore_result(self, result, action):
+        """Log a failure of a call to the AirPlay server whose result the
+        response doesn't wait for, such as a command that is postponed until
+        the services of the renderer have been initialized."""
+        if isinstance(result, defer.Deferred):
+            result.addErrback(log.err, "AirPlay %s failed" % (action, ))
+        return result
+
     def render(self, request):
         log.msg("Got AirPlay request, URI = %s, %r"
                 % (request.uri, request.getAllHeaders()), ll=3)
@@ -141,19 +262,28 @@ class BaseResource(resource.Resource):
         return ret
 
     def late_render(self, result, request):
-        # DeferredList callbacks with a two-tuple, the first value of which is
-        # the result from the Deferred that fired. The notifyFinish Deferred
-        # callbacks with value None when the request is finished normally.
-        data = result[0]
-        if data:
+        # DeferredList callbacks with a two-tuple of the result and the index
+        # of the Deferred that fired. The notifyFinish Deferred callbacks with
+        # value None when the request has been finished already.
+        data, index = result
+        if index == 0:
             try:
                 # must set content-length to avoid chunked encoding
-                request.setHeader('content-length', len(data))
-                request.write(data)
+                request.setHeader('content-length', len(data or ''))
+                if data:
+                    request.write(data)
                 request.finish()
             except:
                 log.err(None, "Failed to write response data for AirPlay request.")
 
+    def render_plist(self, request, response):
+        """Set the headers for a plist response, in the content type that the
+        client prefers, and return the encoded PListResponse."""
+        ctype = negotiate_plist_type(request.getHeader('accept'))
+        request.setHeader('Content-Type', ctype)
+        request.setHeader('Vary', 'Accept')
+        return response.encode(ctype)
+
     def late_error(self, fail, request):
         # DeferredList errbacks with a FirstError failure, from which we can
         # get the real failure.
@@ -174,13 +304,13 @@ class SetPropertyResource(BaseResource):
 
     def render_PUT(self, request):
         ctype = request.getAllHeaders().get('content-type')
-        if ctype == CT_BINARY_PLIST:
-            prop = request.uri.rsplit("?", 1)[1]
-            parsedbody = read_binary_plist(StringIO(request.content.read()))
-            value = parsedbody.get("value")
-            self.apserver.set_property(prop, value)
-        else:
+        opener = PLIST_OPENERS.get(ctype)
+        if opener is None:
             raise Exception("Unexpected content type for setProperty: %s" % ctype)
+        prop = request.uri.rsplit("?", 1)[1]
+        parsedbody = opener(request.content)
+        value = parsedbody.get("value")
+        self.apserver.set_property(prop, value)
         return ""
 
 
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import random
+from collections import OrderedDict
+from ignore_list import HTTP_ERROR, NETWORK_ERROR, BUILD_ERROR
+
+__all__ = [
+    'RetryBackoff',
+]
+
+# Tuples of (first delay, max delay) in seconds, per failure category
+DEFAULT_DELAYS = {
+    HTTP_ERROR: (10, 1800),
+    NETWORK_ERROR: (5, 600),
+    BUILD_ERROR: (60, 3600),
+}
+
+# Default maximum number of devices to track
+DEFAULT_MAX_SIZE = 1000
+
+
+class RetryBackoff(object):
+    """Exponential backoff with jitter for retrying failed device builds.
+
+    The delay before the next attempt doubles with each consecutive failure
+    of the same device, starting from and capped by values that depend on the
+    category of the failure. The actual delay is randomized between half and
+    all of the computed delay, so that devices that failed at the same time
+    are not retried at the same time.
+
+    """
+
+    def __init__(self, delays=None, max_size=DEFAULT_MAX_SIZE,
+                 rand=random.random):
+        """Initialize the backoff.
+
+        Arguments:
+        delays   -- dictionary of category to a tuple of (first delay, max
+                    delay), defaults to DEFAULT_DELAYS
+        max_size -- maximum number of devices to track; the least recently
+                    failed device is forgotten first
+        rand     -- function that returns a random number in [0, 1)
+
+        """
+        self.delays = delays or DEFAULT_DELAYS
+        self.max_size = max_size
+        self._rand = rand
+        self._failures = OrderedDict()
+
+    def failed(self, udn, category):
+        """Register a failure for the device with the given UDN.
+
+        Return the number of seconds to wait before trying again.
+
+        """
+        count = self._failures.pop(udn, 0) + 1
+        self._failures[udn] = count
+        while len(self._failures) > self.max_size:
+            self._failures.popitem(last=False)
+        first, maximum = self.delays[category]
+        delay = min(maximum, first * 2 ** min(count - 1, 32))
+        return delay / 2.0 + self._rand() * delay / 2.0
+
+    def succeeded(self, udn):
+        """Forget previous failures of the device with the given UDN."""
+        self._failures.pop(udn, None)
+
+    def failure_count(self, udn):
+        """Return the number of consecutive failures for the device with the
+        given UDN."""
+        return self._failures.get(udn, 0)
@@ -26,19 +26,26 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import uuid
+import os
+from collections import OrderedDict
+from cStringIO import StringIO
 from device import CommandError
 from device_discovery import DeviceDiscoveryService
-from airplayserver import IAirPlayServer
+from airplayserver import IAirPlayServer, PhotoRejectedError
 from AirPlayService import AirPlayService
 from upnp import parse_duration, to_duration
 from config import config
-from util import get_image_type, create_device_id
+from util import get_image_type, create_device_id, parse_byte_range
 from interactive import InteractiveWeb
+from ratelimit import SoapBudget
+from photostore import PhotoStore, PhotoStoreFullError
+from relay import MediaRelay
+import imaging
+from events import FOUND, UPDATED, REMOVED
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.application.internet import TCPServer
-from twisted.web import server, resource, static
+from twisted.web import http, server, resource, static
 from twisted.python import log
 
 MEDIA_RENDERER_DEVICE_TYPE = 'urn:schemas-upnp-org:device:MediaRenderer:1'
@@ -53,28 +60,71 @@ MEDIA_RENDERER_TYPES = [MEDIA_RENDERER_DEVICE_TYPE, AVTRANSPORT_SERVICE_TYPE,
 # List of service types that a device must have
 REQ_SERVICE_TYPES = [AVTRANSPORT_SERVICE_TYPE, CONNMANAGER_SERVICE_TYPE]
 
+# Max number of photos that an AirPlay client may cache per renderer
+MAX_CACHED_PHOTOS = 3
+
+# AVTransport actions that are polled while media is played
+POLLED_ACTIONS = ['GetPositionInfo', 'GetTransportInfo']
+
 
 class BridgeServer(DeviceDiscoveryService):
 
     def __init__(self, interface):
         DeviceDiscoveryService.__init__(self, interface[0], MEDIA_RENDERER_TYPES,
                                         [MEDIA_RENDERER_DEVICE_TYPE],
-                                        REQ_SERVICE_TYPES)
+                                        REQ_SERVICE_TYPES, lazy_services=True,
+                                        ignore_file=config.ignore_file(),
+                                        removal_grace=config.device_removal_grace(),
+                                        add_debounce=config.device_add_debounce())
 
         self._ports = []
-        
+
+        # AirPlay services are added and removed outside of the SSDP handling;
+        # this subscription comes first, so that the AirPlay service exists
+        # when the Interactive Web gets the same events
+        self.events.subscribe(self._update_airplay, [FOUND, REMOVED])
+
         # optionally add a server for the Interactive Web
         if config.interactive_web_enabled():
             iwebport = config.interactive_web_port()
             self.iweb = InteractiveWeb(iwebport, interface[0])
             self.iweb.setServiceParent(self)
+            self.events.subscribe(self._update_iweb, [FOUND, UPDATED, REMOVED])
         else:
             self.iweb = None
 
         # add a server for serving photos to UPnP devices
-        self.photoweb = PhotoWeb(0, 5, interface[0])
+        store = PhotoStore(config.photo_memory_budget(),
+                           config.photo_disk_budget(), threaded=True)
+        self.photoweb = PhotoWeb(0, 5, interface[0], store)
         self.photoweb.setServiceParent(self)
 
+        # optionally scale photos for the renderers
+        self.photo_target = (config.photo_max_width(),
+                             config.photo_max_height(),
+                             config.photo_max_size())
+        if config.photo_scaling() and imaging.AVAILABLE:
+            self.scaler = imaging.PhotoScaler(store,
+                                              config.photo_scaling_processes())
+            self.scaler.setServiceParent(self)
+        else:
+            self.scaler = None
+
+        # optionally let the renderers fetch media through a caching relay
+        if config.media_relay():
+            cache = PhotoStore(config.media_relay_memory_budget(),
+                               config.media_relay_disk_budget(),
+                               threaded=True)
+            self.relay = MediaRelay(0, 5, interface[0], cache,
+                                    config.media_relay_read_ahead())
+            self.relay.setServiceParent(self)
+        else:
+            self.relay = None
+
+        # shared budget for SOAP traffic to all renderers
+        self.budget = SoapBudget(config.soap_rate_limit(),
+                                 config.soap_poll_interval())
+
         self.interface = interface
 
     def startService(self):
@@ -84,30 +134,64 @@ class BridgeServer(DeviceDiscoveryService):
             # apparently, logging in __init__ is too early
             iwebport = self.iweb.port
             log.msg("Starting interactive web at port %d" % (iwebport, ))
+        if config.photo_scaling() and not imaging.AVAILABLE:
+            log.msg("Photo scaling requires the Python Imaging Library, "
+                    "photos will be sent unchanged")
         DeviceDiscoveryService.startService(self)
 
-    def on_device_found(self, device):
+    def _update_airplay(self, events):
+        for event in events:
+            if event.kind == FOUND:
+                self._add_airplay_service(event.device)
+            else:
+                self._remove_airplay_service(event.device)
+
+    def _add_airplay_service(self, device):
         log.msg('Found device %s with base URL %s' % (device,
                                                       device.get_base_url()))
-        cpoint = AVControlPoint(device, self.photoweb, self.interface[0])
+        cpoint = AVControlPoint(device, self.photoweb, self.interface[0],
+                                self.budget, self.scaler, self.photo_target,
+                                self.relay)
         devid = create_device_id(device.UDN)
         avc = AirPlayService(cpoint, device.friendlyName, host=self.interface[0], port=self._find_port(), index=self.interface[1], device_id=devid)
         avc.setName(device.UDN)
         avc.setServiceParent(self)
-        
-        if self.iweb:
-            self.iweb.add_device(device) 
 
-    def on_device_removed(self, device):
+    def _update_iweb(self, events):
+        for event in events:
+            device = event.device
+            if event.kind == REMOVED:
+                self.iweb.remove_device(device)
+            else:
+                # the Interactive Web lists all actions of all services
+                dl = defer.DeferredList([s.ensure_initialized()
+                                         for s in device],
+                                        consumeErrors=True)
+                dl.addCallback(self._add_to_iweb, device)
+
+    def _add_to_iweb(self, result, device):
+        # the device may have disappeared while its services were loading
+        if device.UDN in self.namedServices:
+            self.iweb.add_device(device)
+
+    def on_device_suspended(self, device):
+        # keep the AirPlay service published, the device may come back
+        log.msg('Device %s has disappeared, waiting for it to come back' %
+                (device, ), ll=2)
+
+    def on_device_updated(self, device):
+        # the AirPlay service keeps using the same Device and Service objects
+        log.msg('Updated device %s with base URL %s' %
+                (device, device.get_base_url()))
+
+    def _remove_airplay_service(self, device):
         log.msg('Lost device %s' % (device, ))
         avc = self.getServiceNamed(device.UDN)
         avc.disownServiceParent()
+        avc.apserver.close()
         self._ports.remove(avc.port)
         del avc
 
-        if self.iweb:
-            self.iweb.remove_device(device)
-
     def _find_port(self):
         port = 22555
         while port in self._ports:
@@ -116,28 +200,164 @@ class BridgeServer(DeviceDiscoveryService):
         return port
 
 
+def requires_services(func):
+    """Decorator for AVControlPoint methods that invoke service actions.
+
+    If the services of the control point aren't initialized yet, the call is
+    postponed until they are, and a Deferred that fires with the result of
+    the call is returned.
+
+    """
+    def wrapper(self, *args, **kwargs):
+        if self._services_failed:
+            # try again
+            self._init_services()
+            if self._services_failed:
+                # failed again right away
+                return defer.fail(self._services_failure)
+        if self._waiting is None:
+            return func(self, *args, **kwargs)
+        d = defer.Deferred()
+        self._waiting.append((func, args, kwargs, d))
+        return d
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
 class AVControlPoint(object):
 
     implements(IAirPlayServer)
 
     _uri = None
+    _relayed = None
+    _play_token = None
     _client = None
     _instance_id = None
     _photo = None
+    _photo_source = None
+    _photo_token = None
+    _photo_request = None
+    _showing_photo = False
+    _next = None
+    _next_supported = False
     _play_pos = None
+    _waiting = None
+    _services_failed = False
+    _services_failure = None
 
-    def __init__(self, device, photoweb, ip_addr):
+    def __init__(self, device, photoweb, ip_addr, budget=None, scaler=None,
+                 photo_target=None, relay=None):
         self._connmgr = [s for s in device if s.serviceType ==
                          CONNMANAGER_SERVICE_TYPE][0]
         self._avtransport = [s for s in device if s.serviceType ==
                              AVTRANSPORT_SERVICE_TYPE][0]
         self.msg = lambda ll, msg: log.msg('(-> %s) %s' % (device.friendlyName, msg), ll=ll)
         self._photoweb = photoweb
-        self._instance_id = self.allocate_instance_id()
         self._ip_addr = ip_addr
+        self._budget = budget or SoapBudget()
+        self._scaler = scaler
+        self._photo_target = photo_target
+        self._relay = relay
+        # cache entries are lists of the published name and the source name
+        self._cached = OrderedDict()
+        self._polls = {}
+        self._init_services()
+
+    def _init_services(self):
+        """Make sure that the services used by this control point are
+        initialized, fetching their configuration in the background if
+        necessary."""
+        self._services_failed = False
+        services = [self._connmgr, self._avtransport]
+        pending = [s.ensure_initialized() for s in services
+                   if not s.is_initialized()]
+        if pending:
+            # calls made in the meantime are queued here
+            self._waiting = []
+            dl = defer.DeferredList(pending, fireOnOneErrback=True,
+                                    consumeErrors=True)
+            dl.addCallbacks(self._services_ready, self._services_error)
+        else:
+            self._services_ready(None)
+
+    def _services_ready(self, result):
+        waiting, self._waiting = self._waiting, None
+        self._instance_id = self.allocate_instance_id()
+        self._next_supported = hasattr(self._avtransport,
+                                       'SetNextAVTransportURI')
+        if self._scaler is not None and self._photo_target:
+            self._learn_photo_target()
+        for func, args, kwargs, d in waiting or []:
+            defer.maybeDeferred(func, self, *args, **kwargs).chainDeferred(d)
+
+    def _services_error(self, fail):
+        waiting, self._waiting = self._waiting, None
+        self._services_failed = True
+        if fail.check(defer.FirstError):
+            fail = fail.value.subFailure
+        self._services_failure = fail
+        log.err(fail, 'Failed to initialize services')
+        for _, _, _, d in waiting:
+            d.errback(fail)
     
-    def __del__(self):
-        self.release_instance_id(self._instance_id)
+    def _learn_photo_target(self):
+        """Cap the photo target by the JPEG profiles that the renderer says
+        that it supports."""
+        def got_info(info):
+            target = imaging.target_from_protocol_info(info.get('Sink', ''),
+                                                       self._photo_target)
+            if target != self._photo_target:
+                self.msg(2, 'Photos will be scaled to at most %dx%d' %
+                         target[:2])
+                self._photo_target = target
+        def failed(fail):
+            self.msg(2, 'Failed to get protocol info: %s' %
+                     (fail.getErrorMessage(), ))
+        d = self._connmgr.GetProtocolInfo(async=True)
+        d.addCallbacks(got_info, failed)
+
+    def close(self):
+        """Release everything that the control point holds on to, when its
+        device has been removed. The SOAP budget keeps a reference to a
+        playing control point, so this cannot be left to __del__."""
+        self.msg(2, 'Closing control point')
+        self._set_uri(None)
+        self._play_pos = None
+        self._unpublish_photo()
+        self._showing_photo = False
+        self._release_media()
+        self._next = None
+        for key in self._cached.keys():
+            self._uncache_photo(key)
+        if self._instance_id is not None:
+            self.release_instance_id(self._instance_id)
+            self._instance_id = None
+
+    def _poll(self, action):
+        """Invoke an AVTransport status action asynchronously, unless the SOAP
+        budget says that the last response is recent enough to be reused."""
+        stamp, response = self._polls.get(action, (None, None))
+        if not self._budget.acquire_poll(stamp):
+            return defer.succeed(response)
+        stamp = self._budget.seconds()
+        def cache(response):
+            self._polls[action] = (stamp, response)
+            return response
+        d = getattr(self._avtransport, action)(InstanceID=self._instance_id,
+                                               async=True)
+        d.addCallback(cache)
+        return d
+
+    def _set_uri(self, uri, polled=False):
+        # a new URI means that cached status responses are stale
+        self._polls.clear()
+        self._uri = uri
+        # only media is polled by the client; photos are just shown
+        if uri and polled:
+            self._budget.session_started(self, len(POLLED_ACTIONS))
+        else:
+            self._budget.session_ended(self)
 
     def _log_async(self, value, log_level, msg):
         self.msg(log_level, msg % (value, ))
@@ -146,6 +366,7 @@ class AVControlPoint(object):
     def set_session_id(self, sid):
         pass
 
+    @requires_services
     def get_scrub(self):
         def parse_posinfo(posinfo):
             duration = parse_duration(posinfo['TrackDuration'])
@@ -166,7 +387,7 @@ class AVControlPoint(object):
 
         if self._uri:
             # async call, returns a Deferred
-            d = self._avtransport.GetPositionInfo(InstanceID=self._instance_id, async=True)
+            d = self._poll('GetPositionInfo')
             d.addCallback(parse_posinfo)
             d.addCallback(maybe_seek) # 
             d.addCallback(self._log_async, 2, 'Scrub requested, returning duration, position: %r')
@@ -174,10 +395,11 @@ class AVControlPoint(object):
         else:
             return defer.succeed((0.0, 0.0))
 
+    @requires_services
     def is_playing(self):
         if self._uri:
             # async call, returns a Deferred
-            d = self._avtransport.GetTransportInfo(InstanceID=self._instance_id, async=True)
+            d = self._poll('GetTransportInfo')
             d.addCallback(lambda stateinfo: stateinfo['CurrentTransportState'] == 'PLAYING')
             d.addCallback(self._log_async, 2, 'Play status requested, returning %r')
             return d
@@ -188,12 +410,15 @@ class AVControlPoint(object):
         stateinfo = self._avtransport.GetTransportInfo(InstanceID=self._instance_id)
         return stateinfo['CurrentTransportState']
 
+    @requires_services
     def set_scrub(self, position):
         if self._uri:
             hms = to_duration(position)
             self.msg(2, 'Scrubbing/seeking to position %f' % (position, ))
+            self._budget.acquire_command()
             self._avtransport.Seek(InstanceID=self._instance_id, Unit='REL_TIME', Target=hms)
 
+    @requires_services
     def play(self, location, position):
         if config.loglevel() >= 2:
             self.msg(2, 'Starting playback of %s (requested position is %f)' %
@@ -201,14 +426,46 @@ class AVControlPoint(object):
         else:
             self.msg(1, 'Starting playback of %s' % (location, ))
 
+        # a queued photo must not be shown when the media ends, and the
+        # current photo needn't be kept while the media plays
+        self._clear_next()
+        self._unpublish_photo()
+        self._showing_photo = False
+
+        # the renderer fetches the media through the relay, if there is one
+        # and if it can relay the media
+        self._release_media()
+        if self._relay is None:
+            return self._load_media(location, position)
+        # the token identifies this play request when the relay is ready
+        token = self._play_token = object()
+        d = self._relay.relay(location)
+        d.addCallback(self._relay_ready, location, position, token)
+        return d
+
+    def _relay_ready(self, uri, location, position, token):
+        if token is not self._play_token:
+            # stopped or replaced while the relay was probing the media
+            if uri != location:
+                self._relay.release(uri)
+            return
+        self._play_token = None
+        if uri != location:
+            self._relayed = uri
+            self.msg(2, 'Relaying the media at %s' % (uri, ))
+        self._load_media(uri, position)
+
+    def _load_media(self, location, position):
         # start loading of media, state should still be STOPPED
+        self._budget.acquire_command()
         self._avtransport.SetAVTransportURI(InstanceID=self._instance_id, CurrentURI=location, CurrentURIMetaData='')
 
         # indicate that we're playing, and save the requested position
         # to be consumed later when the device knows the duration!
-        self._uri = location        
+        self._set_uri(location, True)
         self._play_pos = position
 
+    @requires_services
     def stop(self):
         if self._uri:
             self.msg(1, 'Stopping playback')
@@ -216,16 +473,32 @@ class AVControlPoint(object):
                 self.msg(1, "Failed to stop playback, device may still be in a playing state")
 
             # clear the URI to indicate that we don't play anymore
-            self._uri = None            
+            self._set_uri(None)
             self._play_pos = None
 
             # unpublish any published photo
-            if not self._photo is None:
-                self._photoweb.unpublish(self._photo)
-                self._photo = None
-                
+            self._unpublish_photo()
+            self._showing_photo = False
+
+        # media that is relayed, or about to be, is no longer needed, nor is
+        # a photo that is being read
+        self._release_media()
+        self._photo_request = None
+
+        # the slideshow (if any) has ended
+        self._next = None
+        for key in self._cached.keys():
+            self._uncache_photo(key)
+
+    def _release_media(self):
+        self._play_token = None
+        if self._relayed is not None:
+            self._relay.release(self._relayed)
+            self._relayed = None
+
     def stop_ignoring_718(self):
         try:
+            self._budget.acquire_command()
             self._avtransport.Stop(InstanceID=self._instance_id)
             return True
         except CommandError, e:
@@ -237,46 +510,223 @@ class AVControlPoint(object):
     def reverse(self, proxy):
         pass
 
+    @requires_services
     def rate(self, speed):
         if self._uri:
             if int(float(speed)) >= 1:
                 self.msg(1, 'Starting/resuming playback')
+                self._budget.acquire_command()
                 self._avtransport.Play(InstanceID=self._instance_id, Speed='1')
             else:
                 self.msg(1, 'Pausing playback')
+                self._budget.acquire_command()
                 self._avtransport.Pause(InstanceID=self._instance_id)
 
     def photo(self, data, transition):
         ctype, ext = get_image_type(data)
 
-        # create a random name for the photo
-        name = str(uuid.uuid4()) + ext
+        # publish the photo right away, since the data may be a file that is
+        # closed when the request has been handled; the token identifies this
+        # photo request when the photo has been read
+        token = self._photo_request = object()
+        d = self._publish_photo(data, ctype, ext)
+        d.addCallback(self._photo_published, token)
+        return d
+
+    def _publish_photo(self, data, ctype, ext):
+        d = self._photoweb.publish(data, ctype, ext)
+        d.addErrback(self._photo_rejected)
+        return d
+
+    def _photo_rejected(self, fail):
+        fail.trap(PhotoStoreFullError)
+        raise PhotoRejectedError(fail.getErrorMessage())
+
+    def _photo_published(self, name, token):
+        if token is not self._photo_request:
+            # stopped, or superseded by other media, while it was being read
+            self._photoweb.unpublish(name)
+            return
+        self._photo_request = None
+
+        # the photo must still be on screen (or on its way there), since
+        # other media may have been played in the meantime
+        if name == self._photo_source and \
+                (self._showing_photo or self._photo_token is not None) and \
+                self._photoweb.is_published(self._photo):
+            self.msg(2, "Photo %s is already shown" % (name, ))
+            self._photoweb.unpublish(name)
+            return
 
         # remove any previous photo
-        if self._photo:
-            self._photoweb.unpublish(self._photo)
+        self._unpublish_photo()
+        self._photo = self._photo_source = name
 
-        # publish the new photo
-        self._photoweb.publish(name, ctype, data)
-        self._photo = name
+        if self._scaler is None or not self._photo_target:
+            d = defer.maybeDeferred(self._show_published_photo, name)
+        else:
+            # the token identifies this photo request when scaling is done
+            token = self._photo_token = object()
+            d = self._scaler.scale(name, self._photo_target)
+            d.addCallback(self._photo_scaled, name, token)
+        # the client doesn't wait for the photo to be shown
+        d.addErrback(log.err, "Failed to show photo %s" % (name, ))
+
+    def _photo_scaled(self, shown, name, token):
+        if token is not self._photo_token:
+            # another photo has been sent while this one was being scaled, and
+            # the original has been unpublished already
+            if shown != name:
+                self._photoweb.unpublish(shown)
+            return
+        self._photo_token = None
+        if shown != name:
+            # the original photo is no longer needed
+            self._photoweb.unpublish(name)
+            self._photo = shown
+        return self._show_published_photo(shown)
+
+    def _unpublish_photo(self):
+        if self._photo is not None:
+            self._photoweb.unpublish(self._photo)
+        self._photo = self._photo_source = self._photo_token = None
+        self._photo_request = None
 
-        # create the URI
-        hostname = self._ip_addr
-        uri = "http://%s:%d/%s" % (hostname, self._photoweb.port, name)
+    def _photo_uri(self, name):
+        return "http://%s:%d/%s" % (self._ip_addr, self._photoweb.port, name)
 
+    def _show_published_photo(self, name, queued=False):
+        uri = self._photo_uri(name)
         self.msg(1, "Showing photo, published at %s" % (uri, ))
+        return self._show_photo(uri, queued)
+
+    @requires_services
+    def _show_photo(self, uri, queued=False):
+        # while a photo is shown, a renderer that supports it can switch to
+        # the next photo without stopping in between
+        if self._next_supported and self._showing_photo:
+            try:
+                if not queued:
+                    self._budget.acquire_command()
+                    self._avtransport.SetNextAVTransportURI(
+                        InstanceID=self._instance_id, NextURI=uri,
+                        NextURIMetaData='')
+                self._next = None
+                self._budget.acquire_command()
+                self._avtransport.Next(InstanceID=self._instance_id)
+                self._set_uri(uri)
+                self._queue_next_photo()
+                return
+            except CommandError, e:
+                self.msg(2, "Failed to switch to the next photo, setting it "
+                         "instead: %s" % (e, ))
+                self._next = None
 
         # start loading of media, also set the URI to indicate that
         # we're playing
-        # Note: if we already have a photo, this would be a good time to call
-        # SetNextAVTransportURI, but I have no media renderer that supports it.
+        self._release_media()
+        self._budget.acquire_command()
         self._avtransport.SetAVTransportURI(InstanceID=self._instance_id,
                                             CurrentURI=uri,
                                             CurrentURIMetaData='')
-        self._uri = uri
+        self._set_uri(uri)
+        self._next = None
 
         # show the photo (no-op if we're already playing)
+        self._budget.acquire_command()
         self._avtransport.Play(InstanceID=self._instance_id, Speed='1')
+        self._showing_photo = True
+        self._queue_next_photo()
+
+    def cache_photo(self, key, data):
+        ctype, ext = get_image_type(data)
+
+        # publish the photo right away, for the same reason as in photo
+        d = self._publish_photo(data, ctype, ext)
+        d.addCallback(self._cached_photo_published, key)
+        return d
+
+    def _cached_photo_published(self, name, key):
+        self._uncache_photo(key)
+        entry = self._cached[key] = [name, name]
+        while len(self._cached) > MAX_CACHED_PHOTOS:
+            self._uncache_photo(next(iter(self._cached)))
+        self.msg(2, "Cached photo %s with asset key %s" % (name, key))
+
+        if self._scaler is None or not self._photo_target:
+            d = defer.maybeDeferred(self._queue_next_photo)
+        else:
+            d = self._scaler.scale(name, self._photo_target)
+            d.addCallback(self._cached_photo_scaled, key, entry)
+        d.addErrback(log.err, "Failed to queue cached photo %s" % (name, ))
+
+    def _cached_photo_scaled(self, shown, key, entry):
+        name = entry[0]
+        if shown == name:
+            return self._queue_next_photo()
+        if self._cached.get(key) is not entry:
+            # the photo has been shown or dropped while it was being scaled
+            self._photoweb.unpublish(shown)
+            return
+        entry[0] = shown
+        if self._next is entry:
+            # the renderer must not fetch the original photo
+            self._next = None
+        d = self._queue_next_photo()
+        self._photoweb.unpublish(name)
+        return d
+
+    def show_cached_photo(self, key, transition):
+        entry = self._cached.pop(key, None)
+        if entry is None:
+            return False
+        queued = self._next is entry
+
+        # the cached photo replaces the current one
+        self._unpublish_photo()
+        self._photo, self._photo_source = entry
+        self._show_published_photo(self._photo, queued)
+        return True
+
+    def _uncache_photo(self, key):
+        entry = self._cached.pop(key, None)
+        if entry is not None:
+            if self._next is entry:
+                self._next = None
+            self._photoweb.unpublish(entry[0])
+
+    @requires_services
+    def _queue_next_photo(self):
+        """Queue the oldest cached photo as the next one on the renderer, if
+        the renderer supports it and a photo is being shown."""
+        if not self._next_supported or not self._showing_photo or \
+                self._next is not None or not self._cached:
+            return
+        entry = next(self._cached.itervalues())
+        uri = self._photo_uri(entry[0])
+        try:
+            self._budget.acquire_command()
+            self._avtransport.SetNextAVTransportURI(
+                InstanceID=self._instance_id, NextURI=uri,
+                NextURIMetaData='')
+        except CommandError, e:
+            self.msg(2, "Failed to queue the next photo, won't try again: "
+                     "%s" % (e, ))
+            self._next_supported = False
+            return
+        self._next = entry
+        self.msg(2, "Queued photo %s as the next one" % (uri, ))
+
+    def _clear_next(self):
+        if self._next is not None:
+            self._next = None
+            try:
+                self._budget.acquire_command()
+                self._avtransport.SetNextAVTransportURI(
+                    InstanceID=self._instance_id, NextURI='',
+                    NextURIMetaData='')
+            except CommandError, e:
+                self.msg(2, "Failed to clear the next photo: %s" % (e, ))
 
     def set_property(self, name, value):
         pass
@@ -292,19 +742,125 @@ class AVControlPoint(object):
             self.msg(2, 'ConnectionManager::ConnectionComplete not implemented!')
 
 
+class StoredPhotoResource(resource.Resource):
+    """Resource that serves a photo in a PhotoStore.
+
+    Photos are named by their contents, so the name of a photo (without the
+    extension) is used as a strong ETag. Conditional requests (If-None-Match
+    and If-Modified-Since) and requests for a single byte range are handled.
+    Each request reads the photo through its own file-like object over the
+    shared buffer of the photo, so the data is never copied as a whole.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, photo):
+        resource.Resource.__init__(self)
+        self.photo = photo
+
+    def render_GET(self, request):
+        photo = self.photo
+        etag = '"%s"' % (os.path.splitext(photo.name)[0], )
+        request.setHeader('content-type', photo.content_type)
+        request.setHeader('accept-ranges', 'bytes')
+        request.setHeader('etag', etag)
+        request.setHeader('last-modified',
+                          http.datetimeToString(photo.mtime))
+        if self._is_not_modified(request, etag):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return ''
+
+        size = photo.size
+        start, end = 0, size
+        value = request.getHeader('range')
+        # If-Range with a date never matches, which is always safe
+        if value and request.getHeader('if-range') in (None, etag):
+            try:
+                byte_range = parse_byte_range(value, size)
+            except ValueError:
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader('content-range', 'bytes */%d' % (size, ))
+                return ''
+            if byte_range is not None:
+                start, end = byte_range
+                request.setResponseCode(http.PARTIAL_CONTENT)
+                request.setHeader('content-range', 'bytes %d-%d/%d' %
+                                  (start, end - 1, size))
+        request.setHeader('content-length', str(end - start))
+        if request.method == 'HEAD' or start == end:
+            return ''
+
+        fobj = StringIO(photo.buffer())
+        if start == 0 and end == size:
+            producer = static.NoRangeStaticProducer(request, fobj)
+        else:
+            producer = static.SingleRangeStaticProducer(request, fobj, start,
+                                                        end - start)
+        producer.start()
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+    def _is_not_modified(self, request, etag):
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = request.getHeader('if-none-match')
+        if tags is not None:
+            tags = [t.strip() for t in tags.split(',')]
+            # weak comparison is used for GET and HEAD
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        since = request.getHeader('if-modified-since')
+        if since is not None:
+            try:
+                since = http.stringToDatetime(since.split(';', 1)[0])
+            except (ValueError, IndexError, KeyError):
+                return False
+            return since >= int(self.photo.mtime)
+        return False
+
+
+class PhotoStoreResource(resource.Resource):
+    """Resource that serves the photos in a PhotoStore."""
+
+    def __init__(self, store):
+        resource.Resource.__init__(self)
+        self.store = store
+
+    def getChild(self, name, request):
+        photo = self.store.get(name)
+        if photo is None:
+            return resource.NoResource()
+        return StoredPhotoResource(photo)
+
+
 class PhotoWeb(TCPServer):
 
-    def __init__(self, port, backlog, ip_addr):
-        self.root = resource.Resource()
+    def __init__(self, port, backlog, ip_addr, store=None):
+        self.store = PhotoStore() if store is None else store
+        self.root = PhotoStoreResource(self.store)
         TCPServer.__init__(self, port, server.Site(self.root), backlog, interface=ip_addr)
 
-    def publish(self, name, content_type, data):
-        self.root.putChild(name, static.Data(data, content_type))
+    def publish(self, data, content_type, ext):
+        """Publish a photo, named by its contents so that it can be shared.
+
+        Return a Deferred that fires with the name of the photo when the data
+        has been read.
+
+        """
+        d = self.store.add_by_contents(content_type, data, ext)
+        d.addCallback(lambda photo: photo.name)
+        return d
 
     def unpublish(self, name):
-        self.root.delEntity(name)
-        
+        self.store.remove(name)
+
+    def is_published(self, name):
+        return name in self.store
+
+    def stopService(self):
+        self.store.clear()
+        return TCPServer.stopService(self)
+
     @property
     def port(self):
         return self._port.getHost().port
-
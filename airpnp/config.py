@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import ConfigParser
+import os.path
 
 __all__ = [
     'config'
@@ -38,6 +39,22 @@ DEFAULTS = {
     "interactive_web": "no",
     "interactive_web_port": "28080",
     "interface": "",
+    "soap_rate_limit": "20",
+    "soap_poll_interval": "0.5",
+    "ignore_file": "",
+    "device_removal_grace": "30",
+    "device_add_debounce": "2",
+    "photo_memory_budget": "16",
+    "photo_disk_budget": "256",
+    "photo_scaling": "no",
+    "photo_scaling_processes": "2",
+    "photo_max_width": "1920",
+    "photo_max_height": "1080",
+    "photo_max_size": "1024",
+    "media_relay": "no",
+    "media_relay_memory_budget": "32",
+    "media_relay_disk_budget": "512",
+    "media_relay_read_ahead": "8",
 }
 
 
@@ -85,6 +102,89 @@ class Config(object):
         """Return the port to use for interactive web."""
         return self._parser.getint("airpnp", "interactive_web_port")
 
+    def soap_rate_limit(self):
+        """Return the maximum number of SOAP requests per second that the
+        bridge may send to all renderers together (0 means no limit)."""
+        return self._parser.getfloat("airpnp", "soap_rate_limit")
+
+    def soap_poll_interval(self):
+        """Return the minimum number of seconds between two status polls of
+        the same renderer."""
+        return self._parser.getfloat("airpnp", "soap_poll_interval")
+
+    def ignore_file(self):
+        """Return the path of the file where ignored devices are saved, or
+        None if they shouldn't be saved."""
+        path = self._parser.get("airpnp", "ignore_file")
+        return os.path.expanduser(path) if path else None
+
+    def device_removal_grace(self):
+        """Return the number of seconds that a device that has disappeared is
+        kept before it is removed."""
+        return self._parser.getfloat("airpnp", "device_removal_grace")
+
+    def device_add_debounce(self):
+        """Return the number of seconds that a new device must stay before it
+        is published."""
+        return self._parser.getfloat("airpnp", "device_add_debounce")
+
+    def photo_memory_budget(self):
+        """Return the max number of bytes of photo data that are kept in
+        memory (configured in megabytes)."""
+        return int(self._parser.getfloat("airpnp", "photo_memory_budget") *
+                   1024 * 1024)
+
+    def photo_disk_budget(self):
+        """Return the max number of bytes of photo data that are kept on disk
+        (configured in megabytes)."""
+        return int(self._parser.getfloat("airpnp", "photo_disk_budget") *
+                   1024 * 1024)
+
+    def photo_scaling(self):
+        """Return whether photos should be scaled for the renderers."""
+        return self._parser.getboolean("airpnp", "photo_scaling")
+
+    def photo_scaling_processes(self):
+        """Return the number of worker processes that scale photos."""
+        return self._parser.getint("airpnp", "photo_scaling_processes")
+
+    def photo_max_width(self):
+        """Return the max width of scaled photos."""
+        return self._parser.getint("airpnp", "photo_max_width")
+
+    def photo_max_height(self):
+        """Return the max height of scaled photos."""
+        return self._parser.getint("airpnp", "photo_max_height")
+
+    def photo_max_size(self):
+        """Return the max number of bytes of scaled photos (configured in
+        kilobytes, 0 means no limit)."""
+        return self._parser.getint("airpnp", "photo_max_size") * 1024
+
+    def media_relay(self):
+        """Return whether renderers should fetch media through the caching
+        relay."""
+        return self._parser.getboolean("airpnp", "media_relay")
+
+    def media_relay_memory_budget(self):
+        """Return the max number of bytes of relayed media that are kept in
+        memory (configured in megabytes)."""
+        return int(self._parser.getfloat("airpnp",
+                                         "media_relay_memory_budget") *
+                   1024 * 1024)
+
+    def media_relay_disk_budget(self):
+        """Return the max number of bytes of relayed media that are kept on
+        disk (configured in megabytes)."""
+        return int(self._parser.getfloat("airpnp", "media_relay_disk_budget") *
+                   1024 * 1024)
+
+    def media_relay_read_ahead(self):
+        """Return the number of bytes that the relay reads from the AirPlay
+        client at a time (configured in megabytes)."""
+        return int(self._parser.getfloat("airpnp", "media_relay_read_ahead") *
+                   1024 * 1024)
+
     def interface_ip(self):
         """Return the IP address of the interface to use for listening services 
         and outbound connections."""
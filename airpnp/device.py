@@ -28,6 +28,8 @@
 
 from upnp import SoapMessage, SoapError, ns, toxpath
 from urlparse import urljoin
+from twisted.internet import defer
+from twisted.python import failure
 
 __all__ = [
     'Device',
@@ -43,14 +45,38 @@ DEVICE_ATTRS = ['deviceType', 'friendlyName', 'manufacturer',
 # Mandatory XML attributes for a service
 SERVICE_ATTRS = ['serviceType', 'serviceId', 'SCPDURL',
                  'controlURL', 'eventSubURL']
-            
-            
+
+# Attributes whose values recur across devices, and are therefore interned
+INTERNED_ATTRS = ['deviceType', 'serviceType', 'serviceId', 'direction']
+
+
+def intern_str(value):
+    """Intern a string value, unless it's a unicode object (which cannot be
+    interned)."""
+    return intern(value) if isinstance(value, str) else value
+
+
 class XMLAttributeMixin(object):
-    
+    """Mixin for model classes that copy attributes from an XML element.
+
+    The attributes listed in xmlattrs are read once, when the object is
+    created, so that no reference to the XML element needs to be kept.
+    Subclasses must declare the attributes as slots.
+
+    """
+
+    __slots__ = []
+
+    def _read_attrs(self, element):
+        for name in self.xmlattrs:
+            value = element.findtext(toxpath(name, self.xmlnamespace))
+            value = value.strip() if value is not None else ''
+            if name in INTERNED_ATTRS:
+                value = intern_str(value)
+            setattr(self, name, value)
+
     def __getattr__(self, name):
-        if not name in self.xmlattrs:
-            raise NameError(name)
-        return self.element.findtext(toxpath(name, self.xmlnamespace)).strip()
+        raise NameError(name)
 
 
 class CommandError(Exception):
@@ -68,6 +94,7 @@ class Device(XMLAttributeMixin):
     
     xmlattrs = DEVICE_ATTRS
     xmlnamespace = ns.device
+    __slots__ = DEVICE_ATTRS + ['_base_url', '_services']
 
     def __init__(self, element, base_url):
         """Initialize this Device object.
@@ -88,8 +115,9 @@ class Device(XMLAttributeMixin):
         """
         self._base_url = base_url
         self._services = {}
-        self.element = element.find(toxpath('device', ns.device))
-        self._read_services(self.element)
+        element = element.find(toxpath('device', ns.device))
+        self._read_attrs(element)
+        self._read_services(element)
 
     def _read_services(self, element):
         for service in element.findall(toxpath('serviceList/service', ns.device)):
@@ -107,6 +135,33 @@ class Device(XMLAttributeMixin):
         """Return the base URL of the device configuration."""
         return self._base_url
 
+    def update(self, other, keep_actions=False):
+        """Update this device in place from a newer description of it.
+
+        Services that exist in both descriptions, with the same ID and type,
+        are updated in place so that references to them stay valid. Other
+        services are added or removed.
+
+        Arguments:
+        other        -- Device object created from the newer description
+        keep_actions -- if True, the service descriptions are known to be
+                        unchanged, so loaded service actions are kept
+
+        """
+        for name in self.xmlattrs:
+            setattr(self, name, getattr(other, name))
+        self._base_url = other._base_url
+        services = {}
+        for service in other:
+            mine = self._services.get(service.serviceId)
+            if mine is not None and mine.serviceType == service.serviceType:
+                mine.update(service, keep_actions)
+                service = mine
+            else:
+                service.device = self
+            services[service.serviceId] = service
+        self._services = services
+
     def __str__(self):
         return '%s [UDN=%s]' % (self.friendlyName, self.UDN)
 
@@ -122,6 +177,7 @@ class Service(XMLAttributeMixin):
 
     xmlattrs = SERVICE_ATTRS
     xmlnamespace = ns.device
+    __slots__ = SERVICE_ATTRS + ['device', 'actions', '_loader', '_waiters']
 
     def __init__(self, device, element, base_url):
         """Initialize this Service object partly.
@@ -130,7 +186,8 @@ class Service(XMLAttributeMixin):
         an object only ensures that mandatory child elements of the <service>
         tag in the device configuration are added as object attributes to the
         newly created object. The initialize method must be called to also
-        add service actions as object methods.
+        add service actions as object methods, either directly or through
+        ensure_initialized if a loader has been set.
 
         Arguments:
         device   -- the Device object that owns this service
@@ -140,15 +197,61 @@ class Service(XMLAttributeMixin):
                     URLs found in the service configuration
 
         """
-        self.element = element
-        self._base_url = base_url
+        self._read_attrs(element)
+        for name in self.xmlattrs:
+            if name.endswith('URL'):
+                setattr(self, name, urljoin(base_url, getattr(self, name)))
         self.device = device
         self.actions = {}
+        self._loader = None
+        self._waiters = None
+
+    def set_loader(self, loader):
+        """Postpone initialization of this service until it is needed.
+
+        Arguments:
+        loader -- callable that receives this service and returns a Deferred
+                  that fires once the initialize method has been called
+
+        """
+        self._loader = loader
+
+    def is_initialized(self):
+        """Return whether the service actions are available or not."""
+        return self._loader is None
+
+    def ensure_initialized(self):
+        """Initialize this service using its loader, unless already done.
+
+        Concurrent calls share the same load operation. If loading fails, the
+        next call will try again.
+
+        Return a Deferred that fires with this service once it has been
+        initialized.
+
+        """
+        if self._loader is None:
+            return defer.succeed(self)
+        waiter = defer.Deferred()
+        if self._waiters is not None:
+            self._waiters.append(waiter)
+        else:
+            self._waiters = [waiter]
+            self._loader(self).addBoth(self._loaded)
+        return waiter
+
+    def _loaded(self, result):
+        waiters, self._waiters = self._waiters, None
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(self)
 
     def initialize(self, scpd_element, soap_sender):
         """Initialize this service object with service actions.
 
-        Each service action is added as a method on this object.
+        Each service action is made available as a method on this object.
 
         Arguments:
         scpd_element -- service configuration retrieved from the SCPD URL
@@ -157,27 +260,59 @@ class Service(XMLAttributeMixin):
 
         """
         self._add_actions(scpd_element, soap_sender)
+        self._loader = None
+
+    def update(self, other, keep_actions=False):
+        """Update this service in place from the same service of a newer
+        device description.
+
+        Arguments:
+        other        -- Service object from the newer description
+        keep_actions -- if True, the service description is known to be
+                        unchanged, so actions are kept if already loaded
+
+        """
+        for name in self.xmlattrs:
+            setattr(self, name, getattr(other, name))
+        if self._waiters is not None:
+            # the old description is being loaded; replacing the loader now
+            # would let that load mark the service as initialized with
+            # outdated actions, so the actions are replaced once it is done
+            waiter = defer.Deferred()
+            waiter.addBoth(lambda _: self._update_actions(other, keep_actions))
+            self._waiters.append(waiter)
+        else:
+            self._update_actions(other, keep_actions)
+
+    def _update_actions(self, other, keep_actions):
+        if keep_actions and self.is_initialized():
+            return
+        self.actions = other.actions
+        for action in self.actions.itervalues():
+            action.service = self
+        self._loader = other._loader
 
     def _add_actions(self, element, soap_sender):
         for action in element.findall(toxpath('actionList/action', ns.service)):
             act = Action(self, action, soap_sender)
             self.actions[act.name] = act
-            setattr(self, act.name, act)
             
     def __getattr__(self, name):
-        value = super(Service, self).__getattr__(name)
-        if name.endswith('URL'):
-            value = urljoin(self._base_url, value)
-        return value
+        # actions are looked up here since there are no slots for them
+        if name != 'actions' and name in self.actions:
+            return self.actions[name]
+        return super(Service, self).__getattr__(name)
 
 
 class Action(XMLAttributeMixin):
 
     xmlattrs = ['name']
     xmlnamespace = ns.service
+    __slots__ = ['name', 'arguments', 'inargs', 'outargs', 'service',
+                 '_soap_sender']
 
     def __init__(self, service, element, soap_sender):
-        self.element = element
+        self._read_attrs(element)
         self.arguments = []
         self._add_arguments(element)
         self._soap_sender = soap_sender
@@ -222,9 +357,10 @@ class Argument(XMLAttributeMixin):
     
     xmlattrs = ['name', 'direction', 'relatedStateVariable']
     xmlnamespace = ns.service
+    __slots__ = xmlattrs
 
     def __init__(self, element):
-        self.element = element
+        self._read_attrs(element)
 
 
 def decode_soap(msg, outargs):
@@ -26,17 +26,34 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from xml.etree import ElementTree as ET
-from device import Device
-from twisted.internet import defer
+from xmlbackend import ET
+from device import Device, intern_str
+from upnp import ns, toxpath
+from util import stream_page
+from twisted.application.service import Service
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 from twisted.web import client
 
 
 __all__ = [
     'DeviceRejectedError',
     'DeviceBuilder',
+    'DescriptionFilter',
+    'FetchCoordinator',
+    'ParserPool',
 ]
 
+# Documents smaller than this (in bytes) are parsed in the reactor thread
+PARSE_THREAD_THRESHOLD = 64 * 1024
+
+# Maximum number of threads used for parsing large documents
+PARSE_MAX_THREADS = 2
+
+# Seconds that a fetched document is reused by other device builders
+FETCH_REUSE_TIME = 10
+
 
 class DeviceRejectedError(Exception):
     """Raised by a DeviceBuilder if a device is rejected by a filter."""
@@ -57,6 +74,247 @@ def reraise_with_url(failure, url):
     failure.raiseException()
 
 
+class ParserPool(Service):
+    """Service that runs XML parsing in a bounded thread pool.
+
+    Parsing a large SCPD can take long enough to stall the reactor, so such
+    documents are handed over to worker threads. Small documents are parsed
+    inline, since the thread hop would cost more than the parsing itself. When
+    the service isn't running, all parsing is inline. Device descriptions are
+    parsed chunk by chunk while they are downloaded (see DescriptionFilter).
+
+    """
+
+    def __init__(self, threshold=PARSE_THREAD_THRESHOLD,
+                 maxthreads=PARSE_MAX_THREADS):
+        self.threshold = threshold
+        self.maxthreads = maxthreads
+        self._pool = None
+
+    def startService(self):
+        Service.startService(self)
+        self._pool = ThreadPool(0, self.maxthreads, name='airpnp-parser')
+        self._pool.start()
+
+    def stopService(self):
+        pool, self._pool = self._pool, None
+        if pool:
+            pool.stop()
+        return Service.stopService(self)
+
+    def parse(self, data, func, *args):
+        """Call func with the data and the additional arguments, in a worker
+        thread if the data is large enough.
+
+        Return a Deferred that fires with the result of the call.
+
+        """
+        if self._pool is None or len(data) < self.threshold:
+            return defer.maybeDeferred(func, data, *args)
+        return threads.deferToThreadPool(reactor, self._pool, func, data, *args)
+
+
+class FetchCoordinator(object):
+    """Coordinator that deduplicates fetches of documents by URL.
+
+    Device builders may be started for several UDNs that share the same
+    location (embedded devices, multi-homed hosts), and different devices may
+    share service descriptions. Concurrent fetches of the same URL share one
+    operation, and a successful result is reused for a short while after it
+    has been fetched. Failures are not reused.
+
+    """
+
+    def __init__(self, reuse_time=FETCH_REUSE_TIME, clock=None):
+        self.reuse_time = reuse_time
+        self._clock = clock or reactor
+        self._pending = {}
+        self._done = {}
+
+    def fetch(self, url, func, *args, **kwargs):
+        """Fetch the given URL by calling func with the URL and the additional
+        arguments, unless a fetch of the same URL is ongoing or has recently
+        finished.
+
+        Return a Deferred that fires with the result of the fetch. Each caller
+        gets its own Deferred, so a caller can cancel without affecting others.
+
+        """
+        now = self._clock.seconds()
+        done = self._done.get(url)
+        if done and done[0] > now:
+            return defer.succeed(done[1])
+        waiter = defer.Deferred()
+        if url in self._pending:
+            self._pending[url].append(waiter)
+        else:
+            self._pending[url] = [waiter]
+            d = defer.maybeDeferred(func, url, *args, **kwargs)
+            d.addBoth(self._fetched, url)
+        return waiter
+
+    def forget(self, url):
+        """Forget a recently fetched result for the given URL, so that the
+        next fetch is done anew."""
+        self._done.pop(url, None)
+
+    def _fetched(self, result, url):
+        now = self._clock.seconds()
+        if not isinstance(result, failure.Failure):
+            # drop expired results while we're at it
+            for key in [k for k, v in self._done.items() if v[0] <= now]:
+                del self._done[key]
+            self._done[url] = (now + self.reuse_time, result)
+        for waiter in self._pending.pop(url):
+            if waiter.called:
+                # cancelled
+                continue
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+
+def parse_scpd(data):
+    """Parse an SCPD and return its root element.
+
+    Only the parsing may be done in a worker thread. The service that the
+    SCPD belongs to may already be published, so it must be initialized on
+    the reactor thread.
+
+    """
+    return ET.fromstring(data)
+
+
+def _path(*names):
+    return tuple(toxpath(name, ns.device) for name in names)
+
+# Element paths of interest in a root device description
+DEVICE_PATH = _path('root', 'device')
+DEVICE_TYPE_PATH = DEVICE_PATH + _path('deviceType')
+FRIENDLY_NAME_PATH = DEVICE_PATH + _path('friendlyName')
+UDN_PATH = DEVICE_PATH + _path('UDN')
+SERVICE_LIST_PATH = DEVICE_PATH + _path('serviceList')
+SERVICE_PATH = SERVICE_LIST_PATH + _path('service')
+SERVICE_TYPE_PATH = SERVICE_PATH + _path('serviceType')
+SERVICE_ID_PATH = SERVICE_PATH + _path('serviceId')
+
+
+class DeviceSummary(object):
+    """The parts of a root device description that are needed for filtering.
+
+    A summary can be passed to a device filter in place of a Device object,
+    since it has the same type attributes and iterates over its services.
+
+    """
+
+    __slots__ = ['deviceType', 'friendlyName', 'UDN', 'location', 'services']
+
+    def __init__(self, location):
+        self.deviceType = self.friendlyName = self.UDN = ''
+        self.location = location
+        self.services = []
+
+    def __iter__(self):
+        return iter(self.services)
+
+    def __str__(self):
+        return '%s [UDN=%s]' % (self.friendlyName or self.location, self.UDN)
+
+
+class ServiceSummary(object):
+    """The parts of a service description that are needed for filtering."""
+
+    __slots__ = ['serviceType', 'serviceId']
+
+    def __init__(self):
+        self.serviceType = self.serviceId = ''
+
+
+class DescriptionTarget(object):
+    """ElementTree parser target that collects a DeviceSummary from the root
+    device of a device description, while building its element tree.
+
+    The type check is called with the summary as soon as the device type is
+    known, and the device check as soon as the service list of the root device
+    is complete. Either check may raise an exception to stop parsing.
+
+    """
+
+    def __init__(self, location, check_type, check_device):
+        self.summary = DeviceSummary(location)
+        self._check_type = check_type
+        self._check_device = check_device
+        self._builder = ET.TreeBuilder()
+        self._path = []
+        self._text = []
+        self.done = False
+
+    def start(self, tag, attrib):
+        self._builder.start(tag, attrib)
+        if self.done:
+            return
+        self._path.append(tag)
+        self._text = []
+        if tuple(self._path) == SERVICE_PATH:
+            self.summary.services.append(ServiceSummary())
+
+    def data(self, data):
+        self._builder.data(data)
+        if not self.done:
+            self._text.append(data)
+
+    def end(self, tag):
+        self._builder.end(tag)
+        if self.done:
+            return
+        path = tuple(self._path)
+        self._path.pop()
+        if len(path) > len(SERVICE_TYPE_PATH):
+            return
+        summary = self.summary
+        text = ''.join(self._text).strip()
+        if path == DEVICE_TYPE_PATH:
+            summary.deviceType = intern_str(text)
+            self._check_type(summary)
+        elif path == FRIENDLY_NAME_PATH:
+            summary.friendlyName = text
+        elif path == UDN_PATH:
+            summary.UDN = text
+        elif path == SERVICE_TYPE_PATH:
+            summary.services[-1].serviceType = intern_str(text)
+        elif path == SERVICE_ID_PATH:
+            summary.services[-1].serviceId = intern_str(text)
+        elif path in (SERVICE_LIST_PATH, DEVICE_PATH):
+            self.done = True
+            self._check_device(summary)
+
+    def close(self):
+        return self._builder.close()
+
+
+class DescriptionFilter(object):
+    """Consumer for stream_page that checks a root device description against
+    the device builder filters while it is being downloaded.
+
+    The document is parsed once, chunk by chunk, and close() returns the root
+    element of the parsed document. A rejection raises an exception from
+    feed(), which aborts the download, and a malformed document raises an
+    exception from close().
+
+    """
+
+    def __init__(self, location, check_type, check_device):
+        self._target = DescriptionTarget(location, check_type, check_device)
+        self._parser = ET.XMLParser(target=self._target)
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        return self._parser.close()
+
+
 class DeviceBuilder(object):
     """Device builder that builds a Device object from a remote location.
 
@@ -66,7 +324,8 @@ class DeviceBuilder(object):
 
     """
 
-    def __init__(self, soap_sender, filter_=None):
+    def __init__(self, soap_sender, filter_=None, parser=None,
+                 type_filter=None, lazy=False, fetcher=None):
         """Initialize a device builder.
 
         Arguments:
@@ -76,10 +335,36 @@ class DeviceBuilder(object):
                        initialization. Should return a tuple of (bool, string),
                        where the bool is the continue flag, and the string is
                        a reason in case the continue flag is False.
+        parser      -- optional ParserPool used for parsing downloaded
+                       SCPDs; if not given, parsing is done inline
+        type_filter -- optional callable that receives the device type as
+                       soon as it has been downloaded, to reject devices
+                       early. Should return a tuple like filter_ does.
+        lazy        -- if True, services are not initialized by the builder;
+                       instead, each service downloads its configuration the
+                       first time its ensure_initialized method is called
+        fetcher     -- optional FetchCoordinator shared with other builders,
+                       so that documents at the same URL are only fetched
+                       once; devices built from the same location are then
+                       shared as well
+
+        The filters are evaluated while the device XML is downloaded, and a
+        rejected device is not downloaded any further. The filter_ callable
+        then receives a DeviceSummary rather than a Device object.
 
         """
         self._filter = filter_
+        self._type_filter = type_filter
+        self._lazy = lazy
         self._soap_sender = soap_sender
+        self._parser = parser or ParserPool()
+        self._fetcher = fetcher or FetchCoordinator()
+
+    def _check_type_filter(self, device):
+        if self._type_filter:
+            accepted, reason = self._type_filter(device.deviceType)
+            if not accepted:
+                raise DeviceRejectedError(device, reason)
 
     def _check_filter(self, device):
         if self._filter:
@@ -88,25 +373,40 @@ class DeviceBuilder(object):
                 raise DeviceRejectedError(device, reason)
         return device
 
-    def _init_service(self, element, service):
-        service.initialize(element, self._soap_sender)
-        return service
+    def _download(self, location):
+        consumer = DescriptionFilter(location, self._check_type_filter,
+                                     self._check_filter)
+        return stream_page(location, consumer, timeout=5)
 
-    def _get_device(self, result):
-        """Get the device from a list of tuples of (success, result), where the
-        result is a Service object.
-        """
-        return result[0][1].device
+    def _load_service(self, service):
+        d = self._fetcher.fetch(service.SCPDURL, client.getPage, timeout=5)
+        d.addErrback(reraise_with_url, service.SCPDURL)
+        d.addCallback(self._parser.parse, parse_scpd)
+        d.addCallback(service.initialize, self._soap_sender)
+        d.addCallback(lambda _: service)
+        return d
 
     def _init_services(self, device):
-        def start_init_service(service):
-            d = client.getPage(service.SCPDURL, timeout=5)
-            d.addErrback(reraise_with_url, service.SCPDURL)
-            d.addCallback(ET.fromstring)
-            d.addCallback(self._init_service, service)
-            return d
-        dl = [start_init_service(s) for s in device]
-        return defer.DeferredList(dl, fireOnOneErrback=True)
+        dl = [s.ensure_initialized() for s in device]
+        d = defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(lambda _: device)
+        return d
+
+    def _defer_services(self, device):
+        for service in device:
+            service.set_loader(self._load_service)
+        return device
+
+    def _fetch_device(self, location):
+        # get the device XML, checking if the device passes the filters
+        # while it's being downloaded
+        d = self._download(location)
+
+        # create a new Device object from the parsed document, whose
+        # services are initialized when needed
+        d.addCallback(Device, location)
+        d.addCallback(self._defer_services)
+        return d
 
     def build(self, location):
         """Build a Device object from a remote location.
@@ -121,25 +421,14 @@ class DeviceBuilder(object):
         """
         d = defer.succeed(location)
 
-        # get the device XML
-        d.addCallback(client.getPage, timeout=5)
+        # get the Device object, possibly shared with another builder
+        d.addCallback(self._fetcher.fetch, self._fetch_device)
 
-        # parse it to an element
-        d.addCallback(ET.fromstring)
+        # initialize services, unless that should be done on demand
+        if not self._lazy:
+            d.addCallback(self._init_services)
 
-        # create a new Device object
-        d.addCallback(Device, location)
-
-        # check if the device passes the filter
-        d.addCallback(self._check_filter)
-
-        # initialize services
-        d.addCallback(self._init_services)
-
-        # error handling for the service initialization
+        # error handling for the device and service initialization
         d.addErrback(reraise_with_url, location)
 
-        # make sure the Device object is returned
-        d.addCallback(self._get_device)
-
         return d
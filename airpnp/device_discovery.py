@@ -33,14 +33,33 @@ from twisted.internet import reactor, defer
 from twisted.application.service import Service, MultiService
 from twisted.application.internet import TimerService
 from twisted.python import log
+from twisted.internet import error as neterror
 from twisted.web import error
+from twisted.web.client import ResponseFailed, ResponseNeverReceived
 from util import *
-from device_builder import DeviceRejectedError, DeviceBuilder
+from device_builder import DeviceRejectedError, DeviceBuilder, ParserPool, \
+        FetchCoordinator
+from ignore_list import *
+from backoff import RetryBackoff
+from lease import LeaseManager
+from registry import DeviceRegistry, index_types, has_compatible_type
+from events import *
 
 
 # Seconds between m-search discoveries
 DISCOVERY_INTERVAL = 300
 
+# Seconds that a device is kept, suspended, after it has disappeared
+REMOVAL_GRACE = 30
+
+# Seconds that a new device must stay before it is reported
+ADD_DEBOUNCE = 2
+
+# Errors that indicate that a device couldn't be reached
+NETWORK_ERRORS = (neterror.ConnectError, neterror.DNSLookupError,
+                  neterror.TimeoutError, defer.TimeoutError, ResponseFailed,
+                  ResponseNeverReceived)
+
 
 class DeviceDiscoveryService(MultiService):
 
@@ -49,11 +68,13 @@ class DeviceDiscoveryService(MultiService):
     Once started, this service will monitor the network for UPnP devices of a
     specific type. If a device is found, the on_device_found(device) method is
     called. When a device disappears, the on_device_removed(device) method is
-    called. A client should subclass this class and implement those methods.
+    called. A client can subclass this class and implement those methods, or
+    subscribe to the same events, delivered in batches, through the events
+    attribute (an EventBus).
 
     """
 
-    def __init__(self, ip_addr, sn_types=[], device_types=[], required_services=[]): # pylint: disable-msg=W0102
+    def __init__(self, ip_addr, sn_types=[], device_types=[], required_services=[], lazy_services=False, ignore_file=None, removal_grace=REMOVAL_GRACE, add_debounce=ADD_DEBOUNCE, clock=None): # pylint: disable-msg=W0102
         """Initialize the service.
 
         Arguments:
@@ -67,16 +88,49 @@ class DeviceDiscoveryService(MultiService):
                              An empty list means that all types are interesting.
         required_services -- if non-empty, list of services that the device
                              must have for it to be considered
+        lazy_services     -- if True, found devices are reported before their
+                             services have been initialized; a client must
+                             call ensure_initialized on the services it uses
+        ignore_file       -- optional path of a file where ignored devices
+                             are saved between runs
+        removal_grace     -- number of seconds that a device that has
+                             disappeared is kept before it is reported as
+                             removed, in case it comes back
+        add_debounce      -- number of seconds that a new device must stay
+                             before it is reported as found
+        clock             -- object that provides IReactorTime, defaults to
+                             the reactor
 
         """
         MultiService.__init__(self)
         self._builders = {}
-        self._devices = {}
-        self._ignored = []
-        self._sn_types = ['upnp:rootdevice'] + sn_types
-        self._dev_types = device_types
+        self._devices = DeviceRegistry()
+        # UDNs of embedded devices, mapped to the UDN of their root device
+        self._roots = {}
+        self._ignored = IgnoreList(path=ignore_file)
+        self._backoff = RetryBackoff()
+        self._sn_types = TypeMatcher(['upnp:rootdevice'] + sn_types)
+        self._dev_types = TypeMatcher(device_types)
         self._req_services = required_services
         self._ip_addr = ip_addr
+        self._lazy_services = lazy_services
+        self.removal_grace = removal_grace
+        self.add_debounce = add_debounce
+        self._clock = clock or reactor
+
+        # create the thread pool service for parsing large documents
+        self._parser = ParserPool()
+        self._parser.setServiceParent(self)
+
+        # shared by device builders to avoid fetching the same document twice
+        self._fetcher = FetchCoordinator()
+
+        # delivers device events to subscribers outside of the discovery path
+        self.events = EventBus(clock=clock)
+
+        # keeps track of when devices expire unless they announce themselves
+        self._leases = LeaseManager(self._devices_expired, clock=clock)
+        self._leases.setServiceParent(self)
 
         # create the UPnP listener service
         UpnpService(self._datagram_handler, ip_addr).setServiceParent(self)
@@ -86,21 +140,22 @@ class DeviceDiscoveryService(MultiService):
         TimerService(DISCOVERY_INTERVAL, self._msearch_discover,
                      msearch).setServiceParent(self)
 
-    def _is_device_interesting(self, device):
+    def _is_device_type_interesting(self, device_type):
         # the device must have an approved device type
-        compat = [d for d in self._dev_types 
-                  if are_service_types_compatible(d, device.deviceType)]
-        if self._dev_types and not compat:
-            reason = "device type %s is not recognized" % (device.deviceType, )
+        if self._dev_types and not self._dev_types.matches(device_type):
+            reason = "device type %s is not recognized" % (device_type, )
             return False, reason
+        return True, None
+
+    def _is_device_interesting(self, device):
+        accepted, reason = self._is_device_type_interesting(device.deviceType)
+        if not accepted:
+            return accepted, reason
 
         # the device must contain all required services
-        missing = []
-        for rs in self._req_services:
-            matches = [s.serviceType for s in device
-                       if are_service_types_compatible(rs, s.serviceType)]
-            if not matches:
-                missing.append(rs)
+        services = index_types([s.serviceType for s in device])
+        missing = [rs for rs in self._req_services
+                   if not has_compatible_type(services, rs)]
         if missing:
             reason = "services %s are missing" % (missing, )
             return False, reason
@@ -108,6 +163,44 @@ class DeviceDiscoveryService(MultiService):
         # passed all tests, device is interesting
         return True, None
 
+    def startService(self):
+        self._ignored.load()
+        MultiService.startService(self)
+
+    def stopService(self):
+        self._ignored.save()
+        self.events.flush()
+        return MultiService.stopService(self)
+
+    def _report(self, kind, device):
+        """Report a device event to the subclass hook and the registry
+        subscribers, and publish it on the event bus.
+
+        This is the only place where devices are reported, so all of them
+        see the same published devices.
+
+        """
+        # the hooks are named after the event kinds
+        getattr(self, 'on_device_' + kind)(device)
+        if kind in (FOUND, UPDATED, REMOVED):
+            self._devices.notify(device.UDN, device)
+        self.events.publish(kind, device)
+
+    def find_devices(self, **criteria):
+        """Return a list of the found devices that match all the given
+        criteria; see DeviceRegistry for the possible criteria."""
+        return [mgr.device for mgr in self._devices.find(**criteria)
+                if mgr.published]
+
+    def subscribe(self, on_added, on_removed, **criteria):
+        """Subscribe to found devices that match all the given criteria; see
+        DeviceRegistry.subscribe."""
+        return self._devices.subscribe(on_added, on_removed, **criteria)
+
+    def unsubscribe(self, subscription):
+        """Cancel a subscription returned by subscribe."""
+        self._devices.unsubscribe(subscription)
+
     def on_device_found(self, device):
         """Called when a device has been found."""
         pass
@@ -116,6 +209,20 @@ class DeviceDiscoveryService(MultiService):
         """Called when a device has disappeared."""
         pass
 
+    def on_device_suspended(self, device):
+        """Called when a device has disappeared, but may come back before it
+        is removed."""
+        pass
+
+    def on_device_resumed(self, device):
+        """Called when a suspended device has come back."""
+        pass
+
+    def on_device_updated(self, device):
+        """Called when a device has been updated in place, after it has
+        rebooted or changed its description."""
+        pass
+
     def _datagram_handler(self, datagram, address):
         """Process incoming datagram, either response or notification."""
         umessage = UpnpMessage(datagram)
@@ -132,45 +239,188 @@ class DeviceDiscoveryService(MultiService):
             if nts == 'ssdp:alive':
                 self._handle_response(umessage)
             elif nts == 'ssdp:byebye':
-                self._device_expired(umessage.get_udn())
+                self._device_expired(self._roots.get(udn, udn))
+
+    def _devices_expired(self, udns):
+        """Handle lack of renewal for a batch of devices."""
+        for udn in udns:
+            self._device_expired(udn)
 
     def _device_expired(self, udn):
-        """Handle a bye-bye message from a device, or lack of renewal."""
+        """Handle a bye-bye message from a device, or lack of renewal.
+
+        A reported device is suspended for a grace period before it is
+        removed, so that a device that comes and goes doesn't cause a removal
+        and an addition each time.
+
+        """
+        mgr = self._devices.get(udn)
+        if mgr is None or mgr.suspended:
+            return
+        if not mgr.published or not self.removal_grace:
+            self._remove_device(udn)
+            return
+        self._cancel_builder(udn)
+        log.msg('Device %s expired or said goodbye, suspending it' %
+                (mgr.device, ), ll=2)
+        mgr.suspend(self._clock.callLater(self.removal_grace,
+                                          self._remove_device, udn))
+        self._report(SUSPENDED, mgr.device)
+
+    def _cancel_builder(self, udn):
+        builder = self._builders.pop(udn, None)
+        if builder:
+            builder.cancel()
+
+    def _remove_device(self, udn):
+        """Remove a device, and report it if it has been reported as found."""
         if udn in self._devices:
-            builder = self._builders.pop(udn, None)
-            if builder:
-                builder.cancel()
-            mgr = self._devices.pop(udn)
-            log.msg('Device %s expired or said goodbye' % (mgr.device, ), ll=2)
+            self._cancel_builder(udn)
+            mgr = self._devices.remove(udn)
+            for embedded, root in self._roots.items():
+                if root == udn:
+                    del self._roots[embedded]
+            log.msg('Removing device %s' % (mgr.device, ), ll=2)
             mgr.stop()
-            self.on_device_removed(mgr.device)
+            if mgr.published:
+                self._report(REMOVED, mgr.device)
 
     def _handle_response(self, umessage):
         """Handle response to M-SEARCH message."""
         udn = umessage.get_udn()
         if udn and not udn in self._ignored:
+            # an embedded device is handled through its root device
+            udn = self._roots.get(udn, udn)
             mgr = self._devices.get(udn)
             if mgr:
+                if mgr.suspended:
+                    log.msg('Device %s is back' % (mgr.device, ), ll=2)
+                    mgr.resume()
+                    self._report(RESUMED, mgr.device)
+                if not udn in self._builders and mgr.has_changed(umessage) \
+                        and self._clock.seconds() >= mgr.rebuild_after:
+                    self._rebuild_device(mgr, umessage)
                 mgr.touch(umessage)
             elif not udn in self._builders:
                 self._build_device(umessage)
 
+    def _create_builder(self, lazy):
+        return DeviceBuilder(self._send_soap_message,
+                             self._is_device_interesting,
+                             self._parser,
+                             self._is_device_type_interesting,
+                             lazy,
+                             self._fetcher)
+
     def _build_device(self, umessage):
         """Start building a device if it seems to be a proper one."""
-        acttype = umessage.get_type()
-        compat = [s for s in self._sn_types 
-                  if are_service_types_compatible(s, acttype)]
-        if compat:
+        if self._sn_types.matches(umessage.get_type()):
             udn = umessage.get_udn()
-            builder = DeviceBuilder(self._send_soap_message,
-                                    self._is_device_interesting)
+            builder = self._create_builder(self._lazy_services)
             d = builder.build(umessage.get_location())
-            
-            d.addCallback(self._device_finished, umessage)
-            d.addErrback(self._device_error, udn)
 
+            # registered before the callbacks are added, since the build may
+            # already be done if all documents were fetched before
             log.msg("Starting build of device with UDN = %s" % (udn, ), ll=3)
             self._builders[udn] = d
+            d.addCallback(self._device_finished, umessage)
+            d.addErrback(self._device_error, udn)
+
+    def _rebuild_device(self, mgr, umessage):
+        """Start an incremental rebuild of a known device whose boot ID,
+        configuration ID or location has changed.
+
+        The device description is fetched anew, but service descriptions
+        are only fetched if the configuration may have changed. The existing
+        Device object is then updated in place.
+
+        """
+        udn = mgr.device.UDN
+        location = umessage.get_location()
+        keep_actions = mgr.has_same_config(umessage)
+        log.msg('Device %s has changed, refreshing it from %s' %
+                (mgr.device, location), ll=2)
+
+        self._fetcher.forget(location)
+        d = self._create_builder(True).build(location)
+        self._builders[udn] = d
+        d.addCallback(self._load_changed_services, mgr.device, keep_actions)
+        d.addCallback(self._device_rebuilt, mgr, umessage, keep_actions)
+        d.addErrback(self._rebuild_error, mgr)
+
+    def _load_changed_services(self, device, old_device, keep_actions):
+        """Load the new descriptions of services that are in use, so that
+        they can replace the old ones without interruption."""
+        dl = []
+        for service in device:
+            try:
+                old = old_device[service.serviceId]
+            except KeyError:
+                continue
+            if old.is_initialized() and not keep_actions:
+                self._fetcher.forget(service.SCPDURL)
+                dl.append(service.ensure_initialized())
+        d = defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(lambda _: device)
+        return d
+
+    def _device_rebuilt(self, device, mgr, umessage, keep_actions):
+        """Handle completion of an incremental device rebuild."""
+        udn = mgr.device.UDN
+        self._builders.pop(udn, None)
+        if device.UDN != udn or device.deviceType != mgr.device.deviceType:
+            log.msg('Location of device %s now has device %s' %
+                    (mgr.device, device), ll=2)
+            self._remove_device(udn)
+            return
+        mgr.device.update(device, keep_actions)
+        self._devices.reindex(udn)
+        mgr.identify(umessage)
+        mgr.rebuild_after = 0
+        self._backoff.succeeded(udn)
+        if mgr.published:
+            self._report(UPDATED, mgr.device)
+
+    def _rebuild_error(self, fail, mgr):
+        """Handle error that occurred when rebuilding a device.
+
+        A device that is rejected is removed. Otherwise the device is kept as
+        it is, since it may e.g. have rebooted before its HTTP server is up,
+        and the rebuild is retried when the device announces itself after a
+        backoff delay.
+
+        """
+        if fail.check(defer.FirstError):
+            fail = fail.value.subFailure
+        if fail.check(defer.CancelledError):
+            return
+        udn = mgr.device.UDN
+        if fail.check(DeviceRejectedError):
+            self._device_error(fail, udn)
+            self._remove_device(udn)
+            return
+        self._builders.pop(udn, None)
+        category = self._failure_category(fail)
+        if category == BUILD_ERROR:
+            log.err(fail, "Failed to rebuild Device with UDN %s" % (udn, ))
+        delay = self._backoff.failed(udn, category)
+        log.msg('Keeping device %s for now, and refreshing it again in %d '
+                'seconds at the earliest, because %s' %
+                (mgr.device, delay, self._failure_message(fail)), ll=2)
+        mgr.rebuild_after = self._clock.seconds() + delay
+
+    def _failure_category(self, fail):
+        """Return the ignore list category of a build failure."""
+        if fail.check(error.Error):
+            return HTTP_ERROR
+        elif fail.check(*NETWORK_ERRORS):
+            return NETWORK_ERROR
+        return BUILD_ERROR
+
+    def _failure_message(self, fail):
+        if hasattr(fail, 'url'):
+            return "%s when fetching %s" % (str(fail.value), fail.url)
+        return str(fail.value)
 
     def _send_soap_message(self, device, url, msg, async=False, deferred=None):
         """Send a SOAP message and do error handling."""
@@ -201,32 +451,55 @@ class DeviceDiscoveryService(MultiService):
     def _device_error(self, fail, udn):
         """Handle error that occurred when building a device."""
         if not fail.check(defer.CancelledError):
-            del self._builders[udn]
+            self._builders.pop(udn, None)
             if fail.check(DeviceRejectedError):
                 device = fail.value.device
                 log.msg('Adding device %s to ignore list, because %s' %
                         (device, fail.getErrorMessage()), ll=2)
-                self._ignored.append(udn)
-            elif fail.check(error.Error):
-                if hasattr(fail, 'url'):
-                    msg = "%s when fetching %s" % (str(fail.value), fail.url)
-                else:
-                    msg = str(fail.value)
-                log.msg('Adding UDN %s to ignore list, because %s' % (udn, msg), ll=2)
-                self._ignored.append(udn)
+                self._ignored.add(udn, REJECTED)
             else:
-                log.err(fail, "Failed to build Device with UDN %s" % (udn, ))
+                category = self._failure_category(fail)
+                if category == BUILD_ERROR:
+                    log.err(fail, "Failed to build Device with UDN %s" % (udn, ))
+                msg = self._failure_message(fail)
+                delay = self._backoff.failed(udn, category)
+                log.msg('Ignoring UDN %s for %d seconds, because %s' %
+                        (udn, delay, msg), ll=2)
+                self._ignored.add(udn, category, delay)
 
     def _device_finished(self, device, umessage):
         """Handle completion of device building."""
-        mgr = DeviceManager(device, self._device_expired)
-        self._devices[device.UDN] = mgr
+        udn = umessage.get_udn()
+        self._builders.pop(udn, None)
+        self._backoff.succeeded(udn)
+        if udn != device.UDN:
+            # announced by an embedded device, whose announcements renew the
+            # root device from now on
+            self._roots[udn] = device.UDN
+        if device.UDN in self._devices:
+            # built from the same location as a device that is already known,
+            # e.g. for an embedded device
+            self._devices.get(device.UDN).touch(umessage)
+            return
+
+        mgr = DeviceManager(device, self._leases)
+        self._devices.add(mgr)
 
         # Start the device container timer
+        mgr.identify(umessage)
         mgr.touch(umessage)
 
-        # Publish the device
-        self.on_device_found(device)
+        # Publish the device, unless it disappears before the debounce time
+        if self.add_debounce:
+            mgr.set_timer(self._clock.callLater(self.add_debounce,
+                                                self._publish_device, mgr))
+        else:
+            self._publish_device(mgr)
+
+    def _publish_device(self, mgr):
+        mgr.set_timer(None)
+        mgr.published = True
+        self._report(FOUND, mgr.device)
 
     def _msearch_discover(self, msearch):
         """Send M-SEARCH device discovery requests."""
@@ -271,37 +544,85 @@ class UpnpService(Service):
 
 class DeviceManager(object):
 
-    def __init__(self, device, expire_func):
+    def __init__(self, device, leases):
         self.device = device
-        self._expire_timer = None
-        self._device_expired = expire_func
+        self.location = self.boot_id = self.config_id = None
+        self.published = False
+        self.suspended = False
+        # clock time before which a failed rebuild isn't retried
+        self.rebuild_after = 0
+        self._leases = leases
+        self._leased = False
+        self._timer = None
+
+    def identify(self, umessage):
+        """Remember the location, boot ID and configuration ID that the
+        device announced in the given message."""
+        self.location = umessage.get_location()
+        self.boot_id = umessage.get_boot_id()
+        self.config_id = umessage.get_config_id()
+
+    def has_changed(self, umessage):
+        """Return whether the given message indicates that the device has
+        rebooted or changed its description since it was identified.
+
+        The boot and configuration IDs are only compared if the message
+        contains them, since UPnP 1.0 devices don't send them.
+
+        """
+        boot_id = umessage.get_boot_id()
+        config_id = umessage.get_config_id()
+        return (umessage.get_location() != self.location or
+                (boot_id is not None and boot_id != self.boot_id) or
+                (config_id is not None and config_id != self.config_id))
+
+    def has_same_config(self, umessage):
+        """Return whether the device description is known to be unchanged
+        according to the configuration ID of the given message."""
+        return (self.config_id is not None and
+                umessage.get_config_id() == self.config_id)
 
     def touch(self, umessage):
-        """Start or reset the device timer based on UPnP HTTP headers.
+        """Start or renew the device lease based on UPnP HTTP headers.
 
-        If the expire timer hasn't been started before, it will be when this
-        method is called. Otherwise, the timer will be reset. The timer time
-        is taken from the "max-age" directive of the "CACHE-CONTROL" header.
+        The lease time is taken from the "max-age" directive of the
+        "CACHE-CONTROL" header. The lease is held by the device UDN, even if
+        the message was sent by one of its embedded devices.
 
         Arguments:
-        headers -- dictionary of UPnP HTTP headers
+        umessage -- UpnpMessage from the device
 
         """
         seconds = get_max_age(umessage.headers) # TODO
         if seconds:
-            udn = umessage.get_udn()
-            timer = self._expire_timer
-            if timer and timer.active():
-                timer.reset(seconds)
-            else:
-                newtimer = reactor.callLater(seconds, self._device_expired,
-                                             udn)
-                self._expire_timer = newtimer
+            self._leases.renew(self.device.UDN, seconds)
+            self._leased = True
+
+    def set_timer(self, timer):
+        """Set the delayed call for the next state change of the device,
+        cancelling the current one if it is still pending."""
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = timer
+
+    def suspend(self, timer):
+        """Mark the device as suspended, with a delayed call that removes it
+        unless it is resumed."""
+        self.stop()
+        self.suspended = True
+        self._timer = timer
+
+    def resume(self):
+        """Mark a suspended device as present again."""
+        self.set_timer(None)
+        self.suspended = False
 
     def stop(self):
-        """Stop the device timer if it is running."""
-        if self._expire_timer and self._expire_timer.active():
-            self._expire_timer.cancel()
+        """Cancel the device lease and any pending delayed call."""
+        if self._leased:
+            self._leases.cancel(self.device.UDN)
+            self._leased = False
+        self.set_timer(None)
 
 
 class UpnpMessage(object):
@@ -338,3 +659,9 @@ class UpnpMessage(object):
     def get_location(self):
         return self.headers['LOCATION']
 
+    def get_boot_id(self):
+        return self.headers.get('BOOTID.UPNP.ORG')
+
+    def get_config_id(self):
+        return self.headers.get('CONFIGID.UPNP.ORG')
+
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from twisted.internet import reactor
+from twisted.python import log
+
+__all__ = [
+    'EventBus',
+    'DeviceEvent',
+    'FOUND',
+    'REMOVED',
+    'SUSPENDED',
+    'RESUMED',
+    'UPDATED',
+]
+
+# Kinds of device events
+FOUND = 'found'
+REMOVED = 'removed'
+SUSPENDED = 'suspended'
+RESUMED = 'resumed'
+UPDATED = 'updated'
+
+# Seconds that events are collected before they are delivered
+BATCH_DELAY = 0.1
+
+
+class DeviceEvent(object):
+    """Event about a device, delivered by an EventBus."""
+
+    __slots__ = ['kind', 'device']
+
+    def __init__(self, kind, device):
+        self.kind = kind
+        self.device = device
+
+    def __repr__(self):
+        return 'DeviceEvent(%s, %s)' % (self.kind, self.device)
+
+
+class Subscription(object):
+    """Event bus subscription, returned by EventBus.subscribe."""
+
+    __slots__ = ['callback', 'kinds', 'filter']
+
+    def __init__(self, callback, kinds, filter_):
+        self.callback = callback
+        self.kinds = frozenset(kinds) if kinds else None
+        self.filter = filter_
+
+    def accepts(self, event):
+        if self.kinds is not None and event.kind not in self.kinds:
+            return False
+        return self.filter is None or self.filter(event.device)
+
+
+class EventBus(object):
+    """Bus that delivers device events to subscribers in batches.
+
+    Published events are queued, and delivered from a later reactor call, so
+    that subscribers don't run in the code path that published them. Events
+    published in quick succession, e.g. for all devices found at startup,
+    are delivered together: each subscriber is called once per batch, with
+    the list of events that it is interested in.
+
+    """
+
+    def __init__(self, batch_delay=BATCH_DELAY, clock=None):
+        """Initialize the event bus.
+
+        Arguments:
+        batch_delay -- number of seconds that events are collected before
+                       they are delivered
+        clock       -- object that provides IReactorTime, defaults to the
+                       reactor
+
+        """
+        self.batch_delay = batch_delay
+        self._clock = clock or reactor
+        self._subscriptions = []
+        self._queue = []
+        self._call = None
+
+    def subscribe(self, callback, kinds=None, filter_=None):
+        """Subscribe to device events.
+
+        Arguments:
+        callback -- callable that receives a list of DeviceEvent objects
+        kinds    -- optional list of event kinds of interest; all kinds are
+                    delivered if not given
+        filter_  -- optional callable that receives a device and returns
+                    whether events about it should be delivered
+
+        Return an object that can be passed to unsubscribe.
+
+        """
+        sub = Subscription(callback, kinds, filter_)
+        self._subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """Cancel a subscription returned by subscribe. Queued events are not
+        delivered to it."""
+        self._subscriptions.remove(sub)
+
+    def publish(self, kind, device):
+        """Queue an event for delivery with the next batch."""
+        self._queue.append(DeviceEvent(kind, device))
+        if self._call is None:
+            self._call = self._clock.callLater(self.batch_delay, self.flush)
+
+    def flush(self):
+        """Deliver all queued events now."""
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        events, self._queue = self._queue, []
+        if not events:
+            return
+        for sub in self._subscriptions[:]:
+            try:
+                accepted = [e for e in events if sub.accepts(e)]
+                if accepted:
+                    sub.callback(accepted)
+            except:
+                log.err(None, 'Event subscriber %r failed' % (sub.callback, ))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+from collections import OrderedDict
+from twisted.internet import reactor
+from twisted.python import log
+
+__all__ = [
+    'IgnoreList',
+    'REJECTED',
+    'HTTP_ERROR',
+    'NETWORK_ERROR',
+    'BUILD_ERROR',
+]
+
+# Categories of ignored devices
+REJECTED = 'rejected'
+HTTP_ERROR = 'http-error'
+NETWORK_ERROR = 'network-error'
+BUILD_ERROR = 'build-error'
+
+# Default number of seconds that a device is ignored, per category
+DEFAULT_TTLS = {
+    REJECTED: 24 * 3600,
+    HTTP_ERROR: 600,
+    NETWORK_ERROR: 600,
+    BUILD_ERROR: 3600,
+}
+
+# Default maximum number of ignored devices
+DEFAULT_MAX_SIZE = 1000
+
+
+class IgnoreList(object):
+    """Bounded collection of UDNs of devices that should be ignored.
+
+    Each entry has a category, which determines how long the entry is kept.
+    When the list is full, the least recently used entry is evicted. The list
+    can optionally be saved to and loaded from a file, so that devices that
+    were rejected before a restart don't have to be fetched again.
+
+    """
+
+    def __init__(self, ttls=None, max_size=DEFAULT_MAX_SIZE, path=None,
+                 clock=None):
+        """Initialize the ignore list.
+
+        Arguments:
+        ttls     -- dictionary of category to number of seconds that entries
+                    of that category are kept, defaults to DEFAULT_TTLS
+        max_size -- maximum number of entries
+        path     -- optional path of the file used by load and save
+        clock    -- object with a seconds() method, defaults to the reactor
+
+        """
+        self.ttls = ttls or DEFAULT_TTLS
+        self.max_size = max_size
+        self.path = path
+        self._clock = clock or reactor
+        self._entries = OrderedDict()
+
+    def add(self, udn, category, ttl=None):
+        """Ignore the device with the given UDN for the given number of
+        seconds, or for the time determined by the category if not given."""
+        self._entries.pop(udn, None)
+        if ttl is None:
+            ttl = self.ttls[category]
+        expires = self._clock.seconds() + ttl
+        self._entries[udn] = (category, expires)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def remove(self, udn):
+        """Stop ignoring the device with the given UDN."""
+        self._entries.pop(udn, None)
+
+    def category(self, udn):
+        """Return the category of the device with the given UDN, or None if
+        the device isn't ignored."""
+        entry = self._entries.get(udn)
+        if entry is None:
+            return None
+        if entry[1] <= self._clock.seconds():
+            del self._entries[udn]
+            return None
+        # mark as recently used
+        del self._entries[udn]
+        self._entries[udn] = entry
+        return entry[0]
+
+    def __contains__(self, udn):
+        return self.category(udn) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Load entries from the file given by the path attribute, if any.
+        Expired entries and entries of unknown categories are skipped."""
+        if not self.path:
+            return
+        try:
+            with open(self.path) as fd:
+                entries = json.load(fd)
+        except IOError:
+            # no file yet
+            return
+        except ValueError:
+            log.err(None, 'Failed to load ignore list from %s' % (self.path, ))
+            return
+        now = self._clock.seconds()
+        for udn, (category, expires) in sorted(entries.items(),
+                                               key=lambda e: e[1][1]):
+            if category in self.ttls and expires > now:
+                self._entries[udn] = (category, expires)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Save unexpired entries to the file given by the path attribute, if
+        any."""
+        if not self.path:
+            return
+        now = self._clock.seconds()
+        entries = dict((udn, entry) for udn, entry in self._entries.items()
+                       if entry[1] > now)
+        try:
+            with open(self.path, 'w') as fd:
+                json.dump(entries, fd)
+        except IOError:
+            log.err(None, 'Failed to save ignore list to %s' % (self.path, ))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Optional scaling of photos to a size that media renderers can show
+quickly. Requires the Python Imaging Library (PIL, or its fork Pillow); if it
+is not installed, AVAILABLE is False and photos are sent unchanged."""
+
+import multiprocessing
+import os
+import signal
+from collections import OrderedDict
+from cStringIO import StringIO
+from photostore import PhotoStoreFullError
+from twisted.application.service import Service
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+__all__ = [
+    'AVAILABLE',
+    'PhotoScaler',
+    'ScaleError',
+    'scale_photo',
+    'target_from_protocol_info',
+]
+
+AVAILABLE = Image is not None
+
+# Default number of worker processes
+DEFAULT_PROCESSES = 2
+
+# Max resolutions of the DLNA JPEG media format profiles for full images
+DLNA_JPEG_PROFILES = {
+    'JPEG_SM': (640, 480),
+    'JPEG_MED': (1024, 768),
+    'JPEG_LRG': (4096, 4096),
+}
+
+# JPEG qualities to try, in order, until the result is small enough
+QUALITIES = (85, 75, 60, 45)
+
+# Number of photos to remember as not needing scaling
+UNSCALED_CACHE_SIZE = 256
+
+# Number of scaled photos that the scaler keeps in the store, so that photos
+# that are shown again, e.g. in a looping slideshow, aren't scaled again
+SCALED_CACHE_SIZE = 16
+
+CT_JPEG = 'image/jpeg'
+
+
+def scale_photo(width, height, max_bytes, data=None, path=None):
+    """Scale a photo to fit within the given resolution and size, and return
+    the JPEG data, or return None if the photo already fits.
+
+    This function runs in a worker process.
+
+    Arguments:
+    width     -- max width of the scaled photo
+    height    -- max height of the scaled photo
+    max_bytes -- max size of the scaled photo, 0 for no limit
+    data      -- the photo data, if path is not given
+    path      -- path of a file that contains the photo data
+
+    """
+    if path is not None:
+        image = Image.open(path)
+        size = os.path.getsize(path)
+    else:
+        image = Image.open(StringIO(data))
+        size = len(data)
+    fits = image.size[0] <= width and image.size[1] <= height
+    if fits and image.format == 'JPEG' and (not max_bytes or
+                                            size <= max_bytes):
+        return None
+
+    # let the JPEG decoder skip detail that would be scaled away anyway,
+    # which makes decoding of large photos many times faster
+    image.draft('RGB', (width, height))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((width, height), Image.ANTIALIAS)
+    for quality in QUALITIES:
+        out = StringIO()
+        image.save(out, 'JPEG', quality=quality)
+        result = out.getvalue()
+        if not max_bytes or len(result) <= max_bytes:
+            break
+    return result
+
+
+class ScaleError(Exception):
+    """Represent an error that occurred in a worker process."""
+    pass
+
+
+def _call(func, args):
+    # run in a worker process; Python 2 pools have no error callback, so
+    # errors are returned as results
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, '%s: %s' % (e.__class__.__name__, e)
+
+
+def _init_worker():
+    # the worker processes are forked from the reactor process, and would
+    # otherwise inherit the signal handlers of the reactor, which don't work
+    # without a running reactor, so the pool couldn't terminate them
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def target_from_protocol_info(sink, target):
+    """Return the photo target of a media renderer, given its sink protocol
+    info (as returned by ConnectionManager::GetProtocolInfo) and the
+    configured target.
+
+    The resolution of the configured target is capped by the largest DLNA
+    JPEG profile that the renderer supports. If the renderer doesn't list any
+    JPEG profile, the configured target is returned.
+
+    Arguments:
+    sink   -- comma-separated list of protocol info strings
+    target -- tuple of (max width, max height, max size in bytes)
+
+    """
+    best = None
+    for entry in sink.split(','):
+        parts = entry.strip().split(':')
+        if len(parts) != 4 or parts[2] != CT_JPEG:
+            continue
+        for param in parts[3].split(';'):
+            name, _, value = param.partition('=')
+            if name == 'DLNA.ORG_PN' and value in DLNA_JPEG_PROFILES:
+                res = DLNA_JPEG_PROFILES[value]
+                if best is None or res[0] * res[1] > best[0] * best[1]:
+                    best = res
+    if best is None:
+        return target
+    width, height, max_bytes = target
+    return (min(width, best[0]), min(height, best[1]), max_bytes)
+
+
+class PhotoScaler(Service):
+    """Service that scales photos in a PhotoStore in a pool of worker
+    processes, so that neither decoding nor encoding blocks the reactor.
+
+    Scaled photos are added to the store under a name derived from the name
+    of the original photo and the target, so with photos named by their
+    contents, a photo is only scaled once per target for as long as the store
+    keeps the result. The scaler holds on to the most recently used scaled
+    photos itself, so that they are kept after they have been unpublished.
+    Concurrent requests for the same scaled photo share one job, and photos
+    that don't need scaling are remembered as such.
+
+    """
+
+    def __init__(self, store, processes=DEFAULT_PROCESSES, run=None,
+                 scale_func=None):
+        """Initialize the photo scaler.
+
+        Arguments:
+        store      -- the PhotoStore that contains the photos
+        processes  -- number of worker processes
+        run        -- callable that runs a function with arguments and
+                      returns a Deferred, for testing
+        scale_func -- the scaling function, for testing
+
+        """
+        self.store = store
+        self.processes = processes
+        self._pool = None
+        self._run = run or self._run_in_pool
+        self._scale_func = scale_func or scale_photo
+        # waiting Deferreds, by the name of the scaled photo
+        self._pending = {}
+        self._unscaled = OrderedDict()
+        # scaled photos that the scaler holds on to, least recently used first
+        self._scaled_names = OrderedDict()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        for scaled in self._scaled_names:
+            self.store.remove(scaled)
+        self._scaled_names.clear()
+
+    def _run_in_pool(self, func, *args):
+        # the pool is created when needed, so that no processes are started
+        # unless photos are shown
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, _init_worker)
+        d = defer.Deferred()
+        def done((ok, result)):
+            # called in a thread of the pool
+            if ok:
+                reactor.callFromThread(d.callback, result)
+            else:
+                reactor.callFromThread(d.errback, ScaleError(result))
+        self._pool.apply_async(_call, (func, args), callback=done)
+        return d
+
+    def scale(self, name, target):
+        """Scale a photo in the store to a target, and return a Deferred that
+        fires with the name of the photo to show.
+
+        If the photo is scaled, the scaled photo has been added to the store
+        on behalf of the caller, who should remove it when it is no longer
+        needed. If the photo doesn't need scaling, or if scaling fails, the
+        Deferred fires with the name of the original photo.
+
+        Arguments:
+        name   -- name of the original photo
+        target -- tuple of (max width, max height, max size in bytes)
+
+        """
+        width, height, max_bytes = target
+        scaled = '%s_%dx%d_%d.jpg' % (os.path.splitext(name)[0], width,
+                                      height, max_bytes)
+        if scaled in self._unscaled:
+            return defer.succeed(name)
+        if self.store.acquire(scaled) is not None:
+            if scaled in self._scaled_names:
+                # mark it as recently used
+                del self._scaled_names[scaled]
+                self._scaled_names[scaled] = True
+            return defer.succeed(scaled)
+        d = defer.Deferred()
+        if scaled in self._pending:
+            self._pending[scaled].append(d)
+            return d
+        photo = self.store.get(name)
+        if photo is None:
+            return defer.succeed(name)
+        self._pending[scaled] = [d]
+        job = self._run(self._scale_func, width, height, max_bytes,
+                        photo.data, photo.path)
+        job.addBoth(self._scaled, name, scaled, photo.size)
+        return d
+
+    def _scaled(self, result, name, scaled, size):
+        waiting = self._pending.pop(scaled)
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Failed to scale photo %s' % (name, ))
+            scaled = name
+        elif result is None:
+            self._unscaled[scaled] = True
+            if len(self._unscaled) > UNSCALED_CACHE_SIZE:
+                self._unscaled.popitem(last=False)
+            scaled = name
+        else:
+            log.msg('Scaled photo %s from %d to %d bytes' %
+                    (name, size, len(result)), ll=2)
+            try:
+                for _ in waiting:
+                    self.store.add(scaled, CT_JPEG, result)
+            except PhotoStoreFullError, e:
+                log.msg('Showing photo %s unscaled: %s' % (name, e), ll=1)
+                scaled = name
+            else:
+                self._hold(scaled)
+        for d in waiting:
+            d.callback(scaled)
+
+    def _hold(self, scaled):
+        self.store.acquire(scaled)
+        self._scaled_names[scaled] = True
+        if len(self._scaled_names) > SCALED_CACHE_SIZE:
+            oldest, _ = self._scaled_names.popitem(last=False)
+            self.store.remove(oldest)
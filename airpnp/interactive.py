@@ -35,15 +35,21 @@ class InteractiveWeb(TCPServer):
     def __init__(self, port, ip_addr):
         self.root = self.create_site()
         self.port = port
+        self._names = {}
 
         TCPServer.__init__(self, port, server.Site(self.root), 100, interface=ip_addr)
 
     def add_device(self, device):
+        # the name may have changed if the device has been updated
+        self.remove_device(device)
         devroot = self.create_device_site(device)
+        self._names[device.UDN] = str(device)
         self.root.putChild(str(device), devroot)
 
     def remove_device(self, device):
-        self.root.delEntity(str(device))
+        name = self._names.pop(device.UDN, None)
+        if name in self.root.children:
+            self.root.delEntity(name)
 
     def create_site(self):
         root = resource.Resource()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import math
+from twisted.application.service import Service
+from twisted.internet import reactor, task
+
+__all__ = [
+    'LeaseManager',
+]
+
+# Seconds covered by each bucket, which is also the tick interval
+DEFAULT_RESOLUTION = 1.0
+
+
+class LeaseManager(Service):
+    """Service that keeps track of when leases, e.g. device announcements,
+    expire.
+
+    Rather than scheduling one reactor call per lease, expiry times are
+    rounded up to a coarse resolution and leases are kept in buckets, one per
+    resolution step. Renewing a lease moves it between two buckets, which is
+    a constant-time operation. A single periodic tick collects all leases in
+    the buckets that have passed, and reports them in one batch. A lease may
+    thus expire up to one resolution step later than requested.
+
+    """
+
+    def __init__(self, expire_func, resolution=DEFAULT_RESOLUTION,
+                 clock=None):
+        """Initialize the lease manager.
+
+        Arguments:
+        expire_func -- callable that receives a list of keys whose leases
+                       have expired
+        resolution  -- number of seconds covered by each bucket
+        clock       -- object that provides IReactorTime, defaults to the
+                       reactor
+
+        """
+        self.resolution = float(resolution)
+        self._expire = expire_func
+        self._clock = clock or reactor
+        self._buckets = {}
+        self._leases = {}
+        self._next_index = self._passed_index()
+        self._ticker = None
+
+    def _index(self, when):
+        # index of the first bucket that ends at or after the given time
+        return int(math.ceil(when / self.resolution))
+
+    def _passed_index(self):
+        # index of the last bucket that has ended
+        return int(math.floor(self._clock.seconds() / self.resolution))
+
+    def renew(self, key, seconds):
+        """Start or renew the lease for the given key, so that it expires the
+        given number of seconds from now."""
+        index = self._index(self._clock.seconds() + seconds)
+        old = self._leases.get(key)
+        if old == index:
+            return
+        if old is not None:
+            self._remove(key, old)
+        self._leases[key] = index
+        self._buckets.setdefault(index, set()).add(key)
+
+    def cancel(self, key):
+        """Cancel the lease for the given key, if there is one."""
+        index = self._leases.pop(key, None)
+        if index is not None:
+            self._remove(key, index)
+
+    def _remove(self, key, index):
+        bucket = self._buckets[index]
+        bucket.discard(key)
+        if not bucket:
+            del self._buckets[index]
+
+    def __contains__(self, key):
+        return key in self._leases
+
+    def __len__(self):
+        return len(self._leases)
+
+    def tick(self):
+        """Expire all leases whose buckets have passed, and report them to the
+        expire function. Called periodically while the service is running."""
+        current = self._passed_index()
+        if current - self._next_index > len(self._buckets):
+            # the clock has jumped; visit the existing buckets instead
+            indexes = sorted(i for i in self._buckets if i <= current)
+        else:
+            indexes = xrange(self._next_index, current + 1)
+        self._next_index = current + 1
+
+        expired = []
+        for index in indexes:
+            bucket = self._buckets.pop(index, None)
+            if bucket:
+                for key in bucket:
+                    del self._leases[key]
+                expired.extend(bucket)
+        if expired:
+            self._expire(expired)
+
+    def startService(self):
+        Service.startService(self)
+        self._ticker = task.LoopingCall(self.tick)
+        self._ticker.clock = self._clock
+        self._ticker.start(self.resolution, now=False)
+
+    def stopService(self):
+        if self._ticker and self._ticker.running:
+            self._ticker.stop()
+        self._ticker = None
+        Service.stopService(self)
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from twisted.internet import defer, threads
+from twisted.python import log
+
+__all__ = [
+    'PhotoStore',
+    'PhotoStoreFullError',
+    'Photo',
+    'photo_digest',
+]
+
+# Default number of bytes of photo data that may be kept in memory
+DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+
+# Default number of bytes of photo data that may be kept on disk
+DEFAULT_DISK_BUDGET = 256 * 1024 * 1024
+
+# Chunk size used when copying photo data to a file
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class PhotoStoreFullError(Exception):
+    """Raised by a PhotoStore when a photo doesn't fit within the budgets,
+    since the photos that fill them are all in use."""
+
+
+def photo_digest(source):
+    """Return a hex digest of the contents of a photo, given as a string or as
+    a seekable file-like object (which is read in chunks)."""
+    if isinstance(source, basestring):
+        return hashlib.sha1(source).hexdigest()
+    digest = hashlib.sha1()
+    source.seek(0, 0)
+    for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), ''):
+        digest.update(chunk)
+    source.seek(0, 0)
+    return digest.hexdigest()
+
+
+def read_photo(source, directory, spill_size):
+    """Read a photo, given as a string or as a seekable file-like object, and
+    return a tuple of (digest, data, path).
+
+    A photo given as a file-like object that is larger than the spill size is
+    copied to a new file in the given directory while it is hashed, so that it
+    is never read into memory as a whole. Then data is None, and otherwise
+    path is None. This is called in a worker thread, so it must not touch the
+    PhotoStore.
+
+    """
+    if isinstance(source, basestring):
+        return photo_digest(source), source, None
+    source.seek(0, 2)
+    size = source.tell()
+    source.seek(0, 0)
+    if size <= spill_size:
+        data = source.read()
+        return photo_digest(data), data, None
+    digest = hashlib.sha1()
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), ''):
+                digest.update(chunk)
+                fobj.write(chunk)
+    except:
+        os.remove(path)
+        raise
+    return digest.hexdigest(), None, path
+
+
+def write_photo(data, directory):
+    """Write photo data to a new file in the given directory and return the
+    path of the file. This is called in a worker thread."""
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as fobj:
+        fobj.write(data)
+    return path
+
+
+class Photo(object):
+    """A photo in a PhotoStore, kept either in memory or in a file."""
+
+    __slots__ = ['name', 'content_type', 'size', 'data', 'path', 'refs',
+                 'evictable', 'spilled', 'mtime', '_map']
+
+    def __init__(self, name, content_type, size, data=None, path=None,
+                 evictable=False):
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+        self.data = data
+        self.path = path
+        # number of times the photo has been added but not removed
+        self.refs = 1
+        # whether the photo may be evicted to stay within the disk budget
+        self.evictable = evictable
+        # whether the photo counts against the disk budget; the data of a
+        # photo stays in memory until its file has been written
+        self.spilled = path is not None
+        # when the photo was added, in seconds since the epoch
+        self.mtime = time.time()
+        self._map = None
+
+    def in_memory(self):
+        """Return whether the photo data is kept in memory."""
+        return self.data is not None
+
+    def buffer(self):
+        """Return the photo data as a string or, for a photo in a file, as a
+        read-only memory map of the file.
+
+        The memory map is created once and shared by all readers. It stays
+        valid for as long as it is referenced, even if the photo is removed
+        from the store in the meantime.
+
+        """
+        if self.data is not None:
+            return self.data
+        if self._map is None:
+            if self.size == 0:
+                return ''
+            fd = open(self.path, 'rb')
+            try:
+                self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fd.close()
+        return self._map
+
+
+class PhotoStore(object):
+    """Store for published photos, shared by all media renderers.
+
+    Photos are kept in memory as long as the total size of all photos in
+    memory is within the memory budget. When it isn't, the least recently used
+    photos are spilled to files in a private temporary directory. Photos that
+    are larger than a quarter of the memory budget are spilled right away, and
+    are copied in chunks if given as a file-like object (such as the temporary
+    file that Twisted uses for large uploads) so that they are never read into
+    memory as a whole. Hashing and file writes are done in worker threads, if
+    the store is threaded, and a photo is served from memory until its file
+    has been written.
+
+    When a new photo doesn't fit within the disk budget, the least recently
+    used photos that were added as evictable, such as cached data that can be
+    fetched again, are evicted. Other photos are in use until they are
+    removed, e.g. shown or queued by a media renderer, so they are never
+    evicted. If there is no room for the new photo once only such photos
+    remain, it is rejected with a PhotoStoreFullError.
+
+    Photos are meant to be named by their contents (see add_by_contents), so
+    that a photo that is added again, e.g. for another media renderer, is
+    shared rather than stored twice. The store counts how many times each
+    photo has been added, and only discards a photo when it has been removed
+    as many times.
+
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 disk_budget=DEFAULT_DISK_BUDGET, directory=None,
+                 threaded=False):
+        """Initialize the photo store.
+
+        Arguments:
+        memory_budget -- max number of bytes of photo data kept in memory
+        disk_budget   -- max number of bytes of photo data kept on disk
+        directory     -- directory for spilled photos, or None to create a
+                         temporary directory when needed
+        threaded      -- if True, photos are hashed and written to files in
+                         worker threads; otherwise that is done inline
+
+        """
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.spill_size = memory_budget // 4
+        self.memory_used = 0
+        self.disk_used = 0
+        self.threaded = threaded
+        self._directory = directory
+        self._own_directory = False
+        # least recently used first
+        self._photos = OrderedDict()
+
+    def add(self, name, content_type, data, evictable=False):
+        """Add a photo to the store and return it. If there already is a photo
+        with the same name, that photo is returned.
+
+        Raise a PhotoStoreFullError if there is no room for the photo.
+
+        Arguments:
+        name         -- name of the photo
+        content_type -- MIME type of the photo
+        data         -- the photo data, as a string
+        evictable    -- if True, the photo may be evicted before it is
+                        removed, to stay within the disk budget
+
+        """
+        photo = self.acquire(name)
+        if photo is not None:
+            return photo
+        self._make_room(name, len(data))
+        photo = Photo(name, content_type, len(data), data=data,
+                      evictable=evictable)
+        self.memory_used += photo.size
+        self._photos[name] = photo
+        if photo.size > self.spill_size:
+            self._spill(photo)
+        self._enforce_budgets()
+        return photo
+
+    def add_by_contents(self, content_type, source, ext='', evictable=False):
+        """Add a photo to the store, named by the digest of its contents and
+        the given extension.
+
+        Return a Deferred that fires with the photo when it has been read, or
+        fails with a PhotoStoreFullError if there is no room for it. The
+        source must not be closed before then.
+
+        Arguments:
+        content_type -- MIME type of the photo
+        source       -- the photo data, as a string or as a seekable
+                        file-like object
+        ext          -- extension of the name of the photo
+        evictable    -- as for add
+
+        """
+        directory = None
+        if not isinstance(source, basestring):
+            directory = self._ensure_directory()
+        d = self._run(read_photo, source, directory, self.spill_size)
+        d.addCallback(self._photo_read, content_type, ext, evictable)
+        return d
+
+    def _photo_read(self, result, content_type, ext, evictable):
+        digest, data, path = result
+        name = digest + ext
+        if path is None:
+            return self.add(name, content_type, data, evictable)
+        photo = self.acquire(name)
+        if photo is not None:
+            self._remove_file(path)
+            return photo
+        size = os.path.getsize(path)
+        try:
+            self._make_room(name, size)
+        except PhotoStoreFullError:
+            self._remove_file(path)
+            raise
+        photo = Photo(name, content_type, size, path=path,
+                      evictable=evictable)
+        self.disk_used += size
+        self._photos[name] = photo
+        return photo
+
+    def get(self, name):
+        """Return the photo with the given name, or None if there is no such
+        photo, and mark it as recently used."""
+        photo = self._photos.pop(name, None)
+        if photo is not None:
+            self._photos[name] = photo
+        return photo
+
+    def acquire(self, name):
+        """Return the photo with the given name and count it as added once
+        more, or return None if there is no such photo."""
+        photo = self.get(name)
+        if photo is not None:
+            photo.refs += 1
+        return photo
+
+    def remove(self, name):
+        """Remove the photo with the given name, if it is in the store. The
+        photo is discarded when it has been removed as many times as it has
+        been added."""
+        photo = self._photos.get(name)
+        if photo is not None:
+            photo.refs -= 1
+            if photo.refs <= 0:
+                del self._photos[name]
+                self._discard(photo)
+
+    def clear(self):
+        """Remove all photos, and the temporary directory if one has been
+        created."""
+        for photo in self._photos.values():
+            self._discard(photo)
+        self._photos.clear()
+        if self._own_directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+            self._own_directory = False
+
+    def __contains__(self, name):
+        return name in self._photos
+
+    def __len__(self):
+        return len(self._photos)
+
+    def _run(self, func, *args):
+        if self.threaded:
+            return threads.deferToThread(func, *args)
+        return defer.maybeDeferred(func, *args)
+
+    def _ensure_directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='airpnp-photos-')
+            self._own_directory = True
+        return self._directory
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            log.msg('Failed to remove spilled photo %s: %s' % (path, e), ll=2)
+
+    def _discard(self, photo):
+        if photo.spilled:
+            self.disk_used -= photo.size
+            # readers keep their own references to the map
+            photo._map = None
+            if photo.path is not None:
+                self._remove_file(photo.path)
+                photo.path = None
+        else:
+            self.memory_used -= photo.size
+        photo.data = None
+
+    def _spill(self, photo):
+        photo.spilled = True
+        self.memory_used -= photo.size
+        self.disk_used += photo.size
+        d = self._run(write_photo, photo.data, self._ensure_directory())
+        d.addCallbacks(self._spilled, self._spill_failed,
+                       callbackArgs=(photo, ), errbackArgs=(photo, ))
+
+    def _spilled(self, path, photo):
+        if self._photos.get(photo.name) is not photo:
+            # discarded while the file was being written
+            self._remove_file(path)
+            return
+        photo.path = path
+        photo.data = None
+
+    def _spill_failed(self, fail, photo):
+        log.err(fail, 'Failed to spill photo %s' % (photo.name, ))
+        if self._photos.get(photo.name) is photo:
+            # keep it in memory instead
+            photo.spilled = False
+            self.disk_used -= photo.size
+            self.memory_used += photo.size
+
+    def _missing_room(self, size):
+        # the number of bytes that must be freed on disk for a new photo,
+        # which goes to disk if it is large, or makes other photos go there
+        if size > self.spill_size:
+            needed = size
+        else:
+            needed = max(0, self.memory_used + size - self.memory_budget)
+        return self.disk_used + needed - self.disk_budget
+
+    def _make_room(self, name, size):
+        if self._missing_room(size) > 0:
+            for key, photo in self._photos.items():
+                if photo.evictable:
+                    log.msg('Evicting photo %s to stay within the disk '
+                            'budget' % (key, ), ll=2)
+                    del self._photos[key]
+                    self._discard(photo)
+                    if self._missing_room(size) <= 0:
+                        break
+        if self._missing_room(size) > 0:
+            raise PhotoStoreFullError('No room for photo %s (%d bytes), '
+                                      'since all photos are in use' %
+                                      (name, size))
+
+    def _enforce_budgets(self):
+        if self.memory_used > self.memory_budget:
+            for photo in self._photos.values():
+                if photo.spilled or \
+                        self.disk_used + photo.size > self.disk_budget:
+                    continue
+                self._spill(photo)
+                if self.memory_used <= self.memory_budget:
+                    break
@@ -26,11 +26,20 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from struct import unpack
+from struct import pack, unpack_from, error as struct_error
 from datetime import datetime, tzinfo, timedelta
+from base64 import b64encode, b64decode
+from cStringIO import StringIO
+from xml.sax.saxutils import escape as xml_escape
+from xmlbackend import ET
 
 __all__ = [
     'read_binary_plist',
+    'open_binary_plist',
+    'read_xml_plist',
+    'open_xml_plist',
+    'write_binary_plist',
+    'write_xml_plist',
     'PListFormatError',
     'PListUnhandledError',
 ]
@@ -97,6 +106,13 @@ MARKER_SET = 0XC0
 MARKER_DICT = 0XD0
 
 
+def _plist_data(fd):
+    if hasattr(fd, 'read'):
+        fd.seek(0, 0)
+        return fd.read()
+    return fd
+
+
 def read_binary_plist(fd):
     """Read an object from a binary plist.
 
@@ -108,15 +124,57 @@ def read_binary_plist(fd):
     be fully understood.
 
     Arguments:
-    fd -- a file-like object that is seekable
+    fd -- a file-like object that is seekable, or a string, buffer or
+          memoryview that contains the plist data
 
     """
-    r = BinaryPListReader(fd)
+    r = BinaryPListReader(_plist_data(fd))
     return r.read()
 
 
+def open_binary_plist(fd):
+    """Open a binary plist for lazy reading.
+
+    Only the trailer and the offset table are read up front. Objects are
+    decoded when they are accessed through the returned PListView, so
+    that the parts of a large plist that aren't needed are never decoded.
+
+    Arguments:
+    fd -- same as for read_binary_plist
+
+    """
+    return PListView(BinaryPListReader(_plist_data(fd)))
+
+
+def read_xml_plist(fd):
+    """Read an object from an XML plist.
+
+    The values are decoded into the same types as by read_binary_plist.
+
+    Raise a PListFormatError if the input data is not a valid XML plist.
+
+    Arguments:
+    fd -- a file-like object, or a string that contains the plist data
+
+    """
+    return XMLPListReader(fd).read()
+
+
+def open_xml_plist(fd):
+    """Open an XML plist for reading through a PListView.
+
+    The document is parsed incrementally, but containers are only assembled
+    into dictionaries and lists when they are accessed through the view.
+
+    Arguments:
+    fd -- same as for read_xml_plist
+
+    """
+    return PListView(XMLPListReader(fd))
+
+
 class PListFormatError(Exception):
-    """Represent a binary plist format error."""
+    """Represent a plist format error."""
     pass
 
 
@@ -125,164 +183,632 @@ class PListUnhandledError(Exception):
     pass
 
 
-class ObjectRef(object):
-    def __init__(self, index):
-        self.index = index
+# struct format characters for big-endian integers, by byte size; in format
+# version '00', 1, 2, and 4-byte integers have to be interpreted as unsigned,
+# whereas 8-byte integers are signed (and 16-byte when available). negative
+# 1, 2, 4-byte integers are always emitted as 8 bytes in format '00'
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'q'}
+
 
-    def resolve(self, lst):
-        return lst[self.index]
+def _format_errors(func):
+    """Decorator that turns low-level decoding errors into PListFormatError."""
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (struct_error, IndexError, TypeError), e:
+            raise PListFormatError("Truncated or corrupt plist: %s" % (e, ))
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
 
 
 class BinaryPListReader(object):
+    """Reader that decodes a binary plist from a single buffer.
 
-    def __init__(self, fd):
-        self._fd = fd
+    All values are unpacked directly from the buffer, and lists of integers
+    (the offset table and the object references of collections) are unpacked
+    in one call each. Objects are decoded on demand, starting from the top
+    level object, and each object is decoded only once.
 
-    def read(self):
-        fd = self._fd
+    """
 
-        # start from the beginning to check the signature
-        fd.seek(0, 0)
-        buf = fd.read(7)
+    def __init__(self, data):
+        self._data = data
+        self._is_view = isinstance(data, memoryview)
+        self._objects = {}
+        self._dicts = {}
+        self._read_trailer()
+
+    def _bytes(self, start, end):
+        chunk = self._data[start:end]
+        return chunk.tobytes() if self._is_view else chunk
+
+    @_format_errors
+    def _read_trailer(self):
+        data = self._data
 
         # verify the signature; the first version digit is always 0
-        if buf != "bplist0":
-            raise PListFormatError("Invalid signature: %s" % (buf, ))
+        sig = self._bytes(0, 7)
+        if sig != "bplist0":
+            raise PListFormatError("Invalid signature: %s" % (sig, ))
 
-        # seek to and read the trailer (validation omitted for now)
-        fd.seek(-32, 2)
-        buf = fd.read(32)
+        if len(data) < 40:
+            raise PListFormatError("Truncated plist")
 
-        _, offsetIntSize, self.objectRefSize, numObjects, topObject, \
-                offsetTableOffset = unpack(">5x3B3Q", buf)
+        # read the trailer (validation omitted for now)
+        offsetIntSize, self.objectRefSize, numObjects, self.topObject, \
+                offsetTableOffset = unpack_from(">6x2B3Q", data,
+                                                len(data) - 32)
 
         # read the object offsets
-        fd.seek(offsetTableOffset, 0)
-        self._offsets = [self._read_sized_int(offsetIntSize) for _ in range(0, numObjects)]
-
-        # read the actual objects
-        objects = [self._read_object(offs) for offs in self._offsets]
-
-        # resolve lazy values (references to the object list)
-        self._resolve_objects(objects)
-
-        return objects[topObject]
-
-    def _resolve_objects(self, objects):
-        # all resolutions are in-place, to avoid breaking references to
-        # the outer objects!
-        for obj in objects:
-            if isinstance(obj, list):
-                for i in range(0, len(obj)):
-                    obj[i] = obj[i].resolve(objects)
-            if isinstance(obj, set):
-                temp = [item.resolve(objects) for item in obj]
-                obj.clear()
-                obj.update(temp)
-            if isinstance(obj, dict):
-                temp = {k.resolve(objects): v.resolve(objects) for k, v in obj.items()}
-                obj.clear()
-                obj.update(temp)
+        self._offsets = self._read_ints(offsetTableOffset, offsetIntSize,
+                                        numObjects)
 
-    def _read_object(self, offset=-1):
-        if offset >= 0:
-            self._fd.seek(offset)
+    def read(self):
+        """Decode and return the top level object."""
+        return self.object(self.topObject)
+
+    @_format_errors
+    def object(self, index):
+        """Decode and return the object with the given index, including all
+        objects that it refers to."""
+        return self._object(index)
+
+    def _object(self, index):
+        objects = self._objects
+        if index in objects:
+            return objects[index]
+        offset = self._offsets[index]
+        marker = ord(self._data[offset])
+        nb1 = marker & 0xf0
+        if nb1 not in (MARKER_ARRAY, MARKER_SET, MARKER_DICT):
+            obj = objects[index] = self._read_value(offset, marker)
+            return obj
+
+        # the empty collection is cached before it is filled, so that shared
+        # objects stay shared
+        if nb1 == MARKER_DICT:
+            obj = objects[index] = {}
+            items = self._dict_refs(index)
+            obj.update([(k, self._object(i)) for k, i in items.iteritems()])
+            return obj
+        count, pos = self._read_count(marker & 0x0f, offset + 1)
+        refs = self._read_ints(pos, self.objectRefSize, count)
+        if nb1 == MARKER_ARRAY:
+            obj = objects[index] = []
+            obj.extend([self._object(i) for i in refs])
         else:
-            offset = self._fd.tell()  # for the error message
-        marker = ord(self._fd.read(1))
+            obj = objects[index] = set()
+            obj.update([self._object(i) for i in refs])
+        return obj
+
+    @_format_errors
+    def kind(self, index):
+        """Return the marker type (high nibble) of the object with the given
+        index."""
+        return ord(self._data[self._offsets[index]]) & 0xf0
+
+    @_format_errors
+    def dict_refs(self, index):
+        """Return a dictionary of the keys of the dictionary object with the
+        given index, to the indexes of the values. Only the keys are
+        decoded."""
+        return self._dict_refs(index)
+
+    def _dict_refs(self, index):
+        if index in self._dicts:
+            return self._dicts[index]
+        nb1, count, pos = self._read_header(index)
+        if nb1 != MARKER_DICT:
+            raise PListFormatError("Object %d is not a dictionary" % (index, ))
+        # first N keys, then N values
+        keys = self._read_ints(pos, self.objectRefSize, count)
+        values = self._read_ints(pos + count * self.objectRefSize,
+                                 self.objectRefSize, count)
+        refs = dict(zip([self._object(k) for k in keys], values))
+        self._dicts[index] = refs
+        return refs
+
+    @_format_errors
+    def array_refs(self, index):
+        """Return the indexes of the items of the array object with the given
+        index."""
+        nb1, count, pos = self._read_header(index)
+        if nb1 != MARKER_ARRAY:
+            raise PListFormatError("Object %d is not an array" % (index, ))
+        return self._read_ints(pos, self.objectRefSize, count)
+
+    def _read_header(self, index):
+        """Return a tuple of the marker type, the count (for collections) and
+        the position of the contents of the object with the given index."""
+        offset = self._offsets[index]
+        marker = ord(self._data[offset])
+        nb1 = marker & 0xf0
+        count = None
+        pos = offset + 1
+        if nb1 in (MARKER_ARRAY, MARKER_SET, MARKER_DICT):
+            count, pos = self._read_count(marker & 0x0f, pos)
+        return nb1, count, pos
+
+    def _read_value(self, offset, marker):
         nb1 = marker & 0xf0
         nb2 = marker & 0x0f
+        pos = offset + 1
 
         if nb1 == MARKER_NULL:
             if marker == MARKER_NULL:
-                obj = None
+                return None
             elif marker == MARKER_FALSE:
-                obj = False
+                return False
             elif marker == MARKER_TRUE:
-                obj = True
+                return True
             #TODO: Fill byte, skip over
         elif nb1 == MARKER_INT:
-            count = 1 << nb2
-            obj = self._read_sized_int(count)
+            return self._read_int(pos, 1 << nb2)
         elif nb1 == MARKER_REAL:
-            obj = self._read_sized_float(nb2)
+            return self._read_float(pos, nb2)
         elif marker == MARKER_DATE:  # marker!
-            secs = self._read_sized_float(3)
+            secs = self._read_float(pos, 3)
             secs += SECS_EPOCH_TO_2001
-            obj = datetime.fromtimestamp(secs, UTC())
+            return datetime.fromtimestamp(secs, UTC())
         elif nb1 == MARKER_DATA or nb1 == MARKER_ASCIISTRING:
-            count = self._read_count(nb2)
-            obj = self._fd.read(count)
+            count, pos = self._read_count(nb2, pos)
+            return self._bytes(pos, pos + count)
         elif nb1 == MARKER_UNICODE16STRING:
-            count = self._read_count(nb2)
-            data = self._fd.read(count * 2)
-            chars = unpack(">%dH" % (count, ), data)
-            s = u''
-            for ch in chars:
-                s += unichr(ch)
-            obj = s
+            count, pos = self._read_count(nb2, pos)
+            return self._bytes(pos, pos + count * 2).decode('utf-16-be')
         elif nb1 == MARKER_UID:
-            count = 1 + nb2
-            obj = self._read_sized_int(count)
-        elif nb1 == MARKER_ARRAY:
-            count = self._read_count(nb2)
-            # we store lazy references to the object list
-            obj = [ObjectRef(self._read_sized_int(self.objectRefSize)) for _ in range(0, count)]
-        elif nb1 == MARKER_SET:
-            count = self._read_count(nb2)
-            # we store lazy references to the object list
-            obj = set([ObjectRef(self._read_sized_int(self.objectRefSize)) for _ in range(0, count)])
-        elif nb1 == MARKER_DICT:
-            count = self._read_count(nb2)
-            # first N keys, then N values
-            # we store lazy references to the object list
-            keys = [ObjectRef(self._read_sized_int(self.objectRefSize)) for _ in range(0, count)]
-            values = [ObjectRef(self._read_sized_int(self.objectRefSize)) for _ in range(0, count)]
-            obj = dict(zip(keys, values))
-
-        try:
-            return obj
-        except NameError:
-            raise PListFormatError("Unknown marker at position %d: %d" %
-                                   (offset, marker))
-
-    def _read_count(self, nb2):
-        count = nb2
-        if count == 0xf:
-            count = self._read_object()
-        return count
-
-    def _read_sized_float(self, log2count):
+            return self._read_int(pos, 1 + nb2)
+
+        raise PListFormatError("Unknown marker at position %d: %d" %
+                               (offset, marker))
+
+    def _read_count(self, nb2, pos):
+        """Return a tuple of the count of a variable-sized object and the
+        position of the object data."""
+        if nb2 != 0xf:
+            return nb2, pos
+        marker = ord(self._data[pos])
+        if marker & 0xf0 != MARKER_INT:
+            raise PListFormatError("Invalid count at position %d" % (pos, ))
+        size = 1 << (marker & 0x0f)
+        return self._read_int(pos + 1, size), pos + 1 + size
+
+    def _read_float(self, pos, log2count):
         if log2count == 2:
             # 32 bits
-            ret, = unpack(">f", self._fd.read(4))
+            ret, = unpack_from(">f", self._data, pos)
         elif log2count == 3:
             # 64 bits
-            ret, = unpack(">d", self._fd.read(8))
+            ret, = unpack_from(">d", self._data, pos)
         else:
             raise PListUnhandledError("Unhandled real size: %d" %
                                       (1 << log2count, ))
         return ret
 
-    def _read_sized_int(self, count):
-        # in format version '00', 1, 2, and 4-byte integers have to be
-        # interpreted as unsigned, whereas 8-byte integers are signed
-        # (and 16-byte when available). negative 1, 2, 4-byte integers
-        # are always emitted as 8 bytes in format '00'
-        buf = self._fd.read(count)
-        if count == 1:
-            ret = ord(buf)
-        elif count == 2:
-            ret, = unpack(">H", buf)
-        elif count == 4:
-            ret, = unpack(">I", buf)
-        elif count == 8:
-            ret, = unpack(">q", buf)
-        else:
-            raise PListUnhandledError("Unhandled int size: %d" %
-                                      (count, ))
+    def _read_int(self, pos, count):
+        fmt = INT_FORMATS.get(count)
+        if fmt is None:
+            raise PListUnhandledError("Unhandled int size: %d" % (count, ))
+        ret, = unpack_from(">" + fmt, self._data, pos)
         return ret
 
+    def _read_ints(self, pos, size, count):
+        """Read a list of integers of the given byte size."""
+        fmt = INT_FORMATS.get(size)
+        if fmt is None:
+            raise PListUnhandledError("Unhandled int size: %d" % (size, ))
+        return unpack_from(">%d%s" % (count, fmt), self._data, pos)
+
+
+class PListView(object):
+    """Lazy view of a plist, returned by open_binary_plist and
+    open_xml_plist.
+
+    Values are looked up by key or by path, where a path is a tuple of
+    dictionary keys and array indexes starting from the top level object.
+    Only the objects along the path and the returned value are decoded, and
+    decoded objects are cached. For a top level dictionary, the view can be
+    used much like a dictionary.
+
+    """
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def _find(self, path):
+        """Return the index of the object at the given path, or None if there
+        is no such object."""
+        if not isinstance(path, tuple):
+            path = (path, )
+        reader = self._reader
+        index = reader.topObject
+        for key in path:
+            kind = reader.kind(index)
+            if kind == MARKER_DICT:
+                index = reader.dict_refs(index).get(key)
+            elif kind == MARKER_ARRAY and isinstance(key, (int, long)):
+                refs = reader.array_refs(index)
+                index = refs[key] if -len(refs) <= key < len(refs) else None
+            else:
+                index = None
+            if index is None:
+                return None
+        return index
+
+    def get(self, path, default=None):
+        """Return the value at the given key or path, or the default value if
+        there is no such value."""
+        index = self._find(path)
+        return default if index is None else self._reader.object(index)
+
+    def __getitem__(self, path):
+        index = self._find(path)
+        if index is None:
+            raise KeyError(path)
+        return self._reader.object(index)
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def keys(self):
+        """Return the keys of the top level dictionary."""
+        return self._reader.dict_refs(self._reader.topObject).keys()
+
+    def value(self):
+        """Decode and return the complete top level object."""
+        return self._reader.read()
+
+
+def _parse_date(text):
+    dt = datetime.strptime(text.strip(), '%Y-%m-%dT%H:%M:%SZ')
+    return dt.replace(tzinfo=UTC())
+
+
+# decoders for the text of XML plist scalar elements, by tag; the marker type
+# is what the corresponding binary plist object would have
+XML_SCALARS = {
+    'string': (MARKER_ASCIISTRING, lambda text: text),
+    'integer': (MARKER_INT, int),
+    'real': (MARKER_REAL, float),
+    'true': (MARKER_NULL, lambda text: True),
+    'false': (MARKER_NULL, lambda text: False),
+    'date': (MARKER_DATE & 0xf0, _parse_date),
+    'data': (MARKER_DATA, b64decode),
+}
+
+
+class XMLPListReader(object):
+    """Reader that decodes an XML plist into the object table model of
+    BinaryPListReader, so that both can be accessed through a PListView.
+
+    The document is parsed with iterparse, and each element is decoded and
+    discarded as soon as it has been parsed, so the element tree of a large
+    document is never held in memory. Objects are numbered in the order in
+    which they end, so containers refer to their items by lower indexes.
+
+    """
+
+    def __init__(self, fd):
+        if isinstance(fd, basestring):
+            fd = StringIO(fd)
+        elif hasattr(fd, 'seek'):
+            fd.seek(0, 0)
+        self._values = []
+        self._kinds = []
+        self._objects = {}
+        try:
+            self.topObject = self._parse(fd)
+        except (SyntaxError, ValueError, TypeError), e:
+            # ElementTree's ParseError is a SyntaxError; int, float, date and
+            # base64 decoding errors are ValueError or TypeError
+            raise PListFormatError("Invalid XML plist: %s" % (e, ))
+
+    def _parse(self, fd):
+        values = self._values
+        kinds = self._kinds
+        # one frame per open container: element, refs and pending dict key
+        stack = []
+        top = None
+        for event, elem in ET.iterparse(fd, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'dict':
+                    stack.append([elem, {}, None])
+                elif tag == 'array':
+                    stack.append([elem, [], None])
+                continue
+            if tag == 'plist':
+                continue
+            if tag == 'key':
+                if not stack or not isinstance(stack[-1][1], dict):
+                    raise PListFormatError("Key outside of dictionary")
+                stack[-1][2] = elem.text or ''
+                elem.clear()
+                continue
+            if tag == 'dict':
+                value = stack.pop()[1]
+                kind = MARKER_DICT
+            elif tag == 'array':
+                value = stack.pop()[1]
+                kind = MARKER_ARRAY
+            elif tag in XML_SCALARS:
+                kind, decode = XML_SCALARS[tag]
+                value = decode(elem.text or '')
+            else:
+                raise PListFormatError("Unknown element: %s" % (tag, ))
+            index = len(values)
+            values.append(value)
+            kinds.append(kind)
+            elem.clear()
+
+            if not stack:
+                if top is not None:
+                    raise PListFormatError("More than one top level object")
+                top = index
+                continue
+            frame = stack[-1]
+            refs = frame[1]
+            if isinstance(refs, dict):
+                if frame[2] is None:
+                    raise PListFormatError("Dictionary value without key")
+                refs[frame[2]] = index
+                frame[2] = None
+            else:
+                refs.append(index)
+            # drop the finished children of the open container
+            frame[0].clear()
+        if top is None:
+            raise PListFormatError("No top level object")
+        return top
+
+    def read(self):
+        """Decode and return the top level object."""
+        return self.object(self.topObject)
+
+    def object(self, index):
+        """Return the object with the given index, including all objects that
+        it refers to."""
+        objects = self._objects
+        if index in objects:
+            return objects[index]
+        kind = self._kinds[index]
+        value = self._values[index]
+        if kind == MARKER_DICT:
+            obj = dict([(k, self.object(i)) for k, i in value.iteritems()])
+        elif kind == MARKER_ARRAY:
+            obj = [self.object(i) for i in value]
+        else:
+            obj = value
+        objects[index] = obj
+        return obj
+
+    def kind(self, index):
+        """Return the marker type (high nibble) that the object with the
+        given index would have in a binary plist."""
+        return self._kinds[index]
+
+    def dict_refs(self, index):
+        """Return a dictionary of the keys of the dictionary object with the
+        given index, to the indexes of the values."""
+        if self._kinds[index] != MARKER_DICT:
+            raise PListFormatError("Object %d is not a dictionary" % (index, ))
+        return self._values[index]
+
+    def array_refs(self, index):
+        """Return the indexes of the items of the array object with the given
+        index."""
+        if self._kinds[index] != MARKER_ARRAY:
+            raise PListFormatError("Object %d is not an array" % (index, ))
+        return self._values[index]
+
+
+def write_binary_plist(obj):
+    """Encode an object as a binary plist and return the data.
+
+    Supported types are None, bool, int, long, float, datetime (naive
+    datetimes are taken to be in UTC), str and unicode (strings), bytearray
+    (data), list and tuple (arrays), set and frozenset (sets) and dict (with
+    string keys). Equal strings and numbers are only stored once.
+
+    """
+    return BinaryPListWriter().write(obj)
+
+
+def write_xml_plist(obj):
+    """Encode an object as an XML plist and return the data.
+
+    The supported types are the same as for write_binary_plist, except that
+    None cannot be represented and sets are written as arrays.
+
+    """
+    parts = [XML_PLIST_HEADER]
+    _write_xml_value(obj, parts)
+    parts.append('</plist>')
+    return ''.join(parts)
+
+
+XML_PLIST_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\
+<plist version="1.0">'
+
+
+def _to_unicode(s):
+    return s if isinstance(s, unicode) else s.decode('utf-8')
+
+
+def _secs_since_2001(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(UTC()).replace(tzinfo=None)
+    delta = dt - datetime(2001, 1, 1)
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _write_xml_value(obj, parts):
+    if obj is True:
+        parts.append('<true/>')
+    elif obj is False:
+        parts.append('<false/>')
+    elif isinstance(obj, (int, long)):
+        parts.append('<integer>%d</integer>' % (obj, ))
+    elif isinstance(obj, float):
+        parts.append('<real>%r</real>' % (obj, ))
+    elif isinstance(obj, datetime):
+        if obj.tzinfo is not None:
+            obj = obj.astimezone(UTC())
+        parts.append(obj.strftime('<date>%Y-%m-%dT%H:%M:%SZ</date>'))
+    elif isinstance(obj, basestring):
+        text = xml_escape(_to_unicode(obj)).encode('utf-8')
+        parts.append('<string>%s</string>' % (text, ))
+    elif isinstance(obj, bytearray):
+        parts.append('<data>%s</data>' % (b64encode(str(obj)), ))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        parts.append('<array>')
+        for item in obj:
+            _write_xml_value(item, parts)
+        parts.append('</array>')
+    elif isinstance(obj, dict):
+        parts.append('<dict>')
+        for key in sorted(obj):
+            _write_xml_key(key, parts)
+            _write_xml_value(obj[key], parts)
+        parts.append('</dict>')
+    else:
+        raise TypeError("Unsupported plist type: %s" % (type(obj), ))
+
+
+def _write_xml_key(key, parts):
+    if not isinstance(key, basestring):
+        raise TypeError("Dictionary keys must be strings: %r" % (key, ))
+    text = xml_escape(_to_unicode(key)).encode('utf-8')
+    parts.append('<key>%s</key>' % (text, ))
+
+
+class BinaryPListWriter(object):
+    """Writer that encodes an object graph as a binary plist.
+
+    The objects are first flattened into a list, where collections refer to
+    their items by index, so that the size of object references is known
+    before anything is encoded.
+
+    """
+
+    def __init__(self):
+        self._objects = []
+        self._unique = {}
+
+    def write(self, obj):
+        top = self._flatten(obj)
+        refsize = _int_size(len(self._objects) - 1)
+
+        chunks = ['bplist00']
+        offsets = []
+        pos = 8
+        for item in self._objects:
+            chunk = self._encode(item, refsize)
+            offsets.append(pos)
+            chunks.append(chunk)
+            pos += len(chunk)
+
+        offsetsize = _int_size(pos)
+        chunks.append(pack('>%d%s' % (len(offsets), INT_FORMATS[offsetsize]),
+                           *offsets))
+        chunks.append(pack('>6x2B3Q', offsetsize, refsize, len(offsets), top,
+                           pos))
+        return ''.join(chunks)
+
+    def _flatten(self, obj):
+        """Add an object and the objects it refers to, and return the index of
+        the object. Collections are added as tuples of a marker and the
+        indexes of their items."""
+        if isinstance(obj, (list, tuple, set, frozenset, dict)):
+            index = len(self._objects)
+            self._objects.append(None)
+            if isinstance(obj, dict):
+                keys = sorted(obj)
+                for key in keys:
+                    if not isinstance(key, basestring):
+                        raise TypeError("Dictionary keys must be strings: %r"
+                                        % (key, ))
+                refs = [self._flatten(k) for k in keys] + \
+                        [self._flatten(obj[k]) for k in keys]
+                item = (MARKER_DICT, refs)
+            else:
+                marker = MARKER_ARRAY if isinstance(obj, (list, tuple)) \
+                        else MARKER_SET
+                item = (marker, [self._flatten(i) for i in obj])
+            self._objects[index] = item
+            return index
+
+        # bool is a subclass of int, and 1 == 1.0, so the type is part of the
+        # key for uniquing
+        key = (type(obj), obj if not isinstance(obj, bytearray) else str(obj))
+        index = self._unique.get(key)
+        if index is None:
+            index = self._unique[key] = len(self._objects)
+            self._objects.append(obj)
+        return index
+
+    def _encode(self, obj, refsize):
+        if isinstance(obj, tuple):
+            marker, refs = obj
+            count = len(refs) / 2 if marker == MARKER_DICT else len(refs)
+            return _encode_header(marker, count) + \
+                    pack('>%d%s' % (len(refs), INT_FORMATS[refsize]), *refs)
+        if obj is None:
+            return chr(MARKER_NULL)
+        if obj is True:
+            return chr(MARKER_TRUE)
+        if obj is False:
+            return chr(MARKER_FALSE)
+        if isinstance(obj, (int, long)):
+            return _encode_int(obj)
+        if isinstance(obj, float):
+            return chr(MARKER_REAL | 3) + pack('>d', obj)
+        if isinstance(obj, datetime):
+            return chr(MARKER_DATE) + pack('>d', _secs_since_2001(obj))
+        if isinstance(obj, bytearray):
+            return _encode_header(MARKER_DATA, len(obj)) + str(obj)
+        if isinstance(obj, basestring):
+            text = _to_unicode(obj)
+            try:
+                data = text.encode('ascii')
+                return _encode_header(MARKER_ASCIISTRING, len(data)) + data
+            except UnicodeEncodeError:
+                data = text.encode('utf-16-be')
+                return _encode_header(MARKER_UNICODE16STRING,
+                                      len(data) / 2) + data
+        raise TypeError("Unsupported plist type: %s" % (type(obj), ))
+
+
+def _int_size(value):
+    """Return the number of bytes needed for an unsigned integer."""
+    if value < 1 << 8:
+        return 1
+    if value < 1 << 16:
+        return 2
+    if value < 1 << 32:
+        return 4
+    return 8
+
+
+def _encode_int(value):
+    if value < 0:
+        # negative integers are always 8 bytes
+        size = 8
+    else:
+        size = _int_size(value)
+        if size == 8 and value >= 1 << 63:
+            raise PListUnhandledError("Unhandled int value: %d" % (value, ))
+    log2size = {1: 0, 2: 1, 4: 2, 8: 3}[size]
+    return chr(MARKER_INT | log2size) + pack('>' + INT_FORMATS[size], value)
+
+
+def _encode_header(marker, count):
+    if count < 0xf:
+        return chr(marker | count)
+    return chr(marker | 0xf) + _encode_int(count)
+
 
 class UTC(tzinfo):
     def utcoffset(self, dt):
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from twisted.internet import reactor
+
+__all__ = [
+    'SoapBudget',
+]
+
+
+class SoapBudget(object):
+    """Bridge-wide token budget for SOAP control traffic.
+
+    The budget is a token bucket that is refilled at a fixed rate. Interactive
+    commands (play, stop, seek, etc.) are always admitted, but they consume
+    tokens so that polling backs off while the user is interacting. Polling
+    requests (position and transport state) are only admitted if there is a
+    token available and if the polling session hasn't polled within its fair
+    share of the rate, i.e. the rate divided by the number of actions that
+    the active sessions poll.
+
+    """
+
+    def __init__(self, rate=0, min_poll_interval=0.0, clock=None):
+        """Initialize the budget.
+
+        Arguments:
+        rate              -- maximum number of SOAP requests per second across
+                             all sessions; 0 means unlimited
+        min_poll_interval -- minimum number of seconds between two polls from
+                             the same session, regardless of the rate
+        clock             -- object with a seconds() method, defaults to the
+                             reactor
+
+        """
+        self.rate = float(rate)
+        self.min_poll_interval = float(min_poll_interval)
+        self._clock = clock or reactor
+        self._tokens = self.rate
+        self._stamp = self._clock.seconds()
+        # registered sessions, mapped to the number of actions they poll
+        self._sessions = {}
+
+    def seconds(self):
+        """Return the current time according to the budget's clock."""
+        return self._clock.seconds()
+
+    def session_started(self, session, actions=1):
+        """Register a session that polls its renderer, using the given number
+        of status actions per poll interval."""
+        self._sessions[session] = actions
+
+    def session_ended(self, session):
+        """Unregister a session that no longer polls its renderer."""
+        self._sessions.pop(session, None)
+
+    def session_count(self):
+        """Return the number of registered sessions."""
+        return len(self._sessions)
+
+    def poll_interval(self):
+        """Return the minimum number of seconds between two polls from the
+        same session, for each action that it polls."""
+        interval = self.min_poll_interval
+        if self.rate > 0:
+            fair = max(1, sum(self._sessions.itervalues())) / self.rate
+            interval = max(interval, fair)
+        return interval
+
+    def acquire_command(self):
+        """Account for an interactive command. Commands are never refused, but
+        may leave the bucket in debt, which delays subsequent polls."""
+        if self.rate > 0:
+            self._refill()
+            self._tokens -= 1
+
+    def acquire_poll(self, last_poll=None):
+        """Try to account for a poll request.
+
+        Arguments:
+        last_poll -- the time (in clock seconds) of the previous poll from the
+                     session, or None if the session hasn't polled yet (in
+                     which case the poll is always admitted, since there is
+                     no cached result to fall back on)
+
+        Return True if the poll may be sent, False if the session should use a
+        cached result instead.
+
+        """
+        if last_poll is None:
+            self.acquire_command()
+            return True
+        if self._clock.seconds() - last_poll < self.poll_interval():
+            return False
+        if self.rate > 0:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        return True
+
+    def _refill(self):
+        now = self._clock.seconds()
+        elapsed = max(0.0, now - self._stamp)
+        self._stamp = now
+        # the bucket holds at most one second worth of tokens
+        self._tokens = min(self.rate, self._tokens + elapsed * self.rate)
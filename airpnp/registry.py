@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from urlparse import urlparse
+from util import split_type, is_version_compatible
+
+__all__ = [
+    'DeviceRegistry',
+    'index_types',
+    'has_compatible_type',
+]
+
+
+def index_types(types):
+    """Return a dictionary of type family to the set of versions of that
+    family found among the given device or service types."""
+    index = {}
+    for type_ in types:
+        family, version = split_type(type_)
+        index.setdefault(family, set()).add(version)
+    return index
+
+
+def has_compatible_type(index, type_):
+    """Return whether a type index, as returned by index_types, has a type
+    that is compatible with the given type."""
+    family, required = split_type(type_)
+    versions = index.get(family, ())
+    return any(is_version_compatible(required, v) for v in versions)
+
+
+class Subscription(object):
+    """Registry subscription, returned by DeviceRegistry.subscribe."""
+
+    __slots__ = ['on_added', 'on_removed', 'criteria', 'matched']
+
+    def __init__(self, on_added, on_removed, criteria):
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.criteria = criteria
+        self.matched = set()
+
+
+class DeviceRegistry(object):
+    """Registry of device managers, keyed by device UDN.
+
+    Besides lookup by UDN, the registry maintains secondary indexes on device
+    type family, service type family, host and friendly name, so that
+    devices can be found without scanning all of them. The criteria that
+    find and subscribe accept are:
+
+    device_type   -- device type; devices with a compatible type match
+    service_type  -- service type; devices with a compatible service match
+    host          -- host name or IP address of the device location
+    friendly_name -- friendly name of the device
+
+    The registered objects must have a device attribute with the Device
+    object, and a published attribute that tells whether the device may be
+    reported to subscribers. If a device has been updated in place, reindex
+    must be called.
+
+    Subscribers are not notified when entries are added, removed or
+    reindexed, but when notify is called, so that the owner of the registry
+    decides when a device is visible.
+
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._keys = {}
+        self._indexes = {
+            'device_type': {},
+            'service_type': {},
+            'host': {},
+            'friendly_name': {},
+        }
+        self._subscriptions = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, udn):
+        return udn in self._entries
+
+    def __iter__(self):
+        return self._entries.itervalues()
+
+    def get(self, udn, default=None):
+        return self._entries.get(udn, default)
+
+    def add(self, entry):
+        """Add an entry (a device manager) to the registry, replacing any
+        entry for the same UDN."""
+        udn = entry.device.UDN
+        if udn in self._entries:
+            self.remove(udn)
+        self._entries[udn] = entry
+        self._index(udn, entry.device)
+
+    def remove(self, udn):
+        """Remove and return the entry for the given UDN."""
+        entry = self._entries.pop(udn)
+        self._unindex(udn)
+        return entry
+
+    def reindex(self, udn):
+        """Update the indexes for a device that has changed in place."""
+        self._unindex(udn)
+        self._index(udn, self._entries[udn].device)
+
+    def _device_keys(self, device):
+        host = urlparse(device.get_base_url()).hostname
+        services = [s.serviceType for s in device]
+        return {
+            'device_type': index_types([device.deviceType]),
+            'service_type': index_types(services),
+            'host': {host: None},
+            'friendly_name': {device.friendlyName: None},
+        }
+
+    def _index(self, udn, device):
+        keys = self._device_keys(device)
+        self._keys[udn] = keys
+        for name, values in keys.iteritems():
+            index = self._indexes[name]
+            for value in values:
+                index.setdefault(value, set()).add(udn)
+
+    def _unindex(self, udn):
+        keys = self._keys.pop(udn)
+        for name, values in keys.iteritems():
+            index = self._indexes[name]
+            for value in values:
+                udns = index[value]
+                udns.discard(udn)
+                if not udns:
+                    del index[value]
+
+    def _candidates(self, name, value):
+        index = self._indexes[name]
+        if name in ('device_type', 'service_type'):
+            value = split_type(value)[0]
+        return index.get(value, ())
+
+    def _matches(self, udn, criteria):
+        keys = self._keys.get(udn)
+        if keys is None:
+            return False
+        for name, value in criteria.iteritems():
+            if name in ('device_type', 'service_type'):
+                if not has_compatible_type(keys[name], value):
+                    return False
+            elif value not in keys[name]:
+                return False
+        return True
+
+    def _check_criteria(self, criteria):
+        unknown = [name for name in criteria if name not in self._indexes]
+        if unknown:
+            raise ValueError('Unknown criteria: %s' % (', '.join(unknown), ))
+
+    def find(self, **criteria):
+        """Return a list of the entries that match all the given criteria.
+        Without criteria, all entries are returned."""
+        self._check_criteria(criteria)
+        if not criteria:
+            return self._entries.values()
+        candidates = min((self._candidates(name, value)
+                          for name, value in criteria.iteritems()), key=len)
+        return [self._entries[udn] for udn in candidates
+                if self._matches(udn, criteria)]
+
+    def subscribe(self, on_added, on_removed, **criteria):
+        """Subscribe to devices that match all the given criteria.
+
+        The on_added callable receives the Device object of each matching
+        published device, including those that are already registered. The
+        on_removed callable receives the Device object of a previously
+        matching device that has been removed or no longer matches.
+
+        Return an object that can be passed to unsubscribe.
+
+        """
+        self._check_criteria(criteria)
+        sub = Subscription(on_added, on_removed, criteria)
+        self._subscriptions.append(sub)
+        for entry in self.find(**criteria):
+            if not entry.published:
+                continue
+            sub.matched.add(entry.device.UDN)
+            sub.on_added(entry.device)
+        return sub
+
+    def unsubscribe(self, sub):
+        """Cancel a subscription returned by subscribe."""
+        self._subscriptions.remove(sub)
+
+    def notify(self, udn, device):
+        """Notify subscribers that the given device has been published,
+        updated or removed, so that it is added to or removed from the
+        subscriptions whose criteria it matches or no longer matches."""
+        entry = self._entries.get(udn)
+        published = entry is not None and entry.published
+        for sub in self._subscriptions[:]:
+            matches = published and self._matches(udn, sub.criteria)
+            if matches and udn not in sub.matched:
+                sub.matched.add(udn)
+                sub.on_added(device)
+            elif not matches and udn in sub.matched:
+                sub.matched.discard(udn)
+                sub.on_removed(device)
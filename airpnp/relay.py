@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import re
+import urlparse
+from photostore import PhotoStore, PhotoStoreFullError
+from util import stream_page, parse_byte_range
+from zope.interface import implements
+from twisted.application.internet import TCPServer
+from twisted.internet import defer, interfaces
+from twisted.python import failure, log
+from twisted.web import http, resource, server
+
+__all__ = [
+    'MediaRelay',
+    'RelayedMedia',
+    'RelayedMediaResource',
+]
+
+# Size of the chunks that relayed media is fetched and cached in
+CHUNK_SIZE = 1024 * 1024
+
+# Default number of bytes that each upstream request reads
+DEFAULT_READ_AHEAD = 8 * CHUNK_SIZE
+
+# Seconds that an upstream request may take
+UPSTREAM_TIMEOUT = 60
+
+# Extensions that are kept in the local URL of relayed media, since some
+# renderers look at them
+EXTENSION = re.compile(r'\.\w{1,5}$')
+
+CONTENT_RANGE = re.compile(r'^bytes\s+(\d+)-\d+/(\d+)$')
+
+# Playlists refer to other URLs, possibly relative ones, so they are passed
+# to the renderers as they are
+PLAYLIST_EXTENSIONS = ['.m3u8', '.m3u']
+PLAYLIST_TYPES = ['application/vnd.apple.mpegurl', 'application/x-mpegurl',
+                  'audio/mpegurl', 'audio/x-mpegurl']
+
+
+class _FetchDone(Exception):
+    """Raised to end an upstream request that returns more than needed."""
+
+
+class _ChunkWriter(object):
+    """Consumer for stream_page that cuts an upstream response into chunks
+    and adds them to the cache of the relayed media."""
+
+    def __init__(self, media, first, end):
+        self.media = media
+        self.index = first
+        self.end = end
+        self.skip = 0
+        self.parts = []
+        self.length = 0
+
+    def begin(self, response):
+        offset = self.media._learn(response)
+        # an upstream server that ignores the range starts from the beginning
+        self.skip = self.index * CHUNK_SIZE - offset
+        if self.skip < 0:
+            raise IOError('Upstream returned a range that starts at %d' %
+                          (offset, ))
+
+    def feed(self, data):
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data = data[skipped:]
+            self.skip -= skipped
+        while data:
+            if self.index == self.end:
+                # the upstream server returns more than was asked for
+                raise _FetchDone()
+            room = CHUNK_SIZE - self.length
+            part, data = data[:room], data[room:]
+            self.parts.append(part)
+            self.length += len(part)
+            if self.length == CHUNK_SIZE:
+                self._flush()
+
+    def close(self):
+        # only the last chunk of the media may be short
+        if self.parts and \
+                self.index * CHUNK_SIZE + self.length == self.media.size:
+            self._flush()
+
+    def _flush(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        self.length = 0
+        self.media._chunk_fetched(self.index, data)
+        self.index += 1
+
+
+class RelayedMedia(object):
+    """Media at an upstream URL that is fetched in chunks into a cache.
+
+    Chunks are fetched with range requests that cover several chunks at a
+    time, so that the upstream server sees a few large sequential reads no
+    matter how small the ranges that the renderer reads are. The size and
+    content type of the media are learned from the first upstream response.
+    Only media whose upstream server answers range requests with its size,
+    and that isn't a playlist, can be relayed.
+
+    """
+
+    def __init__(self, name, url, cache, read_ahead=DEFAULT_READ_AHEAD,
+                 stream=stream_page):
+        """Initialize the relayed media.
+
+        Arguments:
+        name       -- local name of the media, also used to name its chunks
+        url        -- upstream URL of the media
+        cache      -- PhotoStore that the chunks are cached in
+        read_ahead -- number of bytes that each upstream request reads
+        stream     -- function used for upstream requests, like stream_page
+
+        """
+        self.name = name
+        self.url = url
+        self.size = None
+        self.content_type = None
+        # number of times the media has been relayed but not released
+        self.refs = 1
+        self._cache = cache
+        self._read_ahead = max(1, read_ahead // CHUNK_SIZE)
+        self._stream = stream
+        # Deferreds waiting for chunks, by chunk index
+        self._waiting = {}
+        # indices of the chunks that are being fetched
+        self._fetching = set()
+        self._fetches = []
+        # Deferreds waiting for the size and content type
+        self._opening = []
+        self._discarded = False
+
+    def chunk_name(self, index):
+        return '%s.%d' % (self.name, index)
+
+    def chunk_count(self):
+        return (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def open(self):
+        """Return a Deferred that fires with this media when its size and
+        content type are known, i.e. as soon as the first upstream response
+        has begun, or fails if the media cannot be relayed."""
+        if self.size is not None:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._opening.append(d)
+        if not self._is_available(0):
+            self._fetch(0)
+        return d
+
+    def get_chunk(self, index):
+        """Return a Deferred that fires with the data of the chunk with the
+        given index, as a string or as a memory map, fetching it (and the
+        chunks after it) if it isn't cached."""
+        photo = self._cache.get(self.chunk_name(index))
+        if photo is not None:
+            return defer.succeed(photo.buffer())
+        d = defer.Deferred()
+        self._waiting.setdefault(index, []).append(d)
+        if index not in self._fetching:
+            self._fetch(index)
+        return d
+
+    def prefetch(self, index):
+        """Start fetching the chunks from the given index on, if they aren't
+        cached or being fetched already.
+
+        Only half of the read-ahead is looked at, so that the next upstream
+        request starts while the chunks of the previous one are being read.
+
+        """
+        last = index + max(1, self._read_ahead // 2)
+        if self.size is not None:
+            last = min(last, self.chunk_count())
+        for i in xrange(index, last):
+            if not self._is_available(i):
+                self._fetch(i)
+                break
+
+    def discard(self):
+        """Stop all upstream requests and remove all chunks from the
+        cache."""
+        self._discarded = True
+        for d in self._fetches[:]:
+            d.cancel()
+        if self.size is not None:
+            for index in xrange(self.chunk_count()):
+                name = self.chunk_name(index)
+                if name in self._cache:
+                    self._cache.remove(name)
+
+    def _is_available(self, index):
+        return index in self._fetching or \
+                self.chunk_name(index) in self._cache
+
+    def _fetch(self, first):
+        last = first + self._read_ahead
+        if self.size is not None:
+            last = min(last, self.chunk_count())
+        end = first + 1
+        while end < last and not self._is_available(end):
+            end += 1
+        indices = range(first, end)
+        self._fetching.update(indices)
+        headers = {'Range': 'bytes=%d-%d' % (first * CHUNK_SIZE,
+                                             end * CHUNK_SIZE - 1)}
+        writer = _ChunkWriter(self, first, end)
+        d = self._stream(self.url, writer, timeout=UPSTREAM_TIMEOUT,
+                         headers=headers)
+        self._fetches.append(d)
+        d.addBoth(self._fetched, d, indices)
+
+    def _fetched(self, result, d, indices):
+        self._fetches.remove(d)
+        self._fetching.difference_update(indices)
+        if isinstance(result, failure.Failure):
+            if result.check(_FetchDone):
+                result = None
+            elif not self._discarded:
+                log.msg('Failed to fetch %s: %s' %
+                        (self.url, result.getErrorMessage()), ll=1)
+        if result is None:
+            # the upstream response ended early
+            result = failure.Failure(IOError('Upstream returned too little '
+                                             'data for %s' % (self.url, )))
+        if self.size is None:
+            opening, self._opening = self._opening, []
+            for waiter in opening:
+                waiter.errback(result)
+        for index in indices:
+            for waiter in self._waiting.pop(index, []):
+                waiter.errback(result)
+
+    def _learn(self, response):
+        """Learn the size and content type of the media from an upstream
+        response, and return the offset at which its body starts."""
+        headers = response.headers
+        if response.code != http.PARTIAL_CONTENT:
+            raise IOError('Upstream does not support range requests for %s' %
+                          (self.url, ))
+        value = (headers.getRawHeaders('content-range') or [''])[0]
+        match = CONTENT_RANGE.match(value)
+        if match is None:
+            raise IOError('Unsupported content range from upstream: %r' %
+                          (value, ))
+        offset, size = int(match.group(1)), int(match.group(2))
+        if self.size is None:
+            content_type = (headers.getRawHeaders('content-type') or
+                            ['application/octet-stream'])[0]
+            if content_type.split(';')[0].strip().lower() in PLAYLIST_TYPES:
+                raise IOError('%s is a playlist' % (self.url, ))
+            self.size = size
+            self.content_type = content_type
+            opening, self._opening = self._opening, []
+            for waiter in opening:
+                waiter.callback(self)
+        elif size != self.size:
+            raise IOError('The size of %s has changed' % (self.url, ))
+        return offset
+
+    def _chunk_fetched(self, index, data):
+        if self._discarded:
+            return
+        name = self.chunk_name(index)
+        if name not in self._cache:
+            try:
+                self._cache.add(name, self.content_type, data, evictable=True)
+            except PhotoStoreFullError, e:
+                # the chunk is served to the waiting renderers all the same
+                log.msg('Not caching chunk of %s: %s' % (self.url, e), ll=2)
+        for waiter in self._waiting.pop(index, []):
+            waiter.callback(data)
+
+
+class _ChunkProducer(object):
+    """Push producer that writes a range of relayed media to a request, one
+    chunk at a time."""
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, request, media, start, end):
+        self.request = request
+        self.media = media
+        self.pos = start
+        self.end = end
+        self.paused = False
+        self.reading = False
+        self.stopped = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self._next()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._next()
+
+    def stopProducing(self):
+        self.stopped = True
+
+    def _next(self):
+        if self.paused or self.reading or self.stopped:
+            return
+        if self.pos >= self.end:
+            self.stopped = True
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        index = self.pos // CHUNK_SIZE
+        self.reading = True
+        d = self.media.get_chunk(index)
+        self.media.prefetch(index + 1)
+        d.addCallbacks(self._write, self._failed, callbackArgs=(index, ))
+
+    def _write(self, chunk, index):
+        self.reading = False
+        if self.stopped:
+            return
+        offset = self.pos - index * CHUNK_SIZE
+        length = min(len(chunk) - offset, self.end - self.pos)
+        if length <= 0:
+            return self._failed(failure.Failure(IOError('Chunk %d of %s is '
+                                                        'too short' %
+                                                        (index,
+                                                         self.media.url))))
+        self.pos += length
+        self.request.write(chunk[offset:offset + length])
+        self._next()
+
+    def _failed(self, fail):
+        self.reading = False
+        if self.stopped:
+            return
+        self.stopped = True
+        self.request.unregisterProducer()
+        # the response is incomplete, so the renderer must see it fail
+        self.request.transport.loseConnection()
+
+
+class RelayedMediaResource(resource.Resource):
+    """Resource that serves relayed media from its cache, supporting HEAD
+    requests and requests for a single byte range."""
+
+    isLeaf = True
+
+    def __init__(self, media):
+        resource.Resource.__init__(self)
+        self.media = media
+
+    def render_GET(self, request):
+        producers = []
+        def stop(_):
+            for producer in producers:
+                producer.stopProducing()
+        finished = request.notifyFinish()
+        finished.addErrback(stop)
+
+        d = self.media.open()
+        d.addCallback(self._respond, request, finished, producers)
+        d.addErrback(self._failed, request, finished)
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+    def _respond(self, media, request, finished, producers):
+        if finished.called:
+            return
+        size = media.size
+        start, end = 0, size
+        request.setHeader('content-type', media.content_type)
+        request.setHeader('accept-ranges', 'bytes')
+        value = request.getHeader('range')
+        if value:
+            try:
+                byte_range = parse_byte_range(value, size)
+            except ValueError:
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader('content-range', 'bytes */%d' % (size, ))
+                request.setHeader('content-length', '0')
+                request.finish()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                request.setResponseCode(http.PARTIAL_CONTENT)
+                request.setHeader('content-range', 'bytes %d-%d/%d' %
+                                  (start, end - 1, size))
+        request.setHeader('content-length', str(end - start))
+        if request.method == 'HEAD' or start == end:
+            request.finish()
+            return
+        producer = _ChunkProducer(request, media, start, end)
+        producers.append(producer)
+        producer.start()
+
+    def _failed(self, fail, request, finished):
+        if finished.called:
+            return
+        request.setResponseCode(http.BAD_GATEWAY)
+        request.setHeader('content-length', '0')
+        request.finish()
+
+
+class MediaRelayResource(resource.Resource):
+    """Resource that serves the media relayed by a MediaRelay."""
+
+    def __init__(self, relay):
+        resource.Resource.__init__(self)
+        self.relay = relay
+
+    def getChild(self, name, request):
+        media = self.relay.get(name)
+        if media is None:
+            return resource.NoResource()
+        return RelayedMediaResource(media)
+
+
+class MediaRelay(TCPServer):
+    """Server that relays media from AirPlay clients to media renderers.
+
+    Renderers tend to read media with many small range requests and to
+    reconnect often, which is slow over a wireless network and drains the
+    battery of the client. The relay fetches the media from the client with
+    large sequential reads instead, caches the chunks in a bounded cache
+    (a PhotoStore, which spills to disk) and serves the renderers from the
+    cache.
+
+    """
+
+    def __init__(self, port, backlog, ip_addr, cache=None,
+                 read_ahead=DEFAULT_READ_AHEAD, stream=stream_page):
+        self.cache = PhotoStore() if cache is None else cache
+        self.root = MediaRelayResource(self)
+        self._ip_addr = ip_addr
+        self._read_ahead = read_ahead
+        self._stream = stream
+        self._media = {}
+        TCPServer.__init__(self, port, server.Site(self.root), backlog,
+                           interface=ip_addr)
+
+    def relay(self, url):
+        """Start relaying the media at the given URL, and return a Deferred
+        that fires with the URL at which the renderer can fetch it.
+
+        The upstream server is asked for the first chunks of the media right
+        away. If the media cannot be relayed, e.g. since it is a live stream
+        without a size or a playlist with relative URLs, the Deferred fires
+        with the given URL instead. Otherwise, the same media may be relayed
+        several times, and is released when it has been released as many
+        times.
+
+        """
+        path = urlparse.urlsplit(url)[2]
+        match = EXTENSION.search(path)
+        ext = match.group(0) if match else ''
+        if ext.lower() in PLAYLIST_EXTENSIONS:
+            return defer.succeed(url)
+        name = hashlib.sha1(url).hexdigest() + ext
+        media = self._media.get(name)
+        if media is None:
+            media = self._media[name] = RelayedMedia(name, url, self.cache,
+                                                     self._read_ahead,
+                                                     self._stream)
+        else:
+            media.refs += 1
+        uri = 'http://%s:%d/%s' % (self._ip_addr, self.port, name)
+        d = media.open()
+        d.addCallbacks(lambda _: uri, self._not_relayed,
+                       errbackArgs=(uri, url))
+        return d
+
+    def _not_relayed(self, fail, uri, url):
+        log.msg('Passing %s to the renderer as it is, since it cannot be '
+                'relayed: %s' % (url, fail.getErrorMessage()), ll=2)
+        self.release(uri)
+        return url
+
+    def release(self, uri):
+        """Release media relayed at the given URL."""
+        name = uri.rsplit('/', 1)[-1]
+        media = self._media.get(name)
+        if media is not None:
+            media.refs -= 1
+            if media.refs <= 0:
+                del self._media[name]
+                media.discard()
+
+    def get(self, name):
+        """Return the relayed media with the given local name, or None."""
+        return self._media.get(name)
+
+    def stopService(self):
+        for media in self._media.values():
+            media.discard()
+        self._media.clear()
+        self.cache.clear()
+        return TCPServer.stopService(self)
+
+    @property
+    def port(self):
+        return self._port.getHost().port
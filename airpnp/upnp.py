@@ -30,7 +30,7 @@ import socket
 import time
 import re
 from cStringIO import StringIO
-from xml.etree import ElementTree as ET
+from xmlbackend import ET
 from httplib import HTTPMessage
 from random import random
 from upnpx import parse_attrns
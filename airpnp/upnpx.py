@@ -26,7 +26,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from xml.etree import ElementTree as ET
+from xmlbackend import ET
 
 __all__ = [
     'parse_attrns',
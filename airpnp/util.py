@@ -31,20 +31,33 @@ import re
 from string import rsplit
 from upnp import SoapMessage, SoapError
 from cStringIO import StringIO
+from twisted.internet import defer, protocol, reactor
 from twisted.web import client, error, http
-from twisted.python import log
+from twisted.web.http_headers import Headers
+from twisted.python import failure, log
 
 __all__ = [
     'format_soap_message',
     'send_soap_message',
     'send_soap_message_deferred',
+    'stream_page',
     'split_usn',
     'get_max_age',
     'get_image_type',
+    'parse_byte_range',
     'create_device_id',
     'are_service_types_compatible',
+    'split_type',
+    'is_version_compatible',
+    'TypeMatcher',
 ]
 
+# Maximum number of type strings whose parsing or matching is memoized
+TYPE_CACHE_SIZE = 1024
+
+_split_types = {}
+
+
 
 class MPOSTRequest(urllib2.Request):
 
@@ -173,6 +186,108 @@ def send_soap_message_deferred(url, msg, mpost=False, deferred=None):
     return d
 
 
+class StreamingBodyReceiver(protocol.Protocol):
+
+    """
+    Internal protocol used by stream_page to pass the response body to a
+    consumer as it arrives.
+
+    If the consumer raises an exception, the download is aborted and the
+    exception is passed to the errback chain. If the response status was an
+    error, the body is discarded and the error is passed on instead.
+
+    """
+
+    def __init__(self, consumer, finished, err=None):
+        self.consumer = consumer
+        self.finished = finished
+        self.failure = failure.Failure(err) if err else None
+
+    def dataReceived(self, data):
+        if self.failure:
+            return
+        try:
+            self.consumer.feed(data)
+        except:
+            self.failure = failure.Failure()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if self.failure:
+            self.finished.errback(self.failure)
+        elif reason.check(client.ResponseDone, http.PotentialDataLoss):
+            try:
+                result = self.consumer.close()
+            except:
+                self.finished.errback()
+            else:
+                self.finished.callback(result)
+        else:
+            self.finished.errback(reason)
+
+
+def stream_page(url, consumer, timeout=0, headers=None):
+    """
+    Download the page at the given URL, passing data to a consumer as it
+    arrives rather than buffering the entire page.
+
+    The consumer must have a feed(data) method, which may raise an exception
+    to abort the download, and a close() method, which is called when the
+    download is complete. If the consumer has a begin(response) method, it is
+    called with the response before any data is passed, and may also raise
+    an exception to abort the download. Headers is an optional dictionary of
+    additional request headers.
+
+    As with getPage, a non-2xx response results in a twisted.web.error.Error,
+    and a download that takes longer than the timeout (in seconds, 0 means no
+    timeout) results in a TimeoutError.
+
+    Return a Deferred, whose callback will be called with the return value of
+    consumer.close().
+
+    """
+    def handle_response(response):
+        err = None
+        if response.code // 100 != 2:
+            err = error.Error(str(response.code), response.phrase)
+        elif hasattr(consumer, 'begin'):
+            try:
+                consumer.begin(response)
+            except Exception, e:
+                err = e
+        def cancel(_):
+            if receiver.transport:
+                receiver.transport.stopProducing()
+        finished = defer.Deferred(cancel)
+        receiver = StreamingBodyReceiver(consumer, finished, err)
+        response.deliverBody(receiver)
+        return finished
+
+    # description URLs may redirect, which getPage used to follow
+    agent = client.RedirectAgent(client.Agent(reactor,
+                                              connectTimeout=timeout or None))
+    req_headers = Headers({'User-Agent': ['OS/1.0 UPnP/1.0 airpnp/1.0']})
+    for name, value in (headers or {}).items():
+        req_headers.setRawHeaders(name, [value])
+    d = agent.request('GET', url, req_headers)
+    d.addCallback(handle_response)
+
+    if timeout:
+        timer = reactor.callLater(timeout, d.cancel)
+        def handle_timeout(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, failure.Failure) and \
+                    result.check(defer.CancelledError):
+                raise defer.TimeoutError("Getting %s took longer than %s "
+                                         "seconds." % (url, timeout))
+            return result
+        d.addBoth(handle_timeout)
+    return d
+
+
 def split_usn(usn):
     """Split a USN into a UDN and a device or service type.
     
@@ -210,12 +325,52 @@ def get_max_age(headers):
     return ret
 
 def get_image_type(data):
-    """Return a tuple of (content type, extension) for the image data."""
+    """Return a tuple of (content type, extension) for the image data, given
+    as a string or as a seekable file-like object."""
+    if hasattr(data, 'read'):
+        data.seek(0, 0)
+        header = data.read(2)
+        data.seek(0, 0)
+        data = header
     if data[:2] == "\xff\xd8":
         return ("image/jpeg", ".jpg")
     return ("image/unknown", ".bin")
 
 
+def parse_byte_range(value, size):
+    """Parse the value of a Range header for an entity of the given size.
+
+    Return a tuple of (start, end) of the range, where end is exclusive, or
+    None if the header should be ignored (because it is malformed, is not in
+    bytes or has more than one range). Raise a ValueError if the range cannot
+    be satisfied.
+
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = [part.strip() for part in spec.partition('-')]
+    if not dash or not (first or last) or \
+            not (first.isdigit() or not first) or \
+            not (last.isdigit() or not last):
+        return None
+    if first:
+        start = int(first)
+        end = int(last) + 1 if last else size
+        if last and end <= start:
+            return None
+    else:
+        # suffix range, i.e. the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range: %s" % (value, ))
+        start = max(size - length, 0)
+        end = size
+    if start >= size:
+        raise ValueError("Range not satisfiable: %s" % (value, ))
+    return start, min(end, size)
+
+
 def format_soap_message(msg):
     args = msg.get_args()
     arg_str = ", ".join(["%s=%s" % (k, v) for k, v in args])
@@ -232,22 +387,98 @@ def create_device_id(data):
     return ''.join("%s:" % hx[i:i + 2] for i in range(0, len(hx), 2))[:-1]
 
 
-def are_service_types_compatible(required, actual):
+def split_type(type_):
+    """Split a device or service type into a tuple of (family, version).
+
+    The version is an int if it is numeric. A type without a version has
+    None as version. Results are memoized, since the same types are seen
+    over and over again.
+
+    """
+    ret = _split_types.get(type_)
+    if ret is None:
+        parts = rsplit(type_, ':', 1)
+        if len(parts) != 2:
+            ret = (type_, None)
+        else:
+            family, version = parts
+            try:
+                version = int(version)
+            except ValueError:
+                pass
+            ret = (family, version)
+        if len(_split_types) >= TYPE_CACHE_SIZE:
+            _split_types.clear()
+        _split_types[type_] = ret
+    return ret
+
+
+def is_version_compatible(required, actual):
+    """Return whether the actual version of a type satisfies the required
+    version, as returned by split_type."""
     if required == actual:
         return True
-    rparts = rsplit(required, ':', 1)
-    aparts = rsplit(actual, ':', 1)
-    if len(rparts) != 2 or len(aparts) != 2:
-        return False
-    rtype, rver = rparts
-    atype, aver = aparts
-    if rtype != atype:
-        return False
-    if rver == aver:
+    if isinstance(required, int) and isinstance(actual, int):
+        return actual >= required
+    # Not numbers, and different
+    return False
+
+
+class TypeMatcher(object):
+    """Matcher that checks if a type is compatible with any of a fixed list of
+    required device or service types.
+
+    The required types are parsed once into a dictionary keyed by type
+    family, that holds the minimum numeric version and any non-numeric
+    versions of the family. Match results are memoized per type string.
+
+    """
+
+    def __init__(self, types):
+        self.types = list(types)
+        self._families = {}
+        for type_ in self.types:
+            family, version = split_type(type_)
+            min_version, exact = self._families.get(family, (None, set()))
+            if isinstance(version, int):
+                if min_version is None or version < min_version:
+                    min_version = version
+            else:
+                exact.add(version)
+            self._families[family] = (min_version, exact)
+        self._memo = {}
+
+    def __nonzero__(self):
+        return bool(self.types)
+
+    def matches(self, actual):
+        """Return whether the actual type is compatible with any of the
+        required types."""
+        ret = self._memo.get(actual)
+        if ret is None:
+            ret = self._match(actual)
+            if len(self._memo) >= TYPE_CACHE_SIZE:
+                self._memo.clear()
+            self._memo[actual] = ret
+        return ret
+
+    def _match(self, actual):
+        family, version = split_type(actual)
+        entry = self._families.get(family)
+        if entry is None:
+            return False
+        min_version, exact = entry
+        if isinstance(version, int) and min_version is not None:
+            return version >= min_version
+        return version in exact
+
+
+def are_service_types_compatible(required, actual):
+    if required == actual:
         return True
-    try:
-        return int(aver) >= int(rver)
-    except ValueError:
-        # Not numbers, and different
+    rtype, rver = split_type(required)
+    atype, aver = split_type(actual)
+    if rver is None or aver is None or rtype != atype:
         return False
+    return is_version_compatible(rver, aver)
 
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011, Per Rovegård <per@rovegard.se>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Selection of the ElementTree implementation used for all XML handling.
+
+The C-accelerated cElementTree is used when it is available, since it has the
+same API and semantics as the pure-Python ElementTree but parses several times
+faster. The pure-Python implementation can be forced by setting the
+AIRPNP_XML_BACKEND environment variable to "ElementTree", e.g. to compare
+behavior or performance.
+
+Other modules should import ET from here rather than from xml.etree, so that
+elements created by different modules always come from the same backend.
+
+"""
+
+import os
+
+__all__ = [
+    'ET',
+    'BACKEND',
+]
+
+BACKENDS = ['cElementTree', 'ElementTree']
+
+
+def load_backend(preferred=None):
+    """Return a tuple of (name, module) for the first available ElementTree
+    implementation, starting with the preferred one if given."""
+    names = BACKENDS
+    if preferred in names:
+        names = [preferred] + [n for n in names if n != preferred]
+    for name in names:
+        try:
+            module = __import__('xml.etree.' + name, fromlist=[name])
+            return name, module
+        except ImportError:
+            pass
+    raise ImportError('No ElementTree implementation found')
+
+
+BACKEND, ET = load_backend(os.environ.get('AIRPNP_XML_BACKEND'))
@@ -0,0 +1,48 @@
+"""Time binary plist parsing on the test fixtures, both fully and lazily
+(looking up a single value through open_binary_plist), and XML plist parsing
+of the same values.
+
+Run from the top-level directory:
+
+    python bench/bench_plist.py [rounds]
+
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from airpnp.plist import read_binary_plist, open_binary_plist, \
+        read_xml_plist, write_xml_plist
+
+# fixture and path of the value to look up lazily
+FIXTURES = [('test/plist/airplay.bin', 'Content-Location'),
+            ('test/plist/unicode.bin', ()),
+            ('test/plist/array.bin', (1, ))]
+
+
+def readall(fname):
+    with open(fname, 'rb') as fd:
+        return fd.read()
+
+
+def bench(func, rounds):
+    return min(timeit.repeat(func, repeat=3, number=rounds)) * 1e6 / rounds
+
+
+def main(rounds):
+    print "%-22s %14s %14s %14s" % ("fixture", "full", "lazy", "xml")
+    for fname, path in FIXTURES:
+        data = readall(fname)
+        full = bench(lambda: read_binary_plist(data), rounds)
+        lazy = bench(lambda: open_binary_plist(data).get(path), rounds)
+        xml = write_xml_plist(read_binary_plist(data))
+        xmlfull = bench(lambda: read_xml_plist(xml), rounds)
+        print "%-22s %11.1f us %11.1f us %11.1f us" % \
+                (os.path.basename(fname), full, lazy, xmlfull)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
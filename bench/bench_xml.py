@@ -0,0 +1,66 @@
+"""Compare the available ElementTree backends on the test fixtures.
+
+Run from the top-level directory:
+
+    python bench/bench_xml.py [rounds]
+
+"""
+
+import os
+import sys
+import timeit
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from airpnp.xmlbackend import BACKENDS, load_backend
+
+FIXTURES = ['test/device_root.xml', 'test/service_scpd.xml', 'test/cds.xml']
+
+
+def readall(fname):
+    with open(fname) as fd:
+        return fd.read()
+
+
+def bench_fromstring(et, data, rounds):
+    return min(timeit.repeat(lambda: et.fromstring(data), repeat=3,
+                             number=rounds))
+
+
+def bench_iterparse(et, data, rounds):
+    def run():
+        for _ in et.iterparse(StringIO(data), ('start', )):
+            pass
+    return min(timeit.repeat(run, repeat=3, number=rounds))
+
+
+def bench_tostring(et, data, rounds):
+    elem = et.fromstring(data)
+    return min(timeit.repeat(lambda: et.tostring(elem), repeat=3,
+                             number=rounds))
+
+
+def main(rounds):
+    backends = []
+    for name in BACKENDS:
+        actual, et = load_backend(name)
+        if actual == name:
+            backends.append((name, et))
+
+    print "%-22s %-11s %s" % ("fixture", "operation",
+                              "  ".join("%14s" % n for n, _ in backends))
+    for fname in FIXTURES:
+        data = readall(fname)
+        for opname, op in [('fromstring', bench_fromstring),
+                           ('iterparse', bench_iterparse),
+                           ('tostring', bench_tostring)]:
+            times = [op(et, data, rounds) for _, et in backends]
+            cols = "  ".join("%11.1f us" % (t * 1e6 / rounds) for t in times)
+            if len(times) > 1 and times[0] > 0:
+                cols += "  (x%.1f)" % (times[-1] / times[0], )
+            print "%-22s %-11s %s" % (os.path.basename(fname), opname, cols)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
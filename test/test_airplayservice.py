@@ -2,9 +2,11 @@ import unittest
 import httplib
 import plistlib
 import os.path
-from mock import Mock
+from mock import Mock, patch
 from airpnp.AirPlayService import AirPlayService
-from airpnp.airplayserver import IAirPlayServer
+from airpnp.airplayserver import IAirPlayServer, PListResponse, \
+        PListResponseCache, PhotoRejectedError, negotiate_plist_type
+from airpnp.plist import read_binary_plist
 from cStringIO import StringIO
 from twisted.web import http, server
 from twisted.internet import defer
@@ -125,6 +127,32 @@ class TestAirPlayProtocol(unittest.TestCase):
         self.assertEqual(plist["features"], 0x77)
         self.assertEqual(plist["model"], "AppleTV2,1")
 
+    def test_server_info_binary_plist(self):
+        data = "GET /server-info HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "Accept: application/x-apple-binary-plist\r\n" + \
+                "Content-Length: 0\r\n\r\n"
+        self._send_data(data)
+
+        resp = self._get_response()
+        self.assertEqual(resp.getheader("Content-Type"),
+                         "application/x-apple-binary-plist")
+        plist = read_binary_plist(resp.read())
+        self.assertEqual(plist["deviceid"], "01:00:17:44:60:d2")
+        self.assertEqual(plist["features"], 0x77)
+
+    def test_playback_info_binary_plist(self):
+        self.apserver.get_scrub.return_value = defer.succeed((20.0, 2.0))
+        self.apserver.is_playing.return_value = defer.succeed(True)
+        data = "GET /playback-info HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "Accept: application/x-apple-binary-plist\r\n" + \
+                "Content-Length: 0\r\n\r\n"
+        self._send_data(data)
+
+        plist = read_binary_plist(self._get_response().read())
+        self.assertEqual(plist["position"], 2.0)
+        self.assertEqual(plist["rate"], 1.0)
+        self.assertEqual(plist["readyToPlay"], True)
+
     def test_play_with_strings_method_calls(self):
         data = "POST /play HTTP/1.1\r\nHost: www.example.com\r\n" + \
                 "Content-Length: 59\r\n\r\nStart-Position: 1.0\n" + \
@@ -133,6 +161,17 @@ class TestAirPlayProtocol(unittest.TestCase):
 
         self.apserver.play.assert_called_with("http://localhost/test", 1.0)
 
+    @patch('twisted.python.log.err')
+    def test_failure_of_postponed_play_is_logged(self, errMock):
+        self.apserver.play.return_value = defer.fail(ValueError())
+        data = "POST /play HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "Content-Length: 39\r\n\r\n" + \
+                "Content-Location: http://localhost/test"
+        self._send_data(data)
+
+        self.assertEqual(errMock.call_args[0][0].type, ValueError)
+        self.assertEqual(self._get_response().status, 200)
+
     def test_play_without_position_method_calls(self):
         data = "POST /play HTTP/1.1\r\nHost: www.example.com\r\n" + \
                 "Content-Length: 39\r\n\r\n" + \
@@ -174,6 +213,96 @@ class TestAirPlayProtocol(unittest.TestCase):
         self.assertEqual(args[0], "forwardEndTime")
         self.assertTrue("epoch" in args[1])
 
+    def test_play_with_text_plist_method_calls(self):
+        body = plistlib.writePlistToString({
+            "Content-Location": "http://localhost/test",
+            "Start-Position": 0.5})
+        data = "POST /play HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "Content-Type: text/x-apple-plist+xml\r\n" + \
+                "Content-Length: %d\r\n\r\n" % (len(body), )
+        data += body
+        self._send_data(data)
+
+        self.apserver.play.assert_called_with("http://localhost/test", 0.5)
+
+    def test_setProperty_with_text_plist_method_calls(self):
+        body = plistlib.writePlistToString({"value": {"epoch": 1}})
+        data = "PUT /setProperty?forwardEndTime HTTP/1.1\r\nHost: www.example.com\r\n" + \
+               "Content-Type: text/x-apple-plist+xml\r\n" + \
+               "Content-Length: %d\r\n\r\n" % (len(body), )
+        data += body
+        self._send_data(data)
+
+        self.apserver.set_property.assert_called_with("forwardEndTime",
+                                                      {"epoch": 1})
+
+    def test_photo_cache_only_method_calls(self):
+        data = "PUT /photo HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "X-Apple-AssetAction: cacheOnly\r\n" + \
+                "X-Apple-AssetKey: abc\r\nContent-Length: 4\r\n\r\ndata"
+        self._send_data(data)
+
+        self.assertFalse(self.apserver.photo.called)
+        args = self.apserver.cache_photo.call_args[0]
+        self.assertEqual(args[0], "abc")
+
+    def test_photo_response_waits_until_photo_is_read(self):
+        reading = defer.Deferred()
+        self.apserver.photo.return_value = reading
+        data = "PUT /photo HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "Content-Length: 4\r\n\r\ndata"
+        self._send_data(data)
+
+        self.assertEqual(self.proto.transport.value(), "")
+        reading.callback("abc.jpg")
+        self.assertEqual(self._get_response().status, 200)
+
+    def test_photo_without_room_is_unavailable(self):
+        self.apserver.cache_photo.return_value = \
+                defer.fail(PhotoRejectedError("full"))
+        data = "PUT /photo HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "X-Apple-AssetAction: cacheOnly\r\n" + \
+                "X-Apple-AssetKey: abc\r\nContent-Length: 4\r\n\r\ndata"
+        self._send_data(data)
+
+        self.assertEqual(self._get_response().status, 503)
+
+    def test_photo_display_cached_method_calls(self):
+        self.apserver.show_cached_photo.return_value = True
+        data = "PUT /photo HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "X-Apple-AssetAction: displayCached\r\n" + \
+                "X-Apple-AssetKey: abc\r\nX-Apple-Transition: Dissolve\r\n" + \
+                "Content-Length: 0\r\n\r\n"
+        self._send_data(data)
+
+        self.apserver.show_cached_photo.assert_called_with("abc", "Dissolve")
+        self.assertEqual(self._get_response().status, 200)
+
+    def test_photo_display_unknown_cached_precondition_failed(self):
+        self.apserver.show_cached_photo.return_value = False
+        data = "PUT /photo HTTP/1.1\r\nHost: www.example.com\r\n" + \
+                "X-Apple-AssetAction: displayCached\r\n" + \
+                "X-Apple-AssetKey: abc\r\nContent-Length: 0\r\n\r\n"
+        self._send_data(data)
+
+        self.assertEqual(self._get_response().status, 412)
+
+    def test_playback_info_is_encoded_once_while_paused(self):
+        with patch("airpnp.airplayserver.write_xml_plist") as write:
+            write.return_value = ""
+            self._send_playback_info((20.0, 2.0), False)
+            self._send_playback_info((20.0, 2.0), False)
+
+        self.assertEqual(write.call_count, 1)
+
+    def test_playback_info_is_encoded_per_request_while_playing(self):
+        with patch("airpnp.airplayserver.write_xml_plist") as write:
+            write.return_value = ""
+            self._send_playback_info((20.0, 2.0), True)
+            self._send_playback_info((20.0, 2.0), True)
+
+        self.assertEqual(write.call_count, 2)
+
     def _send_playback_info(self, get_scrub_response, is_playing_response):
         self.apserver.get_scrub.return_value = defer.succeed(get_scrub_response)
         self.apserver.is_playing.return_value = defer.succeed(is_playing_response)
@@ -189,6 +318,55 @@ class TestAirPlayProtocol(unittest.TestCase):
         return resp
 
 
+class TestNegotiatePListType(unittest.TestCase):
+
+    def test_xml_without_accept(self):
+        self.assertEqual(negotiate_plist_type(None), "text/x-apple-plist+xml")
+
+    def test_xml_for_wildcard(self):
+        self.assertEqual(negotiate_plist_type("*/*"), "text/x-apple-plist+xml")
+
+    def test_binary_when_accepted(self):
+        ctype = negotiate_plist_type("application/x-apple-binary-plist")
+        self.assertEqual(ctype, "application/x-apple-binary-plist")
+
+    def test_quality_is_respected(self):
+        accept = "application/x-apple-binary-plist;q=0.5, text/x-apple-plist+xml"
+        self.assertEqual(negotiate_plist_type(accept), "text/x-apple-plist+xml")
+
+    def test_xml_on_tie(self):
+        accept = "application/x-apple-binary-plist, text/x-apple-plist+xml"
+        self.assertEqual(negotiate_plist_type(accept), "text/x-apple-plist+xml")
+
+
+class TestPListResponse(unittest.TestCase):
+
+    def test_encoded_once_per_type(self):
+        response = PListResponse({"a": 1})
+        first = response.encode("application/x-apple-binary-plist")
+        second = response.encode("application/x-apple-binary-plist")
+
+        self.assertTrue(first is second)
+
+    def test_cache_reuses_response_for_same_state(self):
+        build = Mock(return_value={"a": 1})
+        cache = PListResponseCache(build)
+        first = cache.get((1.0, False))
+        second = cache.get((1.0, False))
+
+        self.assertTrue(first is second)
+        self.assertEqual(build.call_count, 1)
+
+    def test_cache_rebuilds_on_state_change(self):
+        build = Mock(return_value={"a": 1})
+        cache = PListResponseCache(build)
+        first = cache.get((1.0, False))
+        second = cache.get((1.0, True))
+
+        self.assertFalse(first is second)
+        build.assert_called_with(1.0, True)
+
+
 class FakeSock(object):
 
     def __init__(self, data):
@@ -0,0 +1,48 @@
+import unittest
+from airpnp.backoff import RetryBackoff
+from airpnp.ignore_list import HTTP_ERROR, NETWORK_ERROR
+
+
+class TestRetryBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = 1.0
+        self.backoff = RetryBackoff({HTTP_ERROR: (10, 50),
+                                     NETWORK_ERROR: (2, 100)}, 2,
+                                    lambda: self.rand)
+
+    def test_first_delay_depends_on_category(self):
+        self.assertEqual(self.backoff.failed("uuid:1", HTTP_ERROR), 10)
+        self.assertEqual(self.backoff.failed("uuid:2", NETWORK_ERROR), 2)
+
+    def test_delay_doubles_for_each_failure(self):
+        delays = [self.backoff.failed("uuid:1", HTTP_ERROR) for _ in range(3)]
+        self.assertEqual(delays, [10, 20, 40])
+
+    def test_delay_is_capped(self):
+        for _ in range(10):
+            delay = self.backoff.failed("uuid:1", HTTP_ERROR)
+        self.assertEqual(delay, 50)
+
+    def test_delay_is_jittered_down_to_half(self):
+        self.rand = 0.0
+        self.assertEqual(self.backoff.failed("uuid:1", HTTP_ERROR), 5)
+
+    def test_success_resets_failures(self):
+        self.backoff.failed("uuid:1", HTTP_ERROR)
+        self.backoff.failed("uuid:1", HTTP_ERROR)
+        self.backoff.succeeded("uuid:1")
+
+        self.assertEqual(self.backoff.failure_count("uuid:1"), 0)
+        self.assertEqual(self.backoff.failed("uuid:1", HTTP_ERROR), 10)
+
+    def test_devices_are_tracked_separately(self):
+        self.backoff.failed("uuid:1", HTTP_ERROR)
+        self.assertEqual(self.backoff.failed("uuid:2", HTTP_ERROR), 10)
+
+    def test_least_recently_failed_device_is_forgotten(self):
+        self.backoff.failed("uuid:1", HTTP_ERROR)
+        self.backoff.failed("uuid:2", HTTP_ERROR)
+        self.backoff.failed("uuid:3", HTTP_ERROR)
+        self.assertEqual(self.backoff.failure_count("uuid:1"), 0)
+        self.assertEqual(self.backoff.failure_count("uuid:3"), 1)
@@ -1,10 +1,23 @@
 import unittest
+import httplib
+import time
 import mock
-from airpnp.bridge import AVControlPoint
-from twisted.internet import defer
+from airpnp.airplayserver import PhotoRejectedError
+from airpnp.bridge import AVControlPoint, PhotoStoreResource, PhotoWeb
+from airpnp.device import CommandError
+from airpnp.imaging import PhotoScaler
+from airpnp.photostore import PhotoStore, photo_digest
+from cStringIO import StringIO
+from airpnp.ratelimit import SoapBudget
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import StringTransport
+from twisted.web import http, server
 
 
-class TestAVControlPoint(unittest.TestCase):
+class AVControlPointTestCase(unittest.TestCase):
+    """Base class for AVControlPoint tests, with a device that has mock
+    AVTransport and ConnectionManager services. Subclasses adjust the
+    services before they create the control point."""
 
     def setUp(self):
         # Setup AVTransport service
@@ -17,8 +30,16 @@ class TestAVControlPoint(unittest.TestCase):
         self.connmgr.serviceId = 'urn:upnp-org:serviceId:ConnectionManager'
         self.connmgr.serviceType = 'urn:schemas-upnp-org:service:ConnectionManager:1'
 
+        self.device = self.create_device()
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.clear()
+
+    def create_device(self):
         def gsbyid(id):
-            all = [self.avtransport, self.conngr]
+            all = [self.avtransport, self.connmgr]
             match = [s for s in all if s.serviceId == id]
             if len(match) == 1:
                 return match[0]
@@ -27,15 +48,35 @@ class TestAVControlPoint(unittest.TestCase):
         device = mock.MagicMock()
         device.__getitem__ = mock.Mock(side_effect=gsbyid)
         device.__iter__.return_value = [self.avtransport, self.connmgr]
-        self.avcp = AVControlPoint(device, None, "127.0.0.1")
+        return device
+
+    def create_photoweb(self):
+        """Return a mock PhotoWeb that publishes photos in self.store."""
+        self.store = PhotoStore()
+        photoweb = mock.Mock(wraps=PhotoWeb(0, 5, "127.0.0.1", self.store))
+        photoweb.port = 8080
+        return photoweb
 
-        # mock away instance ID business since these methods check for 
+    def create_control_point(self, photoweb=None, budget=None,
+                             instance_id="0", device=None, **kwargs):
+        avcp = AVControlPoint(device or self.device, photoweb, "127.0.0.1",
+                              budget, **kwargs)
+
+        # mock away instance ID business since these methods check for
         # attributes that will be auto-added by the mock service.
-        self.avcp.allocate_instance_id = mock.Mock(return_value="0")
-        self.avcp.release_instance_id = mock.Mock()
+        avcp.allocate_instance_id = mock.Mock(return_value=instance_id)
+        avcp.release_instance_id = mock.Mock()
 
         # suppress logging
-        self.avcp.msg = lambda *args: None
+        avcp.msg = lambda *args: None
+        return avcp
+
+
+class TestAVControlPoint(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        self.avcp = self.create_control_point()
 
     def test_get_scrub_without_uri(self):
         # Deferred.result
@@ -123,3 +164,563 @@ class TestAVControlPoint(unittest.TestCase):
                                                  Unit="REL_TIME",
                                                  Target="0:00:05.000")
 
+
+
+class TestAVControlPointBudget(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        self.clock = task.Clock()
+        self.budget = SoapBudget(0, 1.0, clock=self.clock)
+        self.avcp = self.create_control_point(budget=self.budget)
+
+        state = {"CurrentTransportState": "PLAYING"}
+        self.avtransport.GetTransportInfo.return_value = defer.succeed(state)
+
+    def test_play_registers_session(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.assertEqual(self.budget.session_count(), 1)
+
+    def test_play_accounts_for_polled_actions(self):
+        budget = SoapBudget(1, clock=self.clock)
+        avcp = self.create_control_point(budget=budget)
+        avcp.play("http://www.example.com/video.avi", 0.0)
+        self.assertEqual(budget.poll_interval(), 2.0)
+
+    def test_photo_does_not_register_session(self):
+        self.avcp._photoweb = self.create_photoweb()
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.assertEqual(self.budget.session_count(), 0)
+
+    def test_stop_unregisters_session(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.stop()
+        self.assertEqual(self.budget.session_count(), 0)
+
+    def test_close_unregisters_session(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.close()
+        self.assertEqual(self.budget.session_count(), 0)
+
+    def test_close_releases_instance_id(self):
+        self.avcp.close()
+        self.avcp.release_instance_id.assert_called_with("0")
+
+    def test_closed_control_point_does_not_poll(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.close()
+
+        self.assertFalse(self.avcp.is_playing().result)
+        self.assertFalse(self.avtransport.GetTransportInfo.called)
+
+    def test_poll_within_interval_returns_cached_status(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.is_playing()
+        playing = self.avcp.is_playing().result
+
+        self.assertEqual(self.avtransport.GetTransportInfo.call_count, 1)
+        self.assertTrue(playing)
+
+    def test_poll_after_interval_queries_renderer(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.is_playing()
+        self.clock.advance(1.0)
+        self.avcp.is_playing()
+
+        self.assertEqual(self.avtransport.GetTransportInfo.call_count, 2)
+
+    def test_new_uri_invalidates_cached_status(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.is_playing()
+        self.avcp.play("http://www.example.com/other.avi", 0.0)
+        self.avcp.is_playing()
+
+        self.assertEqual(self.avtransport.GetTransportInfo.call_count, 2)
+
+
+class TestAVControlPointLazyServices(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        self.avtransport.is_initialized.return_value = False
+        self.loading = defer.Deferred()
+        self.avtransport.ensure_initialized.return_value = self.loading
+        self.avcp = self.create_control_point()
+
+    def test_uninitialized_services_are_initialized(self):
+        self.assertTrue(self.avtransport.ensure_initialized.called)
+        self.assertFalse(self.connmgr.ensure_initialized.called)
+
+    def test_calls_are_postponed_until_services_are_initialized(self):
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+
+        self.loading.callback(self.avtransport)
+        self.assertTrue(self.avtransport.SetAVTransportURI.called)
+
+    def test_postponed_call_returns_result(self):
+        d = self.avcp.is_playing()
+        self.loading.callback(self.avtransport)
+
+        self.assertEqual(d.result, False)
+
+    @mock.patch('twisted.python.log.err')
+    def test_postponed_call_fails_if_initialization_fails(self, errMock):
+        d = self.avcp.is_playing()
+        self.loading.errback(ValueError())
+
+        err = [None]
+        d.addErrback(lambda x: err.__setitem__(0, x))
+        self.assertEqual(err[0].type, ValueError)
+
+    @mock.patch('twisted.python.log.err')
+    def test_call_fails_if_initialization_fails_right_away(self, errMock):
+        self.loading.errback(ValueError())
+        self.avtransport.ensure_initialized.return_value = \
+                defer.fail(ValueError())
+        d = self.avcp.play("http://www.example.com/video.avi", 0.0)
+
+        err = []
+        d.addErrback(err.append)
+        self.assertEqual(err[0].type, ValueError)
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+
+    def test_photo_is_published_before_services_are_initialized(self):
+        self.avcp._photoweb = self.create_photoweb()
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        self.assertEqual(len(self.store), 1)
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+
+        self.loading.callback(self.avtransport)
+        self.assertTrue(self.avtransport.SetAVTransportURI.called)
+
+
+class TestAVControlPointPhoto(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        del self.avtransport.SetNextAVTransportURI
+        self.photoweb = self.create_photoweb()
+        self.avcp = self.create_control_point(self.photoweb)
+
+    def test_photo_is_named_by_contents(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        self.assertTrue(photo_digest("\xff\xd8\x00") + ".jpg" in self.store)
+
+    def test_same_photo_again_is_a_no_op(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        name = photo_digest("\xff\xd8\x00") + ".jpg"
+        self.assertEqual(self.store.get(name).refs, 1)
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 1)
+        self.assertEqual(self.avtransport.Play.call_count, 1)
+
+    def test_same_photo_after_media_is_shown_again(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        uri = self.avtransport.SetAVTransportURI.call_args[1]['CurrentURI']
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 3)
+        self.assertEqual(self.avcp._uri, uri)
+        self.assertTrue(uri.endswith(photo_digest("\xff\xd8\x00") + ".jpg"))
+
+    def test_play_unpublishes_photo(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.play("http://www.example.com/video.avi", 0.0)
+
+        self.assertEqual(len(self.store), 0)
+
+    def test_photo_without_room_is_rejected(self):
+        self.store.memory_budget = self.store.disk_budget = 0
+        d = self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        result = []
+        d.addErrback(result.append)
+        self.assertTrue(result[0].check(PhotoRejectedError))
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+
+    def test_photo_read_while_stopping_is_not_shown(self):
+        reading = defer.Deferred()
+        self.photoweb.publish.side_effect = lambda *args: reading
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.stop()
+        reading.callback("abc.jpg")
+
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+        self.photoweb.unpublish.assert_called_with("abc.jpg")
+
+    def test_other_photo_replaces_previous(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 2)
+
+    def test_photo_is_shared_between_control_points(self):
+        other = self.create_control_point(self.photoweb, instance_id="1",
+                                          device=self.create_device())
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        other.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+
+        self.assertEqual(len(self.store), 2)
+
+
+class TestAVControlPointNextPhoto(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        self.photoweb = self.create_photoweb()
+        self.avcp = self.create_control_point(self.photoweb)
+
+    def next_uri(self):
+        return self.avtransport.SetNextAVTransportURI.call_args[1]['NextURI']
+
+    def test_cached_photo_is_not_queued_before_a_photo_is_shown(self):
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x00"))
+
+        self.assertFalse(self.avtransport.SetNextAVTransportURI.called)
+
+    def test_cached_photo_is_queued_while_a_photo_is_shown(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+
+        name = photo_digest("\xff\xd8\x01") + ".jpg"
+        self.assertTrue(self.next_uri().endswith("/" + name))
+
+    def test_queued_photo_is_shown_with_next(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+        self.assertTrue(self.avcp.show_cached_photo("a", None))
+
+        self.assertEqual(self.avtransport.SetNextAVTransportURI.call_count, 1)
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 1)
+        self.assertTrue(self.avtransport.Next.called)
+        self.assertEqual(len(self.store), 1)
+
+    def test_oldest_cached_photo_is_queued_after_next(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+        self.avcp.cache_photo("b", StringIO("\xff\xd8\x02"))
+        self.avcp.show_cached_photo("a", None)
+
+        name = photo_digest("\xff\xd8\x02") + ".jpg"
+        self.assertTrue(self.next_uri().endswith("/" + name))
+
+    def test_new_photo_is_shown_with_next(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 1)
+        self.assertEqual(self.avtransport.Next.call_count, 1)
+
+    def test_unknown_cached_photo(self):
+        self.assertFalse(self.avcp.show_cached_photo("a", None))
+
+    def test_cache_is_bounded(self):
+        for i in range(5):
+            self.avcp.cache_photo(str(i), StringIO("\xff\xd8" + chr(i)))
+
+        self.assertEqual(len(self.store), 3)
+        self.assertFalse(self.avcp.show_cached_photo("0", None))
+
+    def test_stop_discards_cached_photos(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+        self.avcp._uri = "http://127.0.0.1:8080/x"
+        self.avcp.stop()
+
+        self.assertEqual(len(self.store), 0)
+
+    def test_failing_next_falls_back_to_set(self):
+        self.avtransport.Next.side_effect = CommandError("fail", None)
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 2)
+
+    def test_failing_set_next_is_not_tried_again(self):
+        self.avtransport.SetNextAVTransportURI.side_effect = \
+                CommandError("fail", None)
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+        self.avcp.cache_photo("b", StringIO("\xff\xd8\x02"))
+
+        self.assertEqual(self.avtransport.SetNextAVTransportURI.call_count, 1)
+
+    def test_play_clears_queued_photo(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.cache_photo("a", StringIO("\xff\xd8\x01"))
+        self.avcp.play("http://localhost/movie.mp4", 0.0)
+
+        self.assertEqual(self.next_uri(), '')
+
+
+class TestAVControlPointPhotoScaling(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        del self.avtransport.SetNextAVTransportURI
+        self.connmgr.GetProtocolInfo.return_value = defer.succeed(
+            {'Sink': 'http-get:*:image/jpeg:DLNA.ORG_PN=JPEG_MED'})
+        self.store = PhotoStore()
+        self.photoweb = PhotoWeb(0, 5, "127.0.0.1", self.store)
+        self.photoweb._port = mock.Mock()
+        self.photoweb._port.getHost.return_value.port = 8080
+        self.jobs = []
+        self.scaler = PhotoScaler(self.store, run=self.run_job,
+                                  scale_func=lambda *args: "scaled")
+        self.avcp = self.create_control_point(self.photoweb,
+                                              scaler=self.scaler,
+                                              photo_target=(1920, 1080, 0))
+
+    def run_job(self, func, *args):
+        d = defer.Deferred()
+        self.jobs.append((d, func, args))
+        return d
+
+    def finish_jobs(self):
+        for d, func, args in self.jobs:
+            d.callback(func(*args))
+        self.jobs = []
+
+    def test_photo_target_is_learned_from_protocol_info(self):
+        self.assertEqual(self.avcp._photo_target, (1024, 768, 0))
+
+    def test_scaled_photo_is_shown(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+        self.finish_jobs()
+
+        uri = self.avtransport.SetAVTransportURI.call_args[1]['CurrentURI']
+        name = uri.rsplit('/', 1)[1]
+        self.assertEqual(self.store.get(name).data, "scaled")
+
+    def test_original_is_discarded_after_scaling(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.finish_jobs()
+
+        self.assertEqual(len(self.store), 1)
+
+    def test_stale_scaled_photo_is_not_shown(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+        self.finish_jobs()
+
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 1)
+        # the stale scaled photo is only held by the scaler
+        refs = sorted(p.refs for p in self.store._photos.values())
+        self.assertEqual(refs, [1, 2])
+
+    def test_stop_releases_scaled_photo(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.finish_jobs()
+        self.avcp.stop()
+
+        # only the scaler holds on to the scaled photo
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.get(self.store._photos.keys()[0]).refs, 1)
+
+    def test_photo_shown_again_is_not_scaled_again(self):
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+        self.finish_jobs()
+        self.avcp.photo(StringIO("\xff\xd8\x01"), None)
+        self.finish_jobs()
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        self.assertEqual(self.jobs, [])
+        self.assertEqual(self.avtransport.SetAVTransportURI.call_count, 3)
+
+
+class TestAVControlPointRelay(AVControlPointTestCase):
+
+    def setUp(self):
+        AVControlPointTestCase.setUp(self)
+        del self.avtransport.SetNextAVTransportURI
+        self.relay = mock.Mock()
+        self.relayed = "http://127.0.0.1:8081/abc.mp4"
+        self.relay.relay.side_effect = lambda url: defer.succeed(self.relayed)
+        self.photoweb = self.create_photoweb()
+        self.avcp = self.create_control_point(self.photoweb, relay=self.relay)
+
+    def test_play_uses_relayed_uri(self):
+        self.avcp.play("http://phone/movie.mp4", 0.0)
+
+        self.relay.relay.assert_called_with("http://phone/movie.mp4")
+        uri = self.avtransport.SetAVTransportURI.call_args[1]['CurrentURI']
+        self.assertEqual(uri, "http://127.0.0.1:8081/abc.mp4")
+
+    def test_play_uses_original_uri_if_not_relayed(self):
+        self.relayed = "http://phone/live"
+        self.avcp.play("http://phone/live", 0.0)
+        self.avcp.stop()
+
+        uri = self.avtransport.SetAVTransportURI.call_args[1]['CurrentURI']
+        self.assertEqual(uri, "http://phone/live")
+        self.assertFalse(self.relay.release.called)
+
+    def test_stop_while_relay_is_probing(self):
+        probing = defer.Deferred()
+        self.relay.relay.side_effect = lambda url: probing
+        self.avcp.play("http://phone/movie.mp4", 0.0)
+        self.avcp.stop()
+        probing.callback("http://127.0.0.1:8081/abc.mp4")
+
+        self.assertFalse(self.avtransport.SetAVTransportURI.called)
+        self.relay.release.assert_called_with("http://127.0.0.1:8081/abc.mp4")
+
+    def test_stop_releases_media(self):
+        self.avcp.play("http://phone/movie.mp4", 0.0)
+        self.avcp.stop()
+
+        self.relay.release.assert_called_with("http://127.0.0.1:8081/abc.mp4")
+
+    def test_play_releases_previous_media(self):
+        self.avcp.play("http://phone/movie.mp4", 0.0)
+        self.avcp.play("http://phone/other.mp4", 0.0)
+
+        self.assertEqual(self.relay.release.call_count, 1)
+
+    def test_photo_releases_media(self):
+        self.avcp.play("http://phone/movie.mp4", 0.0)
+        self.avcp.photo(StringIO("\xff\xd8\x00"), None)
+
+        self.assertTrue(self.relay.release.called)
+
+
+class TestPhotoStoreResource(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PhotoStore(memory_budget=100)
+        self.proto = http.HTTPChannel()
+        self.proto.requestFactory = server.Request
+        self.proto.site = server.Site(PhotoStoreResource(self.store))
+        self.proto.makeConnection(StringTransport())
+
+    def tearDown(self):
+        self.store.clear()
+
+    def get(self, name, method="GET", **headers):
+        data = "%s /%s HTTP/1.1\r\nHost: www.example.com\r\n" % (method, name)
+        for key, value in headers.items():
+            data += "%s: %s\r\n" % (key.replace("_", "-"), value)
+        self.proto.dataReceived(data + "\r\n")
+        # pull data from the producer, if any
+        transport = self.proto.transport
+        while transport.producer is not None:
+            transport.producer.resumeProducing()
+        resp = httplib.HTTPResponse(FakeSock(transport.value()),
+                                    method=method)
+        resp.begin()
+        return resp
+
+    def test_photo_in_memory(self):
+        self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('a.jpg')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Type"), "image/jpeg")
+        self.assertEqual(resp.read(), 'x' * 10)
+
+    def test_spilled_photo(self):
+        self.store.add('a.jpg', 'image/jpeg', 'y' * 70000)
+        resp = self.get('a.jpg')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read(), 'y' * 70000)
+
+    def test_unknown_photo(self):
+        resp = self.get('b.jpg')
+
+        self.assertEqual(resp.status, 404)
+
+    def test_etag_is_name(self):
+        self.store.add('abc.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('abc.jpg')
+
+        self.assertEqual(resp.getheader("ETag"), '"abc"')
+
+    def test_if_none_match(self):
+        self.store.add('abc.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('abc.jpg', If_None_Match='"xyz", "abc"')
+
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.read(), '')
+
+    def test_if_none_match_takes_precedence(self):
+        self.store.add('abc.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('abc.jpg', If_None_Match='"xyz"',
+                        If_Modified_Since=http.datetimeToString(time.time() + 60))
+
+        self.assertEqual(resp.status, 200)
+
+    def test_if_modified_since(self):
+        self.store.add('abc.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('abc.jpg',
+                        If_Modified_Since=http.datetimeToString(time.time() + 60))
+
+        self.assertEqual(resp.status, 304)
+
+    def test_modified_since(self):
+        self.store.add('abc.jpg', 'image/jpeg', 'x' * 10)
+        resp = self.get('abc.jpg',
+                        If_Modified_Since=http.datetimeToString(time.time() - 60))
+
+        self.assertEqual(resp.status, 200)
+
+    def test_range(self):
+        self.store.add('a.jpg', 'image/jpeg', '0123456789')
+        resp = self.get('a.jpg', Range='bytes=2-4')
+
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.getheader("Content-Range"), "bytes 2-4/10")
+        self.assertEqual(resp.read(), '234')
+
+    def test_range_of_spilled_photo(self):
+        self.store.add('a.jpg', 'image/jpeg', '0123456789' * 7000)
+        resp = self.get('a.jpg', Range='bytes=-5')
+
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.read(), '56789')
+
+    def test_unsatisfiable_range(self):
+        self.store.add('a.jpg', 'image/jpeg', '0123456789')
+        resp = self.get('a.jpg', Range='bytes=20-')
+
+        self.assertEqual(resp.status, 416)
+        self.assertEqual(resp.getheader("Content-Range"), "bytes */10")
+
+    def test_if_range_mismatch_gives_whole_photo(self):
+        self.store.add('a.jpg', 'image/jpeg', '0123456789')
+        resp = self.get('a.jpg', Range='bytes=2-4', If_Range='"other"')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read(), '0123456789')
+
+    def test_head(self):
+        self.store.add('a.jpg', 'image/jpeg', '0123456789')
+        resp = self.get('a.jpg', method="HEAD")
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Length"), "10")
+        self.assertEqual(self.proto.transport.value().split("\r\n\r\n", 1)[1], '')
+
+    def test_removed_photo_is_still_served_by_pending_request(self):
+        photo = self.store.add('a.jpg', 'image/jpeg', 'z' * 70000)
+        buf = photo.buffer()
+        self.store.remove('a.jpg')
+
+        self.assertEqual(buf[:3], 'zzz')
+
+
+class FakeSock(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode, bufsize=0):
+        return StringIO(self.data)
@@ -34,6 +34,10 @@ class TestDevice(unittest.TestCase):
         with self.assertRaises(NameError):
             device.modelBlob
 
+    def test_device_does_not_keep_xml(self):
+        self.assertFalse(hasattr(self.device, '__dict__'))
+        self.assertFalse(hasattr(self.device, 'element'))
+
     def test_service_count(self):
         device = self.device
         services = [s for s in device]
@@ -75,6 +79,15 @@ class TestService(unittest.TestCase):
         self.assertEqual(service.controlURL, 'http://www.base.com/MediaRenderer_AVTransport/control')
         self.assertEqual(service.eventSubURL, 'http://www.base.com/MediaRenderer_AVTransport/event')
 
+    def test_service_action_lookup(self):
+        action = self.service.actions['GetCurrentTransportActions']
+        self.assertIs(self.service.GetCurrentTransportActions, action)
+
+    def test_service_action_arguments(self):
+        action = self.service.actions['GetCurrentTransportActions']
+        self.assertEqual([a.name for a in action.inargs], ['InstanceID'])
+        self.assertEqual([a.name for a in action.outargs], ['Actions'])
+
     def test_service_action_existence(self):
         self.assertTrue(hasattr(self.service, 'GetCurrentTransportActions'))
 
@@ -157,3 +170,140 @@ class TestService(unittest.TestCase):
         ret.callback(response)
         self.assertEqual(actual.result, {"Actions": "test"})
 
+
+
+class TestServiceLoading(unittest.TestCase):
+
+    def setUp(self):
+        f = open('test/device_root.xml', 'r')
+        elem = ElementTree.parse(f)
+        self.device = Device(elem, 'http://www.base.com')
+        self.service = self.device['urn:upnp-org:serviceId:AVTransport']
+
+        self.loading = defer.Deferred()
+        self.loader = mock.Mock(return_value=self.loading)
+        self.service.set_loader(self.loader)
+
+    def _initialize(self, _=None):
+        f = open('test/service_scpd.xml', 'r')
+        self.service.initialize(ElementTree.parse(f), mock.Mock())
+
+    def test_service_with_loader_is_not_initialized(self):
+        self.assertFalse(self.service.is_initialized())
+
+    def test_service_without_loader_is_initialized(self):
+        service = self.device['urn:upnp-org:serviceId:ConnectionManager']
+        self.assertTrue(service.is_initialized())
+
+    def test_ensure_initialized_calls_loader(self):
+        self.service.ensure_initialized()
+        self.loader.assert_called_with(self.service)
+
+    def test_concurrent_calls_share_loader(self):
+        self.service.ensure_initialized()
+        self.service.ensure_initialized()
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_ensure_initialized_fires_with_service(self):
+        d1 = self.service.ensure_initialized()
+        d2 = self.service.ensure_initialized()
+        self.loading.addCallback(self._initialize)
+        self.loading.callback(None)
+
+        self.assertIs(d1.result, self.service)
+        self.assertIs(d2.result, self.service)
+        self.assertTrue(hasattr(self.service, 'GetCurrentTransportActions'))
+
+    def test_failed_load_is_retried(self):
+        d = self.service.ensure_initialized()
+        d.addErrback(lambda _: None)
+        self.loading.errback(ValueError())
+        self.service.ensure_initialized()
+
+        self.assertEqual(self.loader.call_count, 2)
+
+
+class TestDeviceUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.device = self._create_device('http://www.base.com')
+        self.service = self.device['urn:upnp-org:serviceId:AVTransport']
+        self._initialize(self.service)
+        self.action = self.service.GetCurrentTransportActions
+
+        self.newer = self._create_device('http://www.base.com:8080')
+
+    def _create_device(self, base_url):
+        f = open('test/device_root.xml', 'r')
+        return Device(ElementTree.parse(f), base_url)
+
+    def _initialize(self, service):
+        f = open('test/service_scpd.xml', 'r')
+        service.initialize(ElementTree.parse(f), mock.Mock())
+
+    def test_base_url_is_updated(self):
+        self.device.update(self.newer)
+        self.assertEqual(self.device.get_base_url(), 'http://www.base.com:8080')
+
+    def test_service_objects_are_kept(self):
+        self.device.update(self.newer)
+        self.assertIs(self.device['urn:upnp-org:serviceId:AVTransport'],
+                      self.service)
+
+    def test_service_urls_are_updated(self):
+        self.device.update(self.newer)
+        self.assertEqual(self.service.controlURL,
+                         'http://www.base.com:8080/MediaRenderer_AVTransport/control')
+
+    def test_actions_are_kept_if_config_is_unchanged(self):
+        self.device.update(self.newer, True)
+        self.assertIs(self.service.GetCurrentTransportActions, self.action)
+
+    def test_actions_are_replaced_if_config_has_changed(self):
+        newer_service = self.newer['urn:upnp-org:serviceId:AVTransport']
+        self._initialize(newer_service)
+        self.device.update(self.newer)
+
+        action = self.service.GetCurrentTransportActions
+        self.assertIsNot(action, self.action)
+        self.assertIs(action.service, self.service)
+
+    def test_uninitialized_service_takes_new_loader(self):
+        newer_service = self.newer['urn:upnp-org:serviceId:AVTransport']
+        loader = mock.Mock(return_value=defer.Deferred())
+        newer_service.set_loader(loader)
+        self.device.update(self.newer)
+
+        self.assertFalse(self.service.is_initialized())
+        self.service.ensure_initialized()
+        loader.assert_called_with(self.service)
+
+    def test_new_service_is_added(self):
+        del self.device._services['urn:upnp-org:serviceId:RenderingControl']
+        self.device.update(self.newer)
+
+        service = self.device['urn:upnp-org:serviceId:RenderingControl']
+        self.assertIs(service.device, self.device)
+
+    def test_removed_service_is_removed(self):
+        del self.newer._services['urn:upnp-org:serviceId:RenderingControl']
+        self.device.update(self.newer)
+
+        self.assertEqual(len(list(self.device)), 2)
+
+    def test_pending_load_finishes_before_actions_are_replaced(self):
+        device = self._create_device('http://www.base.com')
+        service = device['urn:upnp-org:serviceId:AVTransport']
+        loading = defer.Deferred()
+        service.set_loader(lambda s: loading)
+        d = service.ensure_initialized()
+        newer_service = self.newer['urn:upnp-org:serviceId:AVTransport']
+        self._initialize(newer_service)
+        device.update(self.newer)
+        loading.addCallback(lambda _: self._initialize(service))
+        loading.callback(None)
+
+        self.assertIs(d.result, service)
+        self.assertIs(service.actions, newer_service.actions)
+        self.assertIs(service.GetCurrentTransportActions.service, service)
+        self.assertTrue(service.is_initialized())
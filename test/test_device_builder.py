@@ -1,8 +1,11 @@
 import unittest
 import os
+import threading
 from mock import patch, Mock
 from airpnp.device_builder import *
-from twisted.internet import defer
+from airpnp.device_builder import parse_scpd
+from airpnp.xmlbackend import ET
+from twisted.internet import defer, task
 from twisted.python import failure
 from twisted.web import error, http
 
@@ -10,6 +13,15 @@ def readall(fn):
     with open(os.path.join(os.path.dirname(__file__), fn), 'r') as fd:
         return fd.read()
 
+def fake_stream_page(url, consumer, timeout=0):
+    """Stream the page returned by the (patched) getPage to the consumer."""
+    def feed(data):
+        consumer.feed(data)
+        return consumer.close()
+    from twisted.web import client
+    return client.getPage(url, timeout=timeout).addCallback(feed)
+
+@patch('airpnp.device_builder.stream_page', fake_stream_page)
 @patch('twisted.web.client.getPage')
 class TestDeviceBuilder(unittest.TestCase):
 
@@ -61,6 +73,66 @@ class TestDeviceBuilder(unittest.TestCase):
         # A pretty arbitrary assertion on the Device object
         self.assertEqual(actual.result.friendlyName, "pyupnp sample")
 
+    def test_lazy_build_doesnt_fetch_services(self, pageMock):
+        pageMock.return_value = defer.succeed(readall('ms.xml'))
+        builder = DeviceBuilder(Mock(), lambda x: (True, None), lazy=True)
+        actual = builder.build('')
+
+        self.assertEqual(pageMock.call_count, 1)
+        self.assertFalse([s for s in actual.result if s.is_initialized()])
+
+    def test_lazy_build_fetches_service_on_demand(self, pageMock):
+        pageMock.return_value = defer.succeed(readall('ms.xml'))
+        builder = DeviceBuilder(Mock(), lambda x: (True, None), lazy=True)
+        device = builder.build('').result
+
+        pageMock.return_value = defer.succeed(readall('cds.xml'))
+        service = [s for s in device][0]
+        service.ensure_initialized()
+
+        self.assertTrue(service.is_initialized())
+        self.assertTrue(service.actions)
+
+    @patch('twisted.internet.threads.deferToThreadPool')
+    def test_service_is_initialized_outside_parser_thread(self, deferMock,
+                                                          pageMock):
+        parsed = defer.Deferred()
+        def defer_to_pool(reactor, pool, func, *args):
+            if func is parse_scpd:
+                return parsed
+            return defer.succeed(func(*args))
+        deferMock.side_effect = defer_to_pool
+        pool = ParserPool(threshold=0)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        pageMock.return_value = defer.succeed(readall('ms.xml'))
+        builder = DeviceBuilder(Mock(), lambda x: (True, None), parser=pool,
+                                lazy=True)
+        device = builder.build('').result
+        pageMock.return_value = defer.succeed(readall('cds.xml'))
+        service = [s for s in device][0]
+        service.ensure_initialized()
+
+        # what runs in the thread must leave the service alone
+        func, args = deferMock.call_args[0][2], deferMock.call_args[0][3:]
+        element = func(*args)
+        self.assertFalse(service.is_initialized())
+        parsed.callback(element)
+        self.assertTrue(service.actions)
+
+    def test_builders_with_shared_fetcher_share_device(self, pageMock):
+        pageMock.return_value = defer.succeed(readall('ms.xml'))
+        fetcher = FetchCoordinator()
+        builder1 = DeviceBuilder(Mock(), lambda x: (True, None), lazy=True,
+                                 fetcher=fetcher)
+        builder2 = DeviceBuilder(Mock(), lambda x: (True, None), lazy=True,
+                                 fetcher=fetcher)
+        device1 = builder1.build('http://www.dummy.com').result
+        device2 = builder2.build('http://www.dummy.com').result
+
+        self.assertIs(device1, device2)
+        self.assertEqual(pageMock.call_count, 1)
+
     def test_failure_from_builder_contains_url(self, pageMock):
         pageMock.return_value = defer.fail(error.Error(http.NOT_FOUND, 'Not Found', 'Not Found'))
         builder = DeviceBuilder(Mock(), lambda x: (True, None))
@@ -88,3 +160,166 @@ class TestDeviceBuilder(unittest.TestCase):
 
         self.assertEqual(err[0].url, 'http://www.dummy.com/cds.xml')
 
+
+
+class TestParserPool(unittest.TestCase):
+
+    def tearDown(self):
+        if self.pool.running:
+            self.pool.stopService()
+
+    def test_small_document_is_parsed_inline(self):
+        self.pool = ParserPool(threshold=100)
+        self.pool.startService()
+        actual = self.pool.parse("<a/>", lambda data: threading.current_thread())
+
+        self.assertIs(actual.result, threading.current_thread())
+
+    def test_document_is_parsed_inline_when_not_running(self):
+        self.pool = ParserPool(threshold=0)
+        actual = self.pool.parse("<a/>", len)
+
+        self.assertEqual(actual.result, 4)
+
+    @patch('twisted.internet.threads.deferToThreadPool')
+    def test_large_document_is_parsed_in_thread_pool(self, deferMock):
+        self.pool = ParserPool(threshold=2)
+        self.pool.startService()
+        self.pool.parse("<a/>", len, 1)
+
+        args = deferMock.call_args[0]
+        self.assertEqual(args[2:], (len, "<a/>", 1))
+
+
+class TestDescriptionFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.data = readall('device_root.xml')
+        self.summaries = []
+
+    def accept(self, summary):
+        self.summaries.append(summary)
+
+    def reject(self, summary):
+        raise DeviceRejectedError(summary, "rejected")
+
+    def test_accepted_document_is_returned_as_tree(self):
+        dfilter = DescriptionFilter('', self.accept, self.accept)
+        for i in range(0, len(self.data), 100):
+            dfilter.feed(self.data[i:i + 100])
+        root = dfilter.close()
+
+        self.assertEqual(ET.tostring(root), ET.tostring(ET.fromstring(self.data)))
+
+    def test_checks_are_called_once(self):
+        dfilter = DescriptionFilter('', self.accept, self.accept)
+        dfilter.feed(self.data)
+        dfilter.close()
+
+        self.assertEqual(len(self.summaries), 2)
+
+    def test_malformed_document_fails_on_close(self):
+        dfilter = DescriptionFilter('', self.accept, self.accept)
+        dfilter.feed(self.data[:-20])
+
+        self.assertRaises(SyntaxError, dfilter.close)
+
+    def test_type_check_receives_device_type(self):
+        dfilter = DescriptionFilter('', self.accept, self.accept)
+        dfilter.feed(self.data)
+
+        self.assertEqual(self.summaries[0].deviceType,
+                         'urn:schemas-upnp-org:device:MediaRenderer:1')
+
+    def test_device_check_receives_services(self):
+        dfilter = DescriptionFilter('', self.accept, self.accept)
+        dfilter.feed(self.data)
+
+        types = [s.serviceType for s in self.summaries[1]]
+        self.assertIn('urn:schemas-upnp-org:service:AVTransport:1', types)
+        self.assertEqual(len(types), 3)
+
+    def test_type_rejection_happens_before_services_are_seen(self):
+        dfilter = DescriptionFilter('', self.reject, self.accept)
+        end = self.data.index('</deviceType>') + len('</deviceType>')
+
+        self.assertRaises(DeviceRejectedError, dfilter.feed, self.data[:end])
+        self.assertEqual(self.summaries, [])
+
+    def test_device_rejection_carries_summary(self):
+        dfilter = DescriptionFilter('', self.accept, self.reject)
+        try:
+            dfilter.feed(self.data)
+            self.fail("DeviceRejectedError not raised")
+        except DeviceRejectedError, e:
+            self.assertEqual(str(e.device), "WDTVLIVE [UDN=uuid:67ff722f-0090-a976-17db-e9396986c234]")
+
+
+class TestFetchCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fetcher = FetchCoordinator(10, self.clock)
+        self.result = defer.Deferred()
+        self.func = Mock(return_value=self.result)
+
+    def test_fetch_calls_func_with_url(self):
+        self.fetcher.fetch('http://a', self.func, 1, x=2)
+        self.func.assert_called_with('http://a', 1, x=2)
+
+    def test_concurrent_fetches_share_result(self):
+        d1 = self.fetcher.fetch('http://a', self.func)
+        d2 = self.fetcher.fetch('http://a', self.func)
+        self.result.callback('data')
+
+        self.assertEqual(self.func.call_count, 1)
+        self.assertEqual(d1.result, 'data')
+        self.assertEqual(d2.result, 'data')
+
+    def test_different_urls_are_fetched_separately(self):
+        self.fetcher.fetch('http://a', self.func)
+        self.fetcher.fetch('http://b', self.func)
+
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_forgotten_result_is_not_reused(self):
+        self.fetcher.fetch('http://a', self.func)
+        self.result.callback('data')
+        self.fetcher.forget('http://a')
+        self.fetcher.fetch('http://a', self.func)
+
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_recent_result_is_reused(self):
+        self.fetcher.fetch('http://a', self.func)
+        self.result.callback('data')
+        self.clock.advance(5)
+        d = self.fetcher.fetch('http://a', self.func)
+
+        self.assertEqual(self.func.call_count, 1)
+        self.assertEqual(d.result, 'data')
+
+    def test_old_result_is_not_reused(self):
+        self.fetcher.fetch('http://a', self.func)
+        self.result.callback('data')
+        self.clock.advance(10)
+        self.fetcher.fetch('http://a', self.func)
+
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_failure_is_not_reused(self):
+        d = self.fetcher.fetch('http://a', self.func)
+        d.addErrback(lambda _: None)
+        self.result.errback(ValueError())
+        self.fetcher.fetch('http://a', self.func)
+
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_cancelled_fetch_doesnt_affect_others(self):
+        d1 = self.fetcher.fetch('http://a', self.func)
+        d2 = self.fetcher.fetch('http://a', self.func)
+        d1.addErrback(lambda _: None)
+        d1.cancel()
+        self.result.callback('data')
+
+        self.assertEqual(d2.result, 'data')
@@ -0,0 +1,280 @@
+import unittest
+import mock
+from airpnp.device_discovery import DeviceManager, UpnpMessage, \
+        DeviceDiscoveryService
+from airpnp.device_builder import DeviceRejectedError
+from twisted.internet import defer, error, task
+
+
+def create_message(location, boot_id=None, config_id=None, udn='uuid:1'):
+    lines = ['NOTIFY * HTTP/1.1',
+             'LOCATION: %s' % (location, ),
+             'CACHE-CONTROL: max-age=1800',
+             'USN: %s::upnp:rootdevice' % (udn, )]
+    if boot_id is not None:
+        lines.append('BOOTID.UPNP.ORG: %s' % (boot_id, ))
+    if config_id is not None:
+        lines.append('CONFIGID.UPNP.ORG: %s' % (config_id, ))
+    return UpnpMessage('\r\n'.join(lines) + '\r\n\r\n')
+
+
+class TestDeviceManager(unittest.TestCase):
+
+    def setUp(self):
+        self.leases = mock.Mock()
+        self.mgr = DeviceManager(mock.Mock(UDN='uuid:1'), self.leases)
+        self.mgr.identify(create_message('http://a/d.xml', '1', '10'))
+
+    def test_same_message_is_not_a_change(self):
+        msg = create_message('http://a/d.xml', '1', '10')
+        self.assertFalse(self.mgr.has_changed(msg))
+
+    def test_new_location_is_a_change(self):
+        msg = create_message('http://a:8080/d.xml', '1', '10')
+        self.assertTrue(self.mgr.has_changed(msg))
+
+    def test_new_boot_id_is_a_change(self):
+        msg = create_message('http://a/d.xml', '2', '10')
+        self.assertTrue(self.mgr.has_changed(msg))
+
+    def test_new_config_id_is_a_change(self):
+        msg = create_message('http://a/d.xml', '1', '11')
+        self.assertTrue(self.mgr.has_changed(msg))
+
+    def test_missing_ids_are_not_a_change(self):
+        msg = create_message('http://a/d.xml')
+        self.assertFalse(self.mgr.has_changed(msg))
+
+    def test_config_is_same_if_config_id_is_same(self):
+        msg = create_message('http://a:8080/d.xml', '2', '10')
+        self.assertTrue(self.mgr.has_same_config(msg))
+
+    def test_config_is_unknown_without_config_id(self):
+        self.mgr.identify(create_message('http://a/d.xml'))
+        msg = create_message('http://a:8080/d.xml')
+        self.assertFalse(self.mgr.has_same_config(msg))
+
+    def test_touch_renews_lease(self):
+        self.mgr.touch(create_message('http://a/d.xml'))
+        self.leases.renew.assert_called_with('uuid:1', 1800)
+
+    def test_touch_by_embedded_device_renews_lease(self):
+        self.mgr.touch(create_message('http://a/d.xml', udn='uuid:2'))
+        self.leases.renew.assert_called_with('uuid:1', 1800)
+
+    def test_stop_cancels_lease(self):
+        self.mgr.touch(create_message('http://a/d.xml'))
+        self.mgr.stop()
+        self.leases.cancel.assert_called_with('uuid:1')
+
+
+class FakeDevice(object):
+
+    UDN = 'uuid:1'
+    deviceType = 'urn:schemas-upnp-org:device:MediaRenderer:1'
+    friendlyName = 'TV'
+
+    def __iter__(self):
+        return iter([])
+
+    def get_base_url(self):
+        return 'http://a/d.xml'
+
+    def update(self, other, keep_actions=False):
+        pass
+
+
+class RecordingDiscoveryService(DeviceDiscoveryService):
+
+    def __init__(self, clock):
+        DeviceDiscoveryService.__init__(self, '127.0.0.1', removal_grace=30,
+                                        add_debounce=2, clock=clock)
+        self.calls = []
+
+    def on_device_found(self, device):
+        self.calls.append('found')
+
+    def on_device_removed(self, device):
+        self.calls.append('removed')
+
+    def on_device_suspended(self, device):
+        self.calls.append('suspended')
+
+    def on_device_resumed(self, device):
+        self.calls.append('resumed')
+
+    def on_device_updated(self, device):
+        self.calls.append('updated')
+
+
+class TestDeviceHysteresis(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = RecordingDiscoveryService(self.clock)
+        self.service._leases.startService()
+        self.message = create_message('http://a/d.xml')
+        self.service._device_finished(FakeDevice(), self.message)
+
+    def tearDown(self):
+        self.service._leases.stopService()
+
+    def test_device_is_found_after_debounce(self):
+        self.assertEqual(self.service.calls, [])
+        self.clock.advance(2)
+        self.assertEqual(self.service.calls, ['found'])
+        self.assertEqual(len(self.service.find_devices()), 1)
+
+    def test_device_that_disappears_during_debounce_is_not_reported(self):
+        self.service._device_expired('uuid:1')
+        self.clock.advance(60)
+        self.assertEqual(self.service.calls, [])
+
+    def test_device_is_suspended_before_removal(self):
+        self.clock.advance(2)
+        self.service._device_expired('uuid:1')
+        self.assertEqual(self.service.calls, ['found', 'suspended'])
+        self.clock.advance(30)
+        self.assertEqual(self.service.calls, ['found', 'suspended', 'removed'])
+
+    def test_suspended_device_that_comes_back_is_resumed(self):
+        self.clock.advance(2)
+        self.service._device_expired('uuid:1')
+        self.service._handle_response(self.message)
+        self.clock.advance(60)
+        self.assertEqual(self.service.calls, ['found', 'suspended', 'resumed'])
+
+    def test_resumed_device_expires_again(self):
+        self.clock.advance(2)
+        self.service._device_expired('uuid:1')
+        self.service._handle_response(self.message)
+        self.clock.advance(1800)
+        self.assertEqual(self.service.calls[-1], 'suspended')
+
+    def test_subscriber_is_told_after_debounce(self):
+        added = []
+        self.service.subscribe(added.append, None)
+        self.assertEqual(added, [])
+        self.clock.advance(2)
+        self.assertEqual([d.UDN for d in added], ['uuid:1'])
+
+    def test_subscriber_is_told_about_removal(self):
+        removed = []
+        self.clock.advance(2)
+        self.service.subscribe(lambda d: None, removed.append)
+        self.service._device_expired('uuid:1')
+        self.assertEqual(removed, [])
+        self.clock.advance(30)
+        self.assertEqual([d.UDN for d in removed], ['uuid:1'])
+
+    def test_events_are_published_on_the_bus(self):
+        events = []
+        self.service.events.subscribe(events.extend)
+        self.clock.advance(2)
+        self.service._device_expired('uuid:1')
+        self.service.events.flush()
+        self.assertEqual([e.kind for e in events], ['found', 'suspended'])
+
+
+class TestDeviceRebuild(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = RecordingDiscoveryService(self.clock)
+        self.service._leases.startService()
+        self.builds = []
+        self.failure = None
+        builder = mock.Mock()
+        builder.build.side_effect = self._build
+        self.service._create_builder = lambda lazy: builder
+        self.service._handle_response(create_message('http://a/d.xml', '1'))
+        self.clock.advance(2)
+
+    def tearDown(self):
+        self.service._leases.stopService()
+
+    def _build(self, location):
+        self.builds.append(location)
+        if self.failure:
+            return defer.fail(self.failure)
+        return defer.succeed(FakeDevice())
+
+    def test_finished_build_is_forgotten(self):
+        self.assertEqual(self.service._builders, {})
+
+    def test_unchanged_device_is_not_rebuilt(self):
+        self.service._handle_response(create_message('http://a/d.xml', '1'))
+        self.assertEqual(self.builds, ['http://a/d.xml'])
+
+    def test_changed_device_is_rebuilt(self):
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.assertEqual(self.builds, ['http://a/d.xml', 'http://a:80/d.xml'])
+        self.assertEqual(self.service.calls, ['found', 'updated'])
+        self.assertEqual(self.service._builders, {})
+
+    def test_unpublished_device_is_not_reported_as_updated(self):
+        self.service._remove_device('uuid:1')
+        self.service._handle_response(create_message('http://a/d.xml', '1'))
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.assertEqual(self.service.calls, ['found', 'removed'])
+
+    def test_failed_rebuild_keeps_device(self):
+        self.failure = error.ConnectError()
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.clock.advance(60)
+        self.assertEqual(self.service.calls, ['found'])
+        self.assertEqual(self.service._builders, {})
+        self.assertEqual(len(self.service.find_devices()), 1)
+
+    def test_failed_rebuild_is_retried_after_backoff(self):
+        self.failure = error.ConnectError()
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.failure = None
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.assertEqual(len(self.builds), 2)
+        self.clock.advance(5)
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.assertEqual(len(self.builds), 3)
+        self.assertEqual(self.service.calls, ['found', 'updated'])
+
+    def test_rejected_rebuild_removes_device(self):
+        self.failure = DeviceRejectedError(FakeDevice(), 'not interesting')
+        self.service._handle_response(create_message('http://a:80/d.xml', '2'))
+        self.assertEqual(self.service.calls, ['found', 'removed'])
+        self.assertEqual(self.service._builders, {})
+
+    def test_embedded_device_is_handled_by_root_device(self):
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(self.service.calls, ['found'])
+
+    def test_changed_embedded_device_rebuilds_root_device(self):
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        self.service._handle_response(create_message('http://a:80/d.xml', '2',
+                                                     udn='uuid:2'))
+        self.assertEqual(len(self.builds), 3)
+        self.assertEqual(self.service.calls, ['found', 'updated'])
+        self.assertEqual(self.service._builders, {})
+
+    def test_embedded_device_says_goodbye_for_root_device(self):
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        msg = create_message('http://a/d.xml', udn='uuid:2')
+        msg.headers['NTS'] = 'ssdp:byebye'
+        self.service._handle_notify(msg)
+        self.assertEqual(self.service.calls, ['found', 'suspended'])
+
+    def test_embedded_device_keeps_root_device_alive(self):
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        self.clock.advance(1000)
+        self.service._handle_response(create_message('http://a/d.xml', '1',
+                                                     udn='uuid:2'))
+        self.clock.advance(1000)
+        self.assertEqual(self.service.calls, ['found'])
+        self.clock.advance(1000)
+        self.assertEqual(self.service.calls, ['found', 'suspended'])
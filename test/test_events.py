@@ -0,0 +1,70 @@
+import unittest
+import mock
+from airpnp.events import *
+from twisted.internet import task
+
+
+class TestEventBus(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bus = EventBus(0.1, self.clock)
+        self.received = []
+
+    def receive(self, events):
+        self.received.append([(e.kind, e.device) for e in events])
+
+    def test_events_are_not_delivered_synchronously(self):
+        self.bus.subscribe(self.receive)
+        self.bus.publish(FOUND, 'a')
+        self.assertEqual(self.received, [])
+
+    def test_events_are_delivered_in_one_batch(self):
+        self.bus.subscribe(self.receive)
+        self.bus.publish(FOUND, 'a')
+        self.bus.publish(FOUND, 'b')
+        self.clock.advance(0.1)
+        self.assertEqual(self.received, [[(FOUND, 'a'), (FOUND, 'b')]])
+
+    def test_later_events_are_delivered_in_next_batch(self):
+        self.bus.subscribe(self.receive)
+        self.bus.publish(FOUND, 'a')
+        self.clock.advance(0.1)
+        self.bus.publish(REMOVED, 'a')
+        self.clock.advance(0.1)
+        self.assertEqual(self.received, [[(FOUND, 'a')], [(REMOVED, 'a')]])
+
+    def test_events_are_filtered_by_kind(self):
+        self.bus.subscribe(self.receive, [REMOVED])
+        self.bus.publish(FOUND, 'a')
+        self.bus.publish(REMOVED, 'b')
+        self.bus.flush()
+        self.assertEqual(self.received, [[(REMOVED, 'b')]])
+
+    def test_events_are_filtered_by_device(self):
+        self.bus.subscribe(self.receive, filter_=lambda d: d == 'b')
+        self.bus.publish(FOUND, 'a')
+        self.bus.publish(FOUND, 'b')
+        self.bus.flush()
+        self.assertEqual(self.received, [[(FOUND, 'b')]])
+
+    def test_subscriber_without_events_is_not_called(self):
+        callback = mock.Mock()
+        self.bus.subscribe(callback, [REMOVED])
+        self.bus.publish(FOUND, 'a')
+        self.bus.flush()
+        self.assertFalse(callback.called)
+
+    def test_failing_subscriber_does_not_affect_others(self):
+        self.bus.subscribe(mock.Mock(side_effect=ValueError()))
+        self.bus.subscribe(self.receive)
+        self.bus.publish(FOUND, 'a')
+        self.bus.flush()
+        self.assertEqual(self.received, [[(FOUND, 'a')]])
+
+    def test_unsubscribed_callback_is_not_called(self):
+        sub = self.bus.subscribe(self.receive)
+        self.bus.unsubscribe(sub)
+        self.bus.publish(FOUND, 'a')
+        self.bus.flush()
+        self.assertEqual(self.received, [])
@@ -0,0 +1,93 @@
+import unittest
+import os
+import tempfile
+from airpnp.ignore_list import *
+from twisted.internet import task
+
+
+class TestIgnoreList(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.ignored = IgnoreList({REJECTED: 100, HTTP_ERROR: 10}, 3,
+                                  clock=self.clock)
+
+    def test_added_udn_is_ignored(self):
+        self.ignored.add("uuid:1", REJECTED)
+        self.assertTrue("uuid:1" in self.ignored)
+
+    def test_unknown_udn_is_not_ignored(self):
+        self.assertFalse("uuid:1" in self.ignored)
+
+    def test_category_is_returned(self):
+        self.ignored.add("uuid:1", HTTP_ERROR)
+        self.assertEqual(self.ignored.category("uuid:1"), HTTP_ERROR)
+
+    def test_entry_expires_according_to_category(self):
+        self.ignored.add("uuid:1", REJECTED)
+        self.ignored.add("uuid:2", HTTP_ERROR)
+        self.clock.advance(10)
+
+        self.assertTrue("uuid:1" in self.ignored)
+        self.assertFalse("uuid:2" in self.ignored)
+
+    def test_explicit_ttl_overrides_category(self):
+        self.ignored.add("uuid:1", REJECTED, 5)
+        self.clock.advance(5)
+        self.assertFalse("uuid:1" in self.ignored)
+
+    def test_removed_udn_is_not_ignored(self):
+        self.ignored.add("uuid:1", REJECTED)
+        self.ignored.remove("uuid:1")
+        self.assertFalse("uuid:1" in self.ignored)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.ignored.add("uuid:1", REJECTED)
+        self.ignored.add("uuid:2", REJECTED)
+        self.ignored.add("uuid:3", REJECTED)
+        "uuid:1" in self.ignored
+        self.ignored.add("uuid:4", REJECTED)
+
+        self.assertEqual(len(self.ignored), 3)
+        self.assertTrue("uuid:1" in self.ignored)
+        self.assertFalse("uuid:2" in self.ignored)
+
+
+class TestIgnoreListPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _create(self):
+        return IgnoreList(path=self.path, clock=self.clock)
+
+    def test_saved_entries_are_loaded(self):
+        ignored = self._create()
+        ignored.add("uuid:1", REJECTED)
+        ignored.save()
+
+        loaded = self._create()
+        loaded.load()
+        self.assertTrue("uuid:1" in loaded)
+
+    def test_expired_entries_are_not_loaded(self):
+        ignored = self._create()
+        ignored.add("uuid:1", HTTP_ERROR)
+        ignored.save()
+        self.clock.advance(3600)
+
+        loaded = self._create()
+        loaded.load()
+        self.assertFalse("uuid:1" in loaded)
+
+    def test_missing_file_is_ignored(self):
+        os.remove(self.path)
+        loaded = self._create()
+        loaded.load()
+        self.assertEqual(len(loaded), 0)
+        open(self.path, 'w').close()
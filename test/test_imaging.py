@@ -0,0 +1,168 @@
+import unittest
+import mock
+from airpnp import imaging
+from airpnp.imaging import PhotoScaler, target_from_protocol_info
+from airpnp.photostore import PhotoStore
+from cStringIO import StringIO
+from twisted.internet import defer
+
+TARGET = (1920, 1080, 0)
+
+
+class TestTargetFromProtocolInfo(unittest.TestCase):
+
+    def test_without_jpeg_profiles(self):
+        sink = "http-get:*:image/jpeg:*,http-get:*:video/mp4:*"
+        self.assertEqual(target_from_protocol_info(sink, TARGET), TARGET)
+
+    def test_largest_profile_caps_target(self):
+        sink = "http-get:*:image/jpeg:DLNA.ORG_PN=JPEG_SM," + \
+                "http-get:*:image/jpeg:DLNA.ORG_PN=JPEG_MED;DLNA.ORG_OP=01"
+        self.assertEqual(target_from_protocol_info(sink, TARGET),
+                         (1024, 768, 0))
+
+    def test_large_profile_keeps_target(self):
+        sink = "http-get:*:image/jpeg:DLNA.ORG_PN=JPEG_LRG"
+        self.assertEqual(target_from_protocol_info(sink, TARGET), TARGET)
+
+    def test_empty_sink(self):
+        self.assertEqual(target_from_protocol_info("", TARGET), TARGET)
+
+
+class TestPhotoScaler(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PhotoStore()
+        self.store.add('a.jpg', 'image/jpeg', 'original')
+        self.jobs = []
+        self.result = 'scaled'
+        self.scaler = PhotoScaler(self.store, run=self.run_job,
+                                  scale_func=self.scale)
+
+    def tearDown(self):
+        self.store.clear()
+
+    def run_job(self, func, *args):
+        d = defer.Deferred()
+        self.jobs.append((d, func, args))
+        return d
+
+    def scale(self, width, height, max_bytes, data, path):
+        return self.result
+
+    def finish_jobs(self):
+        for d, func, args in self.jobs:
+            d.callback(func(*args))
+        self.jobs = []
+
+    def get_name(self, d):
+        names = []
+        d.addCallback(names.append)
+        return names[0]
+
+    def test_scaled_photo_is_added_to_store(self):
+        d = self.scaler.scale('a.jpg', TARGET)
+        self.finish_jobs()
+
+        name = self.get_name(d)
+        self.assertNotEqual(name, 'a.jpg')
+        self.assertEqual(self.store.get(name).data, 'scaled')
+
+    def test_photo_is_passed_to_scale_function(self):
+        self.scaler.scale('a.jpg', TARGET)
+
+        self.assertEqual(self.jobs[0][2], (1920, 1080, 0, 'original', None))
+
+    def test_scaled_photo_is_reused(self):
+        self.scaler.scale('a.jpg', TARGET)
+        self.finish_jobs()
+        d = self.scaler.scale('a.jpg', TARGET)
+
+        self.assertEqual(self.jobs, [])
+        # one reference is held by the scaler
+        self.assertEqual(self.store.get(self.get_name(d)).refs, 3)
+
+    def test_unpublished_scaled_photo_is_reused(self):
+        d = self.scaler.scale('a.jpg', TARGET)
+        self.finish_jobs()
+        self.store.remove(self.get_name(d))
+        self.scaler.scale('a.jpg', TARGET)
+
+        self.assertEqual(self.jobs, [])
+
+    def test_least_recently_used_scaled_photo_is_released(self):
+        with mock.patch('airpnp.imaging.SCALED_CACHE_SIZE', 1):
+            d = self.scaler.scale('a.jpg', TARGET)
+            self.finish_jobs()
+            first = self.get_name(d)
+            self.store.remove(first)
+            self.scaler.scale('a.jpg', (640, 480, 0))
+            self.finish_jobs()
+
+        self.assertFalse(first in self.store)
+
+    def test_concurrent_requests_share_job(self):
+        d1 = self.scaler.scale('a.jpg', TARGET)
+        d2 = self.scaler.scale('a.jpg', TARGET)
+        self.assertEqual(len(self.jobs), 1)
+        self.finish_jobs()
+
+        name = self.get_name(d1)
+        self.assertEqual(self.get_name(d2), name)
+        self.assertEqual(self.store.get(name).refs, 3)
+
+    def test_other_target_is_scaled_separately(self):
+        self.scaler.scale('a.jpg', TARGET)
+        self.scaler.scale('a.jpg', (640, 480, 0))
+
+        self.assertEqual(len(self.jobs), 2)
+
+    def test_photo_that_fits_is_not_scaled_again(self):
+        self.result = None
+        d = self.scaler.scale('a.jpg', TARGET)
+        self.finish_jobs()
+        self.assertEqual(self.get_name(d), 'a.jpg')
+
+        d = self.scaler.scale('a.jpg', TARGET)
+        self.assertEqual(self.jobs, [])
+        self.assertEqual(self.get_name(d), 'a.jpg')
+
+    def test_original_is_shown_if_scaling_fails(self):
+        def fail(*args):
+            raise ValueError("corrupt")
+        self.scaler._scale_func = fail
+        self.scaler._run = lambda func, *args: defer.maybeDeferred(func, *args)
+        with mock.patch('twisted.python.log.err'):
+            d = self.scaler.scale('a.jpg', TARGET)
+
+        self.assertEqual(self.get_name(d), 'a.jpg')
+
+    def test_original_is_shown_if_store_is_full(self):
+        self.store.memory_budget = self.store.disk_budget = 0
+        d = self.scaler.scale('a.jpg', TARGET)
+        self.finish_jobs()
+
+        self.assertEqual(self.get_name(d), 'a.jpg')
+        self.assertEqual(len(self.store), 1)
+
+
+class TestScalePhoto(unittest.TestCase):
+
+    def setUp(self):
+        if not imaging.AVAILABLE:
+            self.skipTest("PIL is not installed")
+
+    def create_jpeg(self, width, height):
+        out = StringIO()
+        imaging.Image.new('RGB', (width, height)).save(out, 'JPEG')
+        return out.getvalue()
+
+    def test_large_photo_is_scaled(self):
+        data = imaging.scale_photo(100, 100, 0,
+                                   data=self.create_jpeg(400, 200))
+        image = imaging.Image.open(StringIO(data))
+        self.assertEqual(image.size, (100, 50))
+
+    def test_small_photo_is_not_scaled(self):
+        data = imaging.scale_photo(100, 100, 0, data=self.create_jpeg(50, 50))
+        self.assertEqual(data, None)
@@ -0,0 +1,76 @@
+import unittest
+import mock
+from airpnp.lease import LeaseManager
+from twisted.internet import task
+
+
+class TestLeaseManager(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.expire = mock.Mock()
+        self.leases = LeaseManager(self.expire, 1, self.clock)
+        self.leases.startService()
+
+    def tearDown(self):
+        self.leases.stopService()
+
+    def expired(self):
+        keys = []
+        for args, _ in self.expire.call_args_list:
+            keys.extend(args[0])
+        return sorted(keys)
+
+    def test_lease_is_not_expired_early(self):
+        self.leases.renew('a', 10)
+        self.clock.advance(9)
+        self.assertEqual(self.expired(), [])
+
+    def test_lease_expires(self):
+        self.leases.renew('a', 10)
+        self.clock.advance(10)
+        self.assertEqual(self.expired(), ['a'])
+        self.assertFalse('a' in self.leases)
+
+    def test_renewed_lease_is_extended(self):
+        self.leases.renew('a', 10)
+        self.clock.advance(5)
+        self.leases.renew('a', 10)
+        self.clock.advance(5)
+        self.assertEqual(self.expired(), [])
+        self.clock.advance(5)
+        self.assertEqual(self.expired(), ['a'])
+
+    def test_cancelled_lease_does_not_expire(self):
+        self.leases.renew('a', 10)
+        self.leases.cancel('a')
+        self.clock.advance(20)
+        self.assertEqual(self.expired(), [])
+        self.assertEqual(len(self.leases), 0)
+
+    def test_leases_expire_in_one_batch(self):
+        self.leases.renew('a', 10)
+        self.leases.renew('b', 10)
+        self.clock.advance(10)
+        self.assertEqual(self.expire.call_count, 1)
+        self.assertEqual(self.expired(), ['a', 'b'])
+
+    def test_fractional_lease_is_rounded_up(self):
+        self.clock.advance(0.5)
+        self.leases.renew('a', 1)
+        self.clock.advance(0.5)
+        self.assertEqual(self.expired(), [])
+        self.clock.advance(1)
+        self.assertEqual(self.expired(), ['a'])
+
+    def test_leases_expire_after_clock_jump(self):
+        self.leases.renew('a', 10)
+        self.leases.renew('b', 1000)
+        self.clock.advance(100000)
+        self.assertEqual(self.expired(), ['a', 'b'])
+
+    def test_no_ticks_after_stop(self):
+        self.leases.renew('a', 10)
+        self.leases.stopService()
+        self.clock.advance(20)
+        self.assertEqual(self.expired(), [])
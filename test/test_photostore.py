@@ -0,0 +1,230 @@
+import unittest
+import os
+import shutil
+import tempfile
+from mock import patch
+from airpnp.photostore import read_photo, write_photo
+from airpnp.photostore import PhotoStore, PhotoStoreFullError, photo_digest
+from cStringIO import StringIO
+from twisted.internet import defer
+
+
+class TestPhotoStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = PhotoStore(memory_budget=100, disk_budget=200,
+                                directory=self.dir)
+
+    def tearDown(self):
+        self.store.clear()
+        shutil.rmtree(self.dir)
+
+    def read(self, photo):
+        if photo.in_memory():
+            return photo.data
+        with open(photo.path, 'rb') as fd:
+            return fd.read()
+
+    def test_small_photo_is_kept_in_memory(self):
+        photo = self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+
+        self.assertTrue(photo.in_memory())
+        self.assertEqual(self.store.memory_used, 10)
+
+    def add_by_contents(self, source, **kwargs):
+        result = []
+        self.store.add_by_contents('image/jpeg', source, '.jpg',
+                                   **kwargs).addBoth(result.append)
+        return result[0]
+
+    def test_photo_is_read_from_file(self):
+        photo = self.add_by_contents(StringIO('x' * 10))
+
+        self.assertEqual(photo.data, 'x' * 10)
+
+    def test_photo_is_named_by_contents(self):
+        photo = self.add_by_contents(StringIO('x' * 10))
+
+        self.assertEqual(photo.name, photo_digest('x' * 10) + '.jpg')
+        self.assertTrue(photo.name in self.store)
+
+    def test_large_photo_is_written_to_file(self):
+        photo = self.add_by_contents(StringIO('x' * 30))
+
+        self.assertFalse(photo.in_memory())
+        self.assertEqual(self.read(photo), 'x' * 30)
+        self.assertEqual(self.store.memory_used, 0)
+        self.assertEqual(self.store.disk_used, 30)
+
+    def test_large_photo_added_again_is_shared(self):
+        first = self.add_by_contents(StringIO('x' * 30))
+        second = self.add_by_contents(StringIO('x' * 30))
+
+        self.assertTrue(first is second)
+        self.assertEqual(first.refs, 2)
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(first.path)])
+
+    def test_large_string_is_spilled(self):
+        photo = self.store.add('a.jpg', 'image/jpeg', 'x' * 30)
+
+        self.assertFalse(photo.in_memory())
+        self.assertEqual(self.read(photo), 'x' * 30)
+        self.assertEqual(self.store.disk_used, 30)
+
+    @patch('twisted.internet.threads.deferToThread')
+    def test_threaded_store_hashes_in_thread(self, deferMock):
+        self.store.threaded = True
+        self.store.add_by_contents('image/jpeg', StringIO('x' * 10))
+
+        self.assertEqual(deferMock.call_args[0][0], read_photo)
+
+    @patch('twisted.internet.threads.deferToThread')
+    def test_photo_is_served_from_memory_while_spilled(self, deferMock):
+        written = defer.Deferred()
+        deferMock.return_value = written
+        self.store.threaded = True
+        photo = self.store.add('a.jpg', 'image/jpeg', 'x' * 30)
+
+        self.assertEqual(deferMock.call_args[0][0], write_photo)
+        self.assertEqual(photo.buffer(), 'x' * 30)
+        self.assertEqual(self.store.disk_used, 30)
+        written.callback(write_photo('x' * 30, self.dir))
+        self.assertFalse(photo.in_memory())
+        self.assertEqual(self.read(photo), 'x' * 30)
+
+    @patch('twisted.internet.threads.deferToThread')
+    def test_file_of_photo_removed_while_spilled_is_deleted(self, deferMock):
+        written = defer.Deferred()
+        deferMock.return_value = written
+        self.store.threaded = True
+        self.store.add('a.jpg', 'image/jpeg', 'x' * 30)
+        self.store.remove('a.jpg')
+        written.callback(write_photo('x' * 30, self.dir))
+
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(self.store.disk_used, 0)
+
+    def test_least_recently_used_photo_is_spilled(self):
+        a = self.store.add('a.jpg', 'image/jpeg', 'a' * 20)
+        b = self.store.add('b.jpg', 'image/jpeg', 'b' * 20)
+        self.store.add('c.jpg', 'image/jpeg', 'c' * 20)
+        self.store.get('a.jpg')
+        self.store.add('d.jpg', 'image/jpeg', 'd' * 20)
+        self.store.add('e.jpg', 'image/jpeg', 'e' * 20)
+        self.store.add('f.jpg', 'image/jpeg', 'f' * 20)
+
+        self.assertTrue(a.in_memory())
+        self.assertFalse(b.in_memory())
+        self.assertEqual(self.read(b), 'b' * 20)
+        self.assertEqual(self.store.memory_used, 100)
+
+    def test_least_recently_used_photo_is_evicted(self):
+        for name in 'abcdefg':
+            self.store.add(name, 'image/jpeg', name * 30, evictable=True)
+
+        self.assertFalse('a' in self.store)
+        self.assertTrue('g' in self.store)
+        self.assertTrue(self.store.disk_used <= 200)
+
+    def test_photo_in_use_is_not_evicted(self):
+        self.store.add('a', 'image/jpeg', 'a' * 30)
+        for name in 'bcdefg':
+            self.store.add(name, 'image/jpeg', name * 30, evictable=True)
+
+        self.assertTrue('a' in self.store)
+        self.assertFalse('b' in self.store)
+        self.assertTrue(self.store.disk_used <= 200)
+
+    def test_photo_is_rejected_when_photos_in_use_fill_disk(self):
+        for name in 'abcdef':
+            self.store.add(name, 'image/jpeg', name * 30)
+
+        self.assertRaises(PhotoStoreFullError, self.store.add, 'g',
+                          'image/jpeg', 'g' * 30)
+        self.assertFalse('g' in self.store)
+        self.assertEqual(self.store.disk_used, 180)
+
+    def test_small_photo_is_rejected_when_nothing_can_be_spilled(self):
+        for name in 'abcdef':
+            self.store.add(name, 'image/jpeg', name * 30)
+        for name in 'hijkl':
+            self.store.add(name, 'image/jpeg', name * 20)
+
+        self.assertRaises(PhotoStoreFullError, self.store.add, 'm',
+                          'image/jpeg', 'm' * 25)
+        self.assertEqual(self.store.memory_used, 100)
+
+    def test_evictable_photos_make_room(self):
+        for name in 'abcde':
+            self.store.add(name, 'image/jpeg', name * 30)
+        self.store.add('f', 'image/jpeg', 'f' * 30, evictable=True)
+        self.store.add('g', 'image/jpeg', 'g' * 30)
+
+        self.assertFalse('f' in self.store)
+        self.assertTrue('g' in self.store)
+
+    def test_too_large_photo_is_rejected(self):
+        self.store.add('a', 'image/jpeg', 'a' * 30, evictable=True)
+
+        self.assertRaises(PhotoStoreFullError, self.store.add, 'b',
+                          'image/jpeg', 'b' * 300, evictable=True)
+
+    def test_rejected_file_is_deleted(self):
+        for name in 'abcdef':
+            self.store.add(name, 'image/jpeg', name * 30)
+        files = sorted(os.listdir(self.dir))
+        result = self.add_by_contents(StringIO('g' * 30))
+
+        self.assertTrue(result.check(PhotoStoreFullError))
+        self.assertEqual(sorted(os.listdir(self.dir)), files)
+
+    def test_remove_deletes_file(self):
+        photo = self.store.add('a.jpg', 'image/jpeg', 'x' * 30)
+        path = photo.path
+        self.store.remove('a.jpg')
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.store.disk_used, 0)
+        self.assertEqual(self.store.get('a.jpg'), None)
+
+    def test_add_shares_photo_with_same_name(self):
+        first = self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+        second = self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.memory_used, 10)
+
+    def test_shared_photo_is_kept_until_removed_by_all(self):
+        self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+        self.store.add('a.jpg', 'image/jpeg', 'x' * 10)
+        self.store.remove('a.jpg')
+
+        self.assertTrue('a.jpg' in self.store)
+        self.store.remove('a.jpg')
+        self.assertFalse('a.jpg' in self.store)
+        self.assertEqual(self.store.memory_used, 0)
+
+    def test_temporary_directory_is_removed(self):
+        store = PhotoStore(memory_budget=100)
+        photo = store.add('a.jpg', 'image/jpeg', 'x' * 30)
+        directory = os.path.dirname(photo.path)
+        store.clear()
+
+        self.assertFalse(os.path.exists(directory))
+
+
+class TestPhotoDigest(unittest.TestCase):
+
+    def test_same_digest_for_string_and_file(self):
+        data = 'x' * 100000
+        self.assertEqual(photo_digest(data), photo_digest(StringIO(data)))
+
+    def test_different_contents(self):
+        self.assertNotEqual(photo_digest('a'), photo_digest('b'))
+
+    def test_file_is_rewound(self):
+        fd = StringIO('abc')
+        photo_digest(fd)
+        self.assertEqual(fd.tell(), 0)
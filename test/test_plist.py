@@ -1,6 +1,7 @@
 import unittest
 import os.path
 import datetime
+import plistlib
 from airpnp.plist import *
 from airpnp.plist import UTC
 from cStringIO import StringIO
@@ -18,6 +19,79 @@ class TestReadBinary(unittest.TestCase):
         content = read_binary_plist(fd)
         self.assertTrue('value' in content)
 
+    def test_reading_from_string(self):
+        content = read_binary_plist(read_file('plist/airplay.bin').getvalue())
+        self.assertTrue('Content-Location' in content)
+
+    def test_reading_from_memoryview(self):
+        data = memoryview(read_file('plist/unicode.bin').getvalue())
+        self.assertEqual(read_binary_plist(data), u"non-ascii \u00e5\u00e4\u00f6")
+
+    def test_truncated_plist(self):
+        data = read_file('plist/airplay.bin').getvalue()
+        self.assertRaises(PListFormatError, read_binary_plist,
+                          data[:20] + data[-32:])
+
+    def test_too_short_plist(self):
+        self.assertRaises(PListFormatError, read_binary_plist, "bplist00")
+
+    def test_shared_objects_are_identical(self):
+        # array with two references to the same array
+        data = ('bplist00\xa2\x01\x01\xa1\x02\x10\x01'
+                '\x08\x0b\x0d'
+                '\x00\x00\x00\x00\x00\x00\x01\x01'
+                '\x00\x00\x00\x00\x00\x00\x00\x03'
+                '\x00\x00\x00\x00\x00\x00\x00\x00'
+                '\x00\x00\x00\x00\x00\x00\x00\x0f')
+        content = read_binary_plist(data)
+        self.assertEqual(content, [[1], [1]])
+        self.assertIs(content[0], content[1])
+
+
+
+class TestOpenBinary(unittest.TestCase):
+
+    def setUp(self):
+        data = 'bplist00\xd1\x01\x02Uvalue\xd4\x03\x04\x05\x06\x07\x07\x07\x07YtimescaleUvalueUepochUflags\x10\x00\x08\x0b\x11\x1a$*06\x00\x00\x00\x00\x00\x00\x01\x01\x00\x00\x00\x00\x00\x00\x00\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x008'
+        self.view = open_binary_plist(data)
+
+    def test_key_lookup(self):
+        self.assertEqual(self.view['value'], {'timescale': 0, 'value': 0,
+                                              'epoch': 0, 'flags': 0})
+
+    def test_path_lookup(self):
+        self.assertEqual(self.view.get(('value', 'timescale')), 0)
+
+    def test_missing_key_gives_default(self):
+        self.assertEqual(self.view.get('foo', 42), 42)
+        self.assertEqual(self.view.get(('value', 'foo', 'bar')), None)
+
+    def test_missing_key_raises_key_error(self):
+        self.assertRaises(KeyError, lambda: self.view['foo'])
+
+    def test_contains(self):
+        self.assertTrue('value' in self.view)
+        self.assertFalse('foo' in self.view)
+
+    def test_keys(self):
+        self.assertEqual(self.view.keys(), ['value'])
+
+    def test_whole_value(self):
+        self.assertEqual(self.view.value().keys(), ['value'])
+
+    def test_unaccessed_values_are_not_decoded(self):
+        self.assertTrue('value' in self.view)
+        # the top level dict is not decoded, only its key
+        self.assertEqual(self.view._reader._objects.values(), ['value'])
+
+    def test_array_index_lookup(self):
+        view = open_binary_plist(read_file('plist/array.bin'))
+        self.assertEqual(view.get(1), 2)
+        self.assertEqual(view.get(3), None)
+
+    def test_invalid_signature(self):
+        self.assertRaises(PListFormatError, open_binary_plist, "hello, world")
+
 
 def test_read_plist():  # generator function
     yield check_plist, 'plist/true.bin', True
@@ -52,3 +126,143 @@ def read_file(fname):
                            fname), 'rb') as fd:
         s = fd.read()
         return StringIO(s)
+
+
+class TestWriteBinary(unittest.TestCase):
+
+    def roundtrip(self, obj):
+        return read_binary_plist(write_binary_plist(obj))
+
+    def test_scalars(self):
+        for obj in [None, True, False, 0, 255, 256, 65536, 2 ** 40, -1,
+                    1.5, "hello", u"non-ascii \u00e5\u00e4\u00f6"]:
+            self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_bool_is_not_int(self):
+        self.assertIs(self.roundtrip([1, True])[1], True)
+
+    def test_data(self):
+        self.assertEqual(self.roundtrip(bytearray("\x00\x01")), "\x00\x01")
+
+    def test_date(self):
+        dt = datetime.datetime(2011, 7, 23, 15, tzinfo=UTC())
+        self.assertEqual(self.roundtrip(dt), dt)
+
+    def test_long_string(self):
+        self.assertEqual(self.roundtrip("x" * 1000), "x" * 1000)
+
+    def test_collections(self):
+        obj = {"list": [1, 2.0, "three"], "set": {1, 2}, "dict": {"a": None}}
+        self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_many_objects(self):
+        obj = range(1000)
+        self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_equal_values_are_stored_once(self):
+        once = write_binary_plist(["duration"])
+        twice = write_binary_plist(["duration", "duration"])
+        # only one more object reference
+        self.assertEqual(len(twice) - len(once), 1)
+
+    def test_fixture_is_reproduced(self):
+        data = read_file('plist/airplay.bin').getvalue()
+        obj = read_binary_plist(data)
+        self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_unsupported_type(self):
+        self.assertRaises(TypeError, write_binary_plist, object())
+
+    def test_non_string_key(self):
+        self.assertRaises(TypeError, write_binary_plist, {1: 2})
+
+
+class TestWriteXml(unittest.TestCase):
+
+    def roundtrip(self, obj):
+        return plistlib.readPlistFromString(write_xml_plist(obj))
+
+    def test_dict(self):
+        obj = {"duration": 20.5, "playing": True, "name": "a & b",
+               "list": [1, False]}
+        self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_unicode(self):
+        self.assertEqual(self.roundtrip(u"\u00e5"), u"\u00e5")
+
+    def test_date(self):
+        dt = datetime.datetime(2011, 7, 23, 15)
+        self.assertEqual(self.roundtrip(dt), dt)
+
+    def test_data(self):
+        self.assertEqual(self.roundtrip(bytearray("\x00")).data, "\x00")
+
+    def test_none_is_unsupported(self):
+        self.assertRaises(TypeError, write_xml_plist, None)
+
+
+class TestReadXml(unittest.TestCase):
+
+    def test_types(self):
+        data = plistlib.writePlistToString({
+            "s": "hello", "u": u"\u00e5", "i": -3, "r": 1.5, "t": True,
+            "f": False, "d": plistlib.Data("\x00\x01"),
+            "dt": datetime.datetime(2011, 7, 23, 15)})
+        obj = read_xml_plist(data)
+        self.assertEqual(obj, {
+            "s": "hello", "u": u"\u00e5", "i": -3, "r": 1.5, "t": True,
+            "f": False, "d": "\x00\x01",
+            "dt": datetime.datetime(2011, 7, 23, 15, tzinfo=UTC())})
+
+    def test_nested_collections(self):
+        value = {"a": [1, {"b": []}, {}], "c": {"d": ["e"]}}
+        data = plistlib.writePlistToString(value)
+        self.assertEqual(read_xml_plist(data), value)
+
+    def test_reading_from_file(self):
+        fd = StringIO(plistlib.writePlistToString([1, 2]))
+        fd.read()
+        self.assertEqual(read_xml_plist(fd), [1, 2])
+
+    def test_same_as_binary_reader(self):
+        fd = read_file('plist/airplay.bin')
+        value = read_binary_plist(fd)
+        self.assertEqual(read_xml_plist(write_xml_plist(value)), value)
+
+    def test_malformed_xml(self):
+        self.assertRaises(PListFormatError, read_xml_plist, "<plist><dict>")
+
+    def test_unknown_element(self):
+        self.assertRaises(PListFormatError, read_xml_plist,
+                          "<plist><foo/></plist>")
+
+    def test_invalid_integer(self):
+        self.assertRaises(PListFormatError, read_xml_plist,
+                          "<plist><integer>x</integer></plist>")
+
+    def test_value_without_key(self):
+        self.assertRaises(PListFormatError, read_xml_plist,
+                          "<plist><dict><true/></dict></plist>")
+
+    def test_empty_plist(self):
+        self.assertRaises(PListFormatError, read_xml_plist, "<plist></plist>")
+
+
+class TestOpenXml(unittest.TestCase):
+
+    def setUp(self):
+        data = plistlib.writePlistToString({"value": {"epoch": 1},
+                                            "list": [1, 2, 3]})
+        self.view = open_xml_plist(data)
+
+    def test_key_lookup(self):
+        self.assertEqual(self.view["value"], {"epoch": 1})
+
+    def test_path_lookup(self):
+        self.assertEqual(self.view.get(("list", 2)), 3)
+
+    def test_missing_key_gives_default(self):
+        self.assertEqual(self.view.get("missing", 5), 5)
+
+    def test_keys(self):
+        self.assertEqual(sorted(self.view.keys()), ["list", "value"])
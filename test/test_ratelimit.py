@@ -0,0 +1,66 @@
+import unittest
+from airpnp.ratelimit import SoapBudget
+from twisted.internet import task
+
+
+class TestSoapBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_unlimited_budget_admits_all_polls(self):
+        budget = SoapBudget(clock=self.clock)
+        for _ in range(100):
+            self.assertTrue(budget.acquire_poll(self.clock.seconds()))
+
+    def test_first_poll_is_always_admitted(self):
+        budget = SoapBudget(1, clock=self.clock)
+        budget.acquire_command()
+        self.assertTrue(budget.acquire_poll(None))
+
+    def test_poll_within_min_interval_is_refused(self):
+        budget = SoapBudget(0, 1.0, clock=self.clock)
+        last = self.clock.seconds()
+        self.clock.advance(0.5)
+        self.assertFalse(budget.acquire_poll(last))
+
+    def test_poll_after_min_interval_is_admitted(self):
+        budget = SoapBudget(0, 1.0, clock=self.clock)
+        last = self.clock.seconds()
+        self.clock.advance(1.0)
+        self.assertTrue(budget.acquire_poll(last))
+
+    def test_poll_interval_is_shared_among_sessions(self):
+        budget = SoapBudget(10, 0.1, clock=self.clock)
+        for session in range(20):
+            budget.session_started(session)
+        self.assertEqual(budget.poll_interval(), 2.0)
+
+    def test_poll_interval_counts_polled_actions(self):
+        budget = SoapBudget(10, 0.1, clock=self.clock)
+        for session in range(10):
+            budget.session_started(session, 2)
+        self.assertEqual(budget.poll_interval(), 2.0)
+
+    def test_ended_session_is_not_counted(self):
+        budget = SoapBudget(10, clock=self.clock)
+        budget.session_started("a")
+        budget.session_started("b")
+        budget.session_ended("a")
+        self.assertEqual(budget.session_count(), 1)
+
+    def test_commands_take_precedence_over_polls(self):
+        budget = SoapBudget(2, clock=self.clock)
+        last = self.clock.seconds()
+        self.clock.advance(1.0)
+        budget.acquire_command()
+        budget.acquire_command()
+        self.assertFalse(budget.acquire_poll(last))
+
+    def test_budget_is_refilled_over_time(self):
+        budget = SoapBudget(2, clock=self.clock)
+        budget.acquire_command()
+        budget.acquire_command()
+        last = self.clock.seconds()
+        self.clock.advance(1.0)
+        self.assertTrue(budget.acquire_poll(last))
@@ -0,0 +1,164 @@
+import unittest
+import mock
+from airpnp.registry import *
+
+MR1 = 'urn:schemas-upnp-org:device:MediaRenderer:1'
+MR2 = 'urn:schemas-upnp-org:device:MediaRenderer:2'
+MS1 = 'urn:schemas-upnp-org:device:MediaServer:1'
+AVT1 = 'urn:schemas-upnp-org:service:AVTransport:1'
+AVT2 = 'urn:schemas-upnp-org:service:AVTransport:2'
+CM1 = 'urn:schemas-upnp-org:service:ConnectionManager:1'
+
+
+class FakeService(object):
+
+    def __init__(self, serviceType):
+        self.serviceType = serviceType
+
+
+class FakeDevice(object):
+
+    def __init__(self, udn, deviceType, services, name='name',
+                 base_url='http://10.0.0.1:80/d.xml'):
+        self.UDN = udn
+        self.deviceType = deviceType
+        self.friendlyName = name
+        self.services = [FakeService(s) for s in services]
+        self.base_url = base_url
+
+    def __iter__(self):
+        return iter(self.services)
+
+    def get_base_url(self):
+        return self.base_url
+
+
+class FakeManager(object):
+
+    def __init__(self, device, published=True):
+        self.device = device
+        self.published = published
+
+
+class TestTypeIndex(unittest.TestCase):
+
+    def test_higher_version_is_compatible(self):
+        self.assertTrue(has_compatible_type(index_types([AVT2]), AVT1))
+
+    def test_lower_version_is_not_compatible(self):
+        self.assertFalse(has_compatible_type(index_types([AVT1]), AVT2))
+
+    def test_other_family_is_not_compatible(self):
+        self.assertFalse(has_compatible_type(index_types([CM1]), AVT1))
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.mr = FakeManager(FakeDevice('uuid:1', MR2, [AVT2, CM1], 'TV'))
+        self.ms = FakeManager(FakeDevice('uuid:2', MS1, [CM1], 'NAS',
+                                         'http://10.0.0.2/d.xml'))
+        self.registry.add(self.mr)
+        self.registry.add(self.ms)
+
+    def test_lookup_by_udn(self):
+        self.assertIs(self.registry.get('uuid:1'), self.mr)
+        self.assertTrue('uuid:2' in self.registry)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_find_by_compatible_device_type(self):
+        self.assertEqual(self.registry.find(device_type=MR1), [self.mr])
+
+    def test_find_by_incompatible_device_type(self):
+        self.registry.remove('uuid:1')
+        self.registry.add(FakeManager(FakeDevice('uuid:1', MR1, [])))
+        self.assertEqual(self.registry.find(device_type=MR2), [])
+
+    def test_find_by_service_type(self):
+        self.assertEqual(self.registry.find(service_type=AVT1), [self.mr])
+        self.assertEqual(len(self.registry.find(service_type=CM1)), 2)
+
+    def test_find_by_host(self):
+        self.assertEqual(self.registry.find(host='10.0.0.2'), [self.ms])
+
+    def test_find_by_friendly_name(self):
+        self.assertEqual(self.registry.find(friendly_name='TV'), [self.mr])
+
+    def test_find_by_several_criteria(self):
+        self.assertEqual(self.registry.find(service_type=CM1,
+                                            host='10.0.0.1'), [self.mr])
+
+    def test_find_with_unknown_criteria_fails(self):
+        self.assertRaises(ValueError, self.registry.find, color='red')
+
+    def test_removed_device_is_not_found(self):
+        self.registry.remove('uuid:1')
+        self.assertEqual(self.registry.find(service_type=AVT1), [])
+        self.assertFalse('uuid:1' in self.registry)
+
+    def test_reindex_after_update(self):
+        self.mr.device.friendlyName = 'Kitchen'
+        self.registry.reindex('uuid:1')
+        self.assertEqual(self.registry.find(friendly_name='TV'), [])
+        self.assertEqual(self.registry.find(friendly_name='Kitchen'), [self.mr])
+
+
+class TestDeviceRegistrySubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.added = mock.Mock()
+        self.removed = mock.Mock()
+        self.device = FakeDevice('uuid:1', MR1, [AVT1], 'TV')
+
+    def test_existing_matching_device_is_reported(self):
+        self.registry.add(FakeManager(self.device))
+        self.registry.subscribe(self.added, self.removed, service_type=AVT1)
+        self.added.assert_called_with(self.device)
+
+    def test_existing_unpublished_device_is_not_reported(self):
+        self.registry.add(FakeManager(self.device, published=False))
+        self.registry.subscribe(self.added, self.removed, service_type=AVT1)
+        self.assertFalse(self.added.called)
+
+    def test_added_device_is_not_reported_before_notify(self):
+        self.registry.subscribe(self.added, self.removed, service_type=AVT1)
+        self.registry.add(FakeManager(self.device))
+        self.assertFalse(self.added.called)
+
+    def test_notified_matching_device_is_reported(self):
+        self.registry.subscribe(self.added, self.removed, service_type=AVT1)
+        self.registry.add(FakeManager(self.device))
+        self.registry.notify('uuid:1', self.device)
+        self.added.assert_called_with(self.device)
+
+    def test_notified_other_device_is_not_reported(self):
+        self.registry.subscribe(self.added, self.removed, service_type=CM1)
+        self.registry.add(FakeManager(self.device))
+        self.registry.notify('uuid:1', self.device)
+        self.assertFalse(self.added.called)
+
+    def test_removed_matching_device_is_reported(self):
+        self.registry.subscribe(self.added, self.removed, service_type=AVT1)
+        self.registry.add(FakeManager(self.device))
+        self.registry.notify('uuid:1', self.device)
+        self.registry.remove('uuid:1')
+        self.registry.notify('uuid:1', self.device)
+        self.removed.assert_called_with(self.device)
+
+    def test_device_that_no_longer_matches_is_reported_as_removed(self):
+        self.registry.subscribe(self.added, self.removed, friendly_name='TV')
+        self.registry.add(FakeManager(self.device))
+        self.registry.notify('uuid:1', self.device)
+        self.device.friendlyName = 'Kitchen'
+        self.registry.reindex('uuid:1')
+        self.registry.notify('uuid:1', self.device)
+        self.removed.assert_called_with(self.device)
+
+    def test_unsubscribed_callbacks_are_not_called(self):
+        sub = self.registry.subscribe(self.added, self.removed)
+        self.registry.unsubscribe(sub)
+        self.registry.add(FakeManager(self.device))
+        self.registry.notify('uuid:1', self.device)
+        self.assertFalse(self.added.called)
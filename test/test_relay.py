@@ -0,0 +1,361 @@
+import unittest
+import httplib
+import mock
+from airpnp.relay import MediaRelay, RelayedMedia
+from airpnp.photostore import PhotoStore
+from cStringIO import StringIO
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.web import http, server
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+DATA = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, headers, length=UNKNOWN_LENGTH):
+        self.code = code
+        self.headers = Headers(dict((k, [v]) for k, v in headers.items()))
+        self.length = length
+
+
+class FakeUpstream(object):
+    """Stand-in for stream_page that records requests, which are answered
+    when the test says so."""
+
+    def __init__(self, data=DATA, ranges=True, content_type="video/mp4"):
+        self.data = data
+        self.ranges = ranges
+        self.content_type = content_type
+        self.requests = []
+
+    def __call__(self, url, consumer, timeout=0, headers=None):
+        d = defer.Deferred()
+        self.requests.append((headers["Range"], consumer, d))
+        return d
+
+    def ranges_requested(self):
+        return [r for r, _, _ in self.requests]
+
+    def answer(self, index=0, data=None):
+        value, consumer, d = self.requests.pop(index)
+        data = self.data if data is None else data
+        first, last = [int(v) for v in value.split("=")[1].split("-")]
+        if self.ranges:
+            body = data[first:last + 1]
+            headers = {"content-range": "bytes %d-%d/%d" %
+                       (first, first + len(body) - 1, len(self.data))}
+            response = FakeResponse(206, headers, len(body))
+        else:
+            body = data
+            response = FakeResponse(200, {}, len(data))
+        response.headers.setRawHeaders("content-type", [self.content_type])
+        try:
+            consumer.begin(response)
+            for i in range(0, len(body), 5):
+                consumer.feed(body[i:i + 5])
+            result = consumer.close()
+        except Exception, e:
+            d.errback(e)
+        else:
+            d.callback(result)
+
+    def fail(self, index=0):
+        _, _, d = self.requests.pop(index)
+        d.errback(IOError("connection refused"))
+
+    def answer_all(self):
+        while self.requests:
+            self.answer()
+
+
+class TestRelayedMedia(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("airpnp.relay.CHUNK_SIZE", 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = PhotoStore()
+        self.upstream = FakeUpstream()
+        self.media = RelayedMedia("m.mp4", "http://phone/m.mp4", self.cache,
+                                  read_ahead=16, stream=self.upstream)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def chunk(self, index):
+        result = []
+        self.media.get_chunk(index).addBoth(result.append)
+        self.upstream.answer_all()
+        return result[0]
+
+    def test_open_learns_size_and_type(self):
+        d = self.media.open()
+        self.upstream.answer_all()
+
+        self.assertEqual(self.media.size, len(DATA))
+        self.assertEqual(self.media.content_type, "video/mp4")
+        self.assertTrue(d.called)
+
+    def test_chunks_are_read_ahead_with_one_request(self):
+        self.media.get_chunk(1)
+
+        self.assertEqual(self.upstream.ranges_requested(), ["bytes=4-19"])
+
+    def test_chunk_data(self):
+        self.assertEqual(self.chunk(2), "89ab")
+
+    def test_chunk_is_served_if_cache_is_full(self):
+        self.cache.memory_budget = self.cache.disk_budget = 0
+
+        self.assertEqual(self.chunk(2), "89ab")
+        self.assertEqual(len(self.cache), 0)
+
+    def test_last_chunk_is_partial(self):
+        self.media.open()
+        self.upstream.answer_all()
+
+        self.assertEqual(self.chunk(8), "wxyz")
+
+    def test_cached_chunk_is_not_fetched_again(self):
+        self.chunk(0)
+        self.chunk(1)
+
+        self.assertEqual(len(self.cache), 4)
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_fetch_stops_at_cached_chunk(self):
+        self.chunk(2)
+        self.media.get_chunk(0)
+
+        self.assertEqual(self.upstream.ranges_requested(), ["bytes=0-7"])
+
+    def test_fetch_stops_at_end_of_media(self):
+        self.chunk(0)
+        self.media.get_chunk(7)
+
+        self.assertEqual(self.upstream.ranges_requested(), ["bytes=28-35"])
+
+    def test_pending_chunk_is_fetched_once(self):
+        self.media.get_chunk(0)
+        self.media.get_chunk(1)
+
+        self.assertEqual(len(self.upstream.requests), 1)
+
+    def test_prefetch_starts_next_request(self):
+        self.chunk(0)
+        self.media.prefetch(3)
+
+        self.assertEqual(self.upstream.ranges_requested(), ["bytes=16-31"])
+
+    def test_prefetch_looks_at_half_of_the_read_ahead(self):
+        self.chunk(0)
+        self.media.prefetch(1)
+
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_upstream_ignoring_ranges_fails_open(self):
+        self.upstream.ranges = False
+        result = []
+        self.media.open().addBoth(result.append)
+        self.upstream.answer_all()
+
+        self.assertTrue(result[0].check(IOError))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_playlist_fails_open(self):
+        self.upstream.content_type = "application/vnd.apple.mpegurl"
+        result = []
+        self.media.open().addBoth(result.append)
+        self.upstream.answer_all()
+
+        self.assertTrue(result[0].check(IOError))
+
+    def test_open_fires_when_upstream_response_begins(self):
+        self.upstream.answer = self.begin_only
+        result = []
+        self.media.open().addBoth(result.append)
+        self.upstream.answer()
+
+        self.assertEqual(result, [self.media])
+
+    def begin_only(self, index=0):
+        value, consumer, d = self.upstream.requests[index]
+        response = FakeResponse(206, {"content-range": "bytes 0-15/36",
+                                      "content-type": "video/mp4"}, 16)
+        consumer.begin(response)
+
+    def test_failed_fetch_fails_waiters(self):
+        result = []
+        self.media.get_chunk(0).addBoth(result.append)
+        self.upstream.fail()
+
+        self.assertTrue(result[0].check(IOError))
+
+    def test_failed_fetch_is_retried(self):
+        self.media.get_chunk(0).addErrback(lambda _: None)
+        self.upstream.fail()
+
+        self.assertEqual(self.chunk(0), "0123")
+
+    def test_short_upstream_response_fails_waiters(self):
+        result = []
+        self.media.get_chunk(1).addBoth(result.append)
+        self.upstream.answer(data=DATA[:6])
+
+        self.assertTrue(result[0].check(IOError))
+
+    def test_discard_removes_chunks(self):
+        self.chunk(0)
+        self.media.discard()
+
+        self.assertEqual(len(self.cache), 0)
+
+    def test_discard_cancels_fetches(self):
+        self.chunk(0)
+        self.media.get_chunk(5).addErrback(lambda _: None)
+        d = self.upstream.requests[0][2]
+        self.media.discard()
+
+        self.assertTrue(d.called)
+
+
+class TestMediaRelay(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("airpnp.relay.CHUNK_SIZE", 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.upstream = FakeUpstream()
+        self.relay = MediaRelay(0, 5, "127.0.0.1", read_ahead=16,
+                                stream=self.upstream)
+        self.relay._port = mock.Mock()
+        self.relay._port.getHost.return_value.port = 8080
+        self.proto = http.HTTPChannel()
+        self.proto.requestFactory = server.Request
+        self.proto.site = server.Site(self.relay.root)
+        self.proto.makeConnection(StringTransport())
+
+    def tearDown(self):
+        self.relay.cache.clear()
+
+    def relayed(self, url):
+        result = []
+        self.relay.relay(url).addCallback(result.append)
+        self.upstream.answer_all()
+        return result[0]
+
+    def get(self, uri, method="GET", **headers):
+        name = uri.rsplit("/", 1)[1]
+        data = "%s /%s HTTP/1.1\r\nHost: www.example.com\r\n" % (method, name)
+        for key, value in headers.items():
+            data += "%s: %s\r\n" % (key.replace("_", "-"), value)
+        self.proto.dataReceived(data + "\r\n")
+        self.upstream.answer_all()
+        resp = httplib.HTTPResponse(FakeSock(self.proto.transport.value()),
+                                    method=method)
+        resp.begin()
+        return resp
+
+    def test_relayed_url_is_local(self):
+        uri = self.relayed("http://phone/movie.mp4?x=1")
+
+        self.assertTrue(uri.startswith("http://127.0.0.1:8080/"))
+        self.assertTrue(uri.endswith(".mp4"))
+
+    def test_get_whole_media(self):
+        resp = self.get(self.relayed("http://phone/m.mp4"))
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Type"), "video/mp4")
+        self.assertEqual(resp.getheader("Accept-Ranges"), "bytes")
+        self.assertEqual(resp.read(), DATA)
+
+    def test_get_range(self):
+        resp = self.get(self.relayed("http://phone/m.mp4"),
+                        Range="bytes=6-13")
+
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.getheader("Content-Range"), "bytes 6-13/36")
+        self.assertEqual(resp.read(), DATA[6:14])
+
+    def test_small_ranges_are_served_from_the_cache(self):
+        uri = self.relayed("http://phone/m.mp4")
+        self.get(uri, Range="bytes=0-1")
+        self.proto.transport.clear()
+        resp = self.get(uri, Range="bytes=2-5")
+
+        self.assertEqual(resp.read(), DATA[2:6])
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_head(self):
+        resp = self.get(self.relayed("http://phone/m.mp4"), method="HEAD")
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Length"), "36")
+        self.assertEqual(resp.read(), "")
+
+    def test_unsatisfiable_range(self):
+        resp = self.get(self.relayed("http://phone/m.mp4"),
+                        Range="bytes=40-")
+
+        self.assertEqual(resp.status, 416)
+        self.assertEqual(resp.getheader("Content-Range"), "bytes */36")
+
+    def test_unknown_media(self):
+        resp = self.get("http://127.0.0.1:8080/abc.mp4")
+
+        self.assertEqual(resp.status, 404)
+
+    def test_unreachable_media_is_not_relayed(self):
+        result = []
+        self.relay.relay("http://phone/m.mp4").addCallback(result.append)
+        self.upstream.fail()
+
+        self.assertEqual(result, ["http://phone/m.mp4"])
+        self.assertEqual(self.relay._media, {})
+
+    def test_media_without_ranges_is_not_relayed(self):
+        self.upstream.ranges = False
+
+        self.assertEqual(self.relayed("http://phone/live.mp4"),
+                         "http://phone/live.mp4")
+        self.assertEqual(len(self.relay.cache), 0)
+
+    def test_playlist_is_not_relayed(self):
+        uri = self.relayed("http://phone/hls/index.m3u8")
+
+        self.assertEqual(uri, "http://phone/hls/index.m3u8")
+        self.assertEqual(self.upstream.requests, [])
+
+    def test_media_with_playlist_type_is_not_relayed(self):
+        self.upstream.content_type = "application/x-mpegURL"
+
+        self.assertEqual(self.relayed("http://phone/stream"),
+                         "http://phone/stream")
+
+    def test_released_media_is_discarded(self):
+        uri = self.relayed("http://phone/m.mp4")
+        self.get(uri)
+        self.relay.release(uri)
+
+        self.assertEqual(len(self.relay.cache), 0)
+        self.assertEqual(self.relay.get(uri.rsplit("/", 1)[1]), None)
+
+    def test_media_relayed_twice_is_released_twice(self):
+        uri = self.relayed("http://phone/m.mp4")
+        self.relayed("http://phone/m.mp4")
+        self.relay.release(uri)
+
+        self.assertNotEqual(self.relay.get(uri.rsplit("/", 1)[1]), None)
+
+
+class FakeSock(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode, bufsize=0):
+        return StringIO(self.data)
@@ -8,7 +8,8 @@ from airpnp.upnp import parse_duration as hms_to_sec
 from airpnp.upnp import to_duration as sec_to_hms
 from twisted.internet import defer
 from twisted.python import failure
-from twisted.web import error, http
+from twisted.web import client, error, http
+from twisted.web.http_headers import Headers
 
 
 class RaisingOpener:
@@ -376,6 +377,121 @@ class TestGetImageType(unittest.TestCase):
         actual = get_image_type(data)
         self.assertEqual(("image/unknown", ".bin"), actual)
 
+    def test_with_file_object(self):
+        fd = StringIO("\xff\xd8\x01\x02\x03\x04")
+        fd.read()
+        actual = get_image_type(fd)
+        self.assertEqual(("image/jpeg", ".jpg"), actual)
+        self.assertEqual(fd.tell(), 0)
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, body='', location=None):
+        self.code = code
+        self.phrase = 'Phrase'
+        self.headers = Headers()
+        if location:
+            self.headers.setRawHeaders('location', [location])
+        self.body = body
+
+    def setPreviousResponse(self, response):
+        self.previousResponse = response
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+
+class FakeAgent(object):
+    """Agent that answers requests from a dictionary of responses by URL."""
+
+    responses = {}
+    requests = []
+
+    def __init__(self, reactor, connectTimeout=None):
+        pass
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        FakeAgent.requests.append((uri, headers))
+        return defer.succeed(FakeAgent.responses[uri])
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.data = []
+
+    def feed(self, data):
+        self.data.append(data)
+
+    def close(self):
+        return ''.join(self.data)
+
+
+@patch('twisted.web.client.Agent', FakeAgent)
+class TestStreamPage(unittest.TestCase):
+
+    def setUp(self):
+        FakeAgent.requests = []
+        FakeAgent.responses = {
+            'http://host/desc.xml': FakeResponse(200, '<root/>'),
+            'http://host/old.xml': FakeResponse(301, location='/desc.xml'),
+            'http://host/missing.xml': FakeResponse(404),
+        }
+
+    def test_page_is_passed_to_consumer(self):
+        d = stream_page('http://host/desc.xml', Collector())
+
+        self.assertEqual(d.result, '<root/>')
+
+    def test_redirect_is_followed(self):
+        d = stream_page('http://host/old.xml', Collector())
+
+        self.assertEqual(d.result, '<root/>')
+        self.assertEqual(FakeAgent.requests[-1][0], 'http://host/desc.xml')
+
+    def test_error_status_fails(self):
+        d = stream_page('http://host/missing.xml', Collector())
+        err = []
+        d.addErrback(err.append)
+
+        self.assertTrue(err[0].check(error.Error))
+
+    def test_additional_headers_are_sent(self):
+        stream_page('http://host/desc.xml', Collector(),
+                    headers={'Range': 'bytes=0-9'})
+
+        headers = FakeAgent.requests[0][1]
+        self.assertEqual(headers.getRawHeaders('range'), ['bytes=0-9'])
+
+
+class TestParseByteRange(unittest.TestCase):
+
+    def test_closed_range(self):
+        self.assertEqual(parse_byte_range("bytes=0-9", 100), (0, 10))
+
+    def test_open_range(self):
+        self.assertEqual(parse_byte_range("bytes=90-", 100), (90, 100))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_byte_range("bytes=-10", 100), (90, 100))
+
+    def test_range_is_truncated(self):
+        self.assertEqual(parse_byte_range("bytes=90-200", 100), (90, 100))
+
+    def test_other_unit_is_ignored(self):
+        self.assertEqual(parse_byte_range("items=0-9", 100), None)
+
+    def test_multiple_ranges_are_ignored(self):
+        self.assertEqual(parse_byte_range("bytes=0-9,20-29", 100), None)
+
+    def test_malformed_range_is_ignored(self):
+        self.assertEqual(parse_byte_range("bytes=a-9", 100), None)
+
+    def test_unsatisfiable_range(self):
+        self.assertRaises(ValueError, parse_byte_range, "bytes=100-", 100)
+
 
 class TestFormatSoapMessage(unittest.TestCase):
 
@@ -416,6 +532,19 @@ class TestCreateDeviceId(unittest.TestCase):
         self.assertEqual(did1, did2)
 
 
+class TestSplitType(unittest.TestCase):
+
+    def test_numeric_version_is_int(self):
+        self.assertEqual(split_type('urn:upnp-org:service:AVTransport:2'),
+                         ('urn:upnp-org:service:AVTransport', 2))
+
+    def test_non_numeric_version_is_kept(self):
+        self.assertEqual(split_type('upnp:rootdevice'), ('upnp', 'rootdevice'))
+
+    def test_type_without_version(self):
+        self.assertEqual(split_type('rootdevice'), ('rootdevice', None))
+
+
 def test_service_compatibility(): # generator function
     # different types
     yield (check_compatibility, 'urn:upnp-org:service:ConnectionManager:1', 
@@ -445,3 +574,38 @@ def check_compatibility(req, act, exp_outcome):
     compat = are_service_types_compatible(req, act)
     assert exp_outcome == compat
 
+
+
+class TestTypeMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = TypeMatcher(['upnp:rootdevice',
+                                    'urn:upnp-org:service:AVTransport:2',
+                                    'urn:upnp-org:service:AVTransport:1'])
+
+    def test_same_type_matches(self):
+        self.assertTrue(self.matcher.matches('upnp:rootdevice'))
+
+    def test_lowest_required_version_is_used(self):
+        self.assertTrue(self.matcher.matches('urn:upnp-org:service:AVTransport:1'))
+
+    def test_higher_version_matches(self):
+        self.assertTrue(self.matcher.matches('urn:upnp-org:service:AVTransport:3'))
+
+    def test_other_family_does_not_match(self):
+        self.assertFalse(self.matcher.matches('urn:upnp-org:service:ConnectionManager:1'))
+
+    def test_other_non_numeric_version_does_not_match(self):
+        self.assertFalse(self.matcher.matches('upnp:smthelse'))
+
+    def test_empty_type_does_not_match(self):
+        self.assertFalse(self.matcher.matches(''))
+
+    def test_empty_matcher_is_false(self):
+        self.assertFalse(TypeMatcher([]))
+        self.assertTrue(self.matcher)
+
+    def test_result_is_memoized(self):
+        self.matcher.matches('upnp:rootdevice')
+        self.matcher._families.clear()
+        self.assertTrue(self.matcher.matches('upnp:rootdevice'))
@@ -0,0 +1,18 @@
+import unittest
+from airpnp.xmlbackend import load_backend
+
+
+class TestLoadBackend(unittest.TestCase):
+
+    def test_preferred_backend_is_used(self):
+        name, et = load_backend('ElementTree')
+        self.assertEqual(name, 'ElementTree')
+        self.assertEqual(et.__name__, 'xml.etree.ElementTree')
+
+    def test_accelerated_backend_is_default(self):
+        name, _ = load_backend()
+        self.assertEqual(name, 'cElementTree')
+
+    def test_unknown_backend_falls_back_to_default(self):
+        name, _ = load_backend('blob')
+        self.assertEqual(name, 'cElementTree')
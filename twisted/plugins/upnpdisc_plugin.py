@@ -34,20 +34,24 @@ from twisted.python import log
 
 from airpnp.config import config
 from airpnp.device_discovery import DeviceDiscoveryService
+from airpnp.events import FOUND, REMOVED
 
 
 class MainService(DeviceDiscoveryService):
 
     def __init__(self, ip):
         DeviceDiscoveryService.__init__(self, ip)
+        self.events.subscribe(self.log_events, [FOUND, REMOVED])
 
-    def on_device_found(self, device):
-        log.msg("Found device %s @ %s" % (device, device.get_base_url()))
-        for service in device:
-            log.msg(" -- service %s of type %s" % (service.serviceId, service.serviceType)) 
-
-    def on_device_removed(self, device):
-        log.msg("Lost device %s" % (device, ))
+    def log_events(self, events):
+        for event in events:
+            device = event.device
+            if event.kind == FOUND:
+                log.msg("Found device %s @ %s" % (device, device.get_base_url()))
+                for service in device:
+                    log.msg(" -- service %s of type %s" % (service.serviceId, service.serviceType)) 
+            else:
+                log.msg("Lost device %s" % (device, ))
 
 
 class MyServiceMaker(object):